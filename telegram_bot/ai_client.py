@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+ارتباط با API سایت chat01.ai
+chat01.ai API client
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Optional, AsyncIterator, Tuple
+
+import httpx
+
+from config import (
+    CHAT01_API_KEY,
+    DEFAULT_MODEL,
+    API_CONNECT_TIMEOUT,
+    API_READ_TIMEOUT,
+    API_WRITE_TIMEOUT,
+    API_POOL_TIMEOUT,
+    API_MAX_CONNECTIONS,
+    API_MAX_KEEPALIVE_CONNECTIONS,
+    API_KEEPALIVE_EXPIRY,
+    API_HTTP2,
+)
+from scheduler import upstream_scheduler
+from resilience import (
+    CircuitOpenError,
+    Ticket,
+    is_upstream_failure,
+    plan_retry,
+    request_deadline,
+    remaining,
+)
+from router import Backend, model_router
+from metrics import UPSTREAM_SECONDS, UPSTREAM_TTFT, UPSTREAM_RESPONSES
+
+logger = logging.getLogger(__name__)
+
+# کلاینت مشترک در طول عمر برنامه
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    """بررسی نصب بودن پکیج h2 برای HTTP/2"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """ساخت کلاینت HTTP با استخر اتصال و keep-alive"""
+    http2 = API_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("HTTP/2 requested but 'h2' is not installed; falling back to HTTP/1.1")
+        http2 = False
+    
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=httpx.Timeout(
+            connect=API_CONNECT_TIMEOUT,
+            read=API_READ_TIMEOUT,
+            write=API_WRITE_TIMEOUT,
+            pool=API_POOL_TIMEOUT,
+        ),
+        limits=httpx.Limits(
+            max_connections=API_MAX_CONNECTIONS,
+            max_keepalive_connections=API_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=API_KEEPALIVE_EXPIRY,
+        ),
+        headers={
+            "Authorization": f"Bearer {CHAT01_API_KEY}",
+            "Content-Type": "application/json",
+        },
+    )
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """ایجاد کلاینت مشترک (در post_init اپلیکیشن)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_http_client()
+    return _client
+
+
+async def close_http_client():
+    """بستن کلاینت مشترک (در post_shutdown اپلیکیشن)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """دریافت کلاینت مشترک؛ در صورت نبود، ساخته می‌شود"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_http_client()
+    return _client
+
+
+def _status_label(error: Exception) -> str:
+    """برچسب وضعیت یک درخواست ناموفق برای متریک‌ها"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return str(error.response.status_code)
+    if isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return 'timeout'
+    if isinstance(error, httpx.TransportError):
+        return 'connection'
+    return 'error'
+
+
+def _select_backend(model: str, stream: bool = False) -> Tuple[Backend, Ticket]:
+    """انتخاب backend و نوبت مدار آن برای تلاش بعدی"""
+    selected = model_router.select(model, stream=stream)
+    if selected is None:
+        raise CircuitOpenError(f"no upstream backend available for {model}")
+    backend = selected[0]
+    if backend.model != model:
+        logger.info(f"Routing {model} request to fallback {backend.name}")
+    return selected
+
+
+def _request_kwargs(backend: Backend, payload: dict, deadline: Optional[float] = None) -> dict:
+    """پارامترهای درخواست برای یک backend مشخص (timeoutها حداکثر تا پایان مهلت درخواست)"""
+    kwargs = {'json': {**payload, 'model': backend.model}}
+    if deadline is not None:
+        left = max(remaining(deadline), 0.001)
+        kwargs['timeout'] = httpx.Timeout(
+            connect=min(API_CONNECT_TIMEOUT, left),
+            read=min(API_READ_TIMEOUT, left),
+            write=min(API_WRITE_TIMEOUT, left),
+            pool=min(API_POOL_TIMEOUT, left),
+        )
+    if backend.api_key:
+        kwargs['headers'] = {"Authorization": f"Bearer {backend.api_key}"}
+    return kwargs
+
+
+async def _post_with_retry(payload: dict, user_id: Optional[int], model: str) -> dict:
+    """
+    ارسال درخواست با تلاش مجدد برای خطاهای گذرا (هر تلاش ممکن است به backend دیگری برود)
+    کل درخواست، با صف و همه‌ی تلاش‌ها و انتظارها، به API_REQUEST_DEADLINE محدود است.
+    """
+    deadline = request_deadline()
+    attempt = 0
+    while True:
+        backend, ticket = _select_backend(model)
+        started = None
+        
+        async def send():
+            nonlocal started
+            async with upstream_scheduler.slot(user_id):
+                started = time.monotonic()
+                return await get_http_client().post(
+                    backend.endpoint, **_request_kwargs(backend, payload, deadline)
+                )
+        
+        backend.in_flight += 1
+        try:
+            response = await asyncio.wait_for(send(), remaining(deadline))
+            response.raise_for_status()
+            data = response.json()
+        except asyncio.CancelledError:
+            # نوبت آزمایشی مدار نیمه‌باز باید آزاد شود، وگرنه backend دیگر درخواستی نمی‌گیرد
+            backend.breaker.release(ticket)
+            raise
+        except Exception as e:
+            latency = time.monotonic() - started if started is not None else None
+            # پایان مهلت در صف نوبت نشانه‌ی ناسالم بودن API نیست
+            backend.record(ticket, latency, True, started is not None and is_upstream_failure(e))
+            if started is not None:
+                UPSTREAM_RESPONSES.inc(model=backend.model, status=_status_label(e))
+            delay = plan_retry(attempt, e, deadline)
+            if delay is None:
+                raise
+            logger.warning(f"API request to {backend.name} failed ({e!r}), retrying in {delay:.1f}s")
+            attempt += 1
+            # انتظار بیرون از نوبت صف تا درخواست‌های دیگر معطل نمانند
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            backend.in_flight -= 1
+        latency = time.monotonic() - started
+        backend.record(ticket, latency, False)
+        UPSTREAM_SECONDS.observe(latency, model=backend.model, mode='complete')
+        UPSTREAM_RESPONSES.inc(model=backend.model, status=str(response.status_code))
+        return data
+
+
+async def chat_with_ai(messages: list, user_id: Optional[int] = None,
+                       model: Optional[str] = None) -> Optional[str]:
+    """ارسال درخواست به API و دریافت پاسخ"""
+    payload = {
+        "model": model or DEFAULT_MODEL,
+        "messages": messages,
+    }
+    
+    try:
+        data = await _post_with_retry(payload, user_id, payload['model'])
+        return data['choices'][0]['message']['content']
+    except CircuitOpenError:
+        logger.warning("API circuit open, request rejected")
+        return None
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        logger.error("API request timed out")
+        return None
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return None
+
+
+def _delta_content(chunk: dict) -> str:
+    """استخراج متن از یک تکه‌ی SSE"""
+    choices = chunk.get('choices') or []
+    if not choices:
+        return ''
+    delta = choices[0].get('delta') or choices[0].get('message') or {}
+    return delta.get('content') or ''
+
+
+async def _stream_once(backend: Backend, payload: dict, user_id: Optional[int],
+                       deadline: float) -> AsyncIterator[str]:
+    """یک تلاش برای دریافت پاسخ به صورت stream از یک backend"""
+    async with upstream_scheduler.slot(user_id), \
+            get_http_client().stream(
+                'POST', backend.endpoint, **_request_kwargs(backend, payload, deadline)
+            ) as response:
+        response.raise_for_status()
+        
+        # اگر سرور stream را نادیده بگیرد، پاسخ کامل JSON برمی‌گردد
+        if 'text/event-stream' not in response.headers.get('content-type', ''):
+            data = json.loads(await response.aread())
+            content = data['choices'][0]['message']['content']
+            if content:
+                yield content
+            return
+        
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                logger.warning(f"Invalid stream chunk: {data[:100]}")
+                continue
+            content = _delta_content(chunk)
+            if content:
+                yield content
+
+
+async def stream_chat_with_ai(messages: list, user_id: Optional[int] = None,
+                              model: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    ارسال درخواست با stream و دریافت تدریجی تکه‌های پاسخ (SSE)
+    تا پیش از رسیدن اولین تکه، خطاهای گذرا دوباره تلاش می‌شوند؛ پس از آن
+    استثنا بالا می‌رود تا فراخواننده تصمیم بگیرد. CircuitOpenError یعنی API در دسترس نیست.
+    تأخیر ثبت‌شده برای مسیریابی، زمان رسیدن اولین تکه است.
+    timeoutهای هر تلاش به باقی‌مانده‌ی API_REQUEST_DEADLINE محدود می‌شوند و پس از پایان آن تلاش تازه‌ای شروع نمی‌شود.
+    """
+    payload = {
+        "model": model or DEFAULT_MODEL,
+        "messages": messages,
+        "stream": True,
+    }
+    
+    deadline = request_deadline()
+    attempt = 0
+    while True:
+        backend, ticket = _select_backend(payload['model'], stream=True)
+        started = time.monotonic()
+        first_token = False
+        backend.in_flight += 1
+        try:
+            async for content in _stream_once(backend, payload, user_id, deadline):
+                if not first_token:
+                    first_token = True
+                    ttft = time.monotonic() - started
+                    backend.record(ticket, ttft, False, stream=True)
+                    UPSTREAM_TTFT.observe(ttft, model=backend.model)
+                yield content
+        except asyncio.CancelledError:
+            if not first_token:
+                backend.breaker.release(ticket)
+            raise
+        except Exception as e:
+            UPSTREAM_RESPONSES.inc(model=backend.model, status=_status_label(e))
+            if first_token:
+                raise
+            backend.record(ticket, time.monotonic() - started, True, is_upstream_failure(e), stream=True)
+            delay = plan_retry(attempt, e, deadline)
+            if delay is None:
+                raise
+            logger.warning(f"API stream from {backend.name} failed ({e!r}), retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            backend.in_flight -= 1
+        if not first_token:
+            backend.record(ticket, time.monotonic() - started, False, stream=True)
+        UPSTREAM_SECONDS.observe(time.monotonic() - started, model=backend.model, mode='stream')
+        UPSTREAM_RESPONSES.inc(model=backend.model, status='200')
+        return
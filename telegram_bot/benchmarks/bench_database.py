@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+میکروبنچمارک متدهای Database روی دیتابیسی با تعداد ردیف واقعی
+Micro-benchmarks for each Database method on a seeded database
+
+اجرا: python benchmarks/bench_database.py --users 2000 --chats 5 --messages 20 --iterations 2000
+برای PostgreSQL: STORAGE_BACKEND=postgres DATABASE_URL=... (فقط روی یک دیتابیس آزمایشی)
+"""
+
+import argparse
+import itertools
+import os
+import random
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Tuple
+
+from common import BENCH_DIR, prepare_environment, summarize, write_report, print_table
+
+WORDS = (
+    'سلام لطفاً توضیح بده چطور می‌توانم این کد را سریع‌تر کنم python database query index '
+    'cache latency throughput وقتی کاربر پیام می‌فرستد پاسخ باید کوتاه و دقیق باشد'
+).split()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Database micro-benchmarks')
+    parser.add_argument('--users', type=int, default=2000, help='seeded users')
+    parser.add_argument('--chats', type=int, default=5, help='chats per user')
+    parser.add_argument('--messages', type=int, default=20, help='messages per chat')
+    parser.add_argument('--iterations', type=int, default=2000, help='calls per method')
+    parser.add_argument('--only', default='', help='comma separated method names to run')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--database', default=None,
+                        help='database file; an already seeded file is reused as is')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results', 'database.json'))
+    return parser.parse_args(argv)
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed(db, users: int, chats: int, messages: int, rng: random.Random) -> float:
+    """پر کردن دیتابیس با کاربران، گفتگوها، پیام‌ها و آمار روزانه؛ زمان صرف‌شده"""
+    from database import estimate_tokens
+    
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    today = date.today()
+    with db.connection() as conn:
+        for first in range(1, users + 1, 500):
+            user_rows, chat_rows, message_rows, usage_rows = [], [], [], []
+            for user_id in range(first, min(first + 500, users + 1)):
+                joined = now - timedelta(days=rng.uniform(1, 365))
+                user_rows.append((
+                    user_id, f'user{user_id}', f'User {user_id}',
+                    rng.choice((20, 20, 50, -1)), joined.strftime('%Y-%m-%d %H:%M:%S'),
+                ))
+                for days_ago in range(rng.randint(0, 7)):
+                    usage_rows.append((user_id, (today - timedelta(days=days_ago)).isoformat(), rng.randint(1, 20)))
+                for number in range(chats):
+                    chat_id = str(uuid.UUID(int=rng.getrandbits(128)))
+                    created = joined + (now - joined) * (number + 1) / (chats + 1)
+                    summarized = messages > 10 and rng.random() < 0.3
+                    chat_rows.append((
+                        chat_id, user_id, f'گفتگو {number + 1}', created.strftime('%Y-%m-%d %H:%M:%S'),
+                        1 if number == chats - 1 else 0,
+                        _text(rng, 60) if summarized else None,
+                    ))
+                    for index in range(messages):
+                        content = _text(rng, rng.randint(5, 25) if index % 2 == 0 else rng.randint(30, 150))
+                        sent = created + timedelta(minutes=index)
+                        message_rows.append((
+                            chat_id, 'user' if index % 2 == 0 else 'assistant', content,
+                            sent.strftime('%Y-%m-%d %H:%M:%S'), estimate_tokens(content),
+                            1 if summarized and index < messages // 2 else 0,
+                        ))
+            conn.executemany(
+                'INSERT INTO users (user_id, username, first_name, daily_limit, created_at) VALUES (?, ?, ?, ?, ?)',
+                user_rows
+            )
+            conn.executemany(
+                'INSERT INTO chats (chat_id, user_id, chat_name, created_at, is_active, summary) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                chat_rows
+            )
+            conn.executemany(
+                'INSERT INTO messages (chat_id, role, content, created_at, tokens, archived) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                message_rows
+            )
+            conn.executemany(
+                'INSERT INTO daily_usage (user_id, usage_date, message_count) VALUES (?, ?, ?)',
+                usage_rows
+            )
+    db.optimize_storage()
+    return time.perf_counter() - started
+
+
+def load_fixtures(db) -> Tuple[List[int], Dict[int, List[str]]]:
+    """شناسه‌ی کاربران و گفتگوهای هر کاربر برای انتخاب تصادفی آرگومان‌ها"""
+    with db.connection() as conn:
+        user_ids = [row[0] for row in conn.execute('SELECT user_id FROM users')]
+        chats: Dict[int, List[str]] = {}
+        for row in conn.execute('SELECT user_id, chat_id FROM chats'):
+            chats.setdefault(row[0], []).append(row[1])
+    return [user_id for user_id in user_ids if user_id in chats], chats
+
+
+def benchmarks(db, user_ids: List[int], chats: Dict[int, List[str]],
+               rng: random.Random) -> Dict[str, Callable[[], object]]:
+    """هر مورد: یک فراخوانی متد با آرگومان‌های تصادفی"""
+    cache = db.user_cache
+    new_users = itertools.count(max(user_ids) + 1)
+    expired_before = (datetime.utcnow() - timedelta(days=90)).strftime('%Y-%m-%d %H:%M:%S')
+    
+    def user() -> int:
+        return rng.choice(user_ids)
+    
+    def chat() -> str:
+        return rng.choice(chats[user()])
+    
+    def state_cold():
+        user_id = user()
+        cache.invalidate(user_id)
+        return db.get_user_state(user_id)
+    
+    def chats_page_after():
+        user_id = user()
+        return db.get_user_chats_page(user_id, after=chats[user_id][0])
+    
+    def users_page_after():
+        return db.get_users_page(after=user())
+    
+    return {
+        # ---- خواندن ----
+        'get_user_state (cold)': state_cold,
+        'get_user_state (cached)': lambda: db.get_user_state(user_ids[0]),
+        'is_user_blocked': lambda: db.is_user_blocked(user()),
+        'get_active_chat': lambda: db.get_active_chat(user()),
+        'get_user_chats': lambda: db.get_user_chats(user()),
+        'get_user_chats_page': lambda: db.get_user_chats_page(user()),
+        'get_user_chats_page (after)': chats_page_after,
+        'get_user_chat': lambda: db.get_user_chat(user(), chat()),
+        'count_user_chats': lambda: db.count_user_chats(user()),
+        'get_users_page': lambda: db.get_users_page(),
+        'get_users_page (after)': users_page_after,
+        'search_users (prefix)': lambda: db.search_users(f'user{rng.randint(1, 99)}'),
+        'search_users (id)': lambda: db.search_users(str(user())),
+        'get_chat_messages': lambda: db.get_chat_messages(chat()),
+        'get_recent_messages': lambda: db.get_recent_messages(chat(), 4000),
+        'get_context_window': lambda: db.get_context_window(chat(), 4000),
+        'get_history_tokens': lambda: db.get_history_tokens(chat()),
+        'get_compaction_batch': lambda: db.get_compaction_batch(chat(), 500, 4000),
+        'get_user_stats': lambda: db.get_user_stats(user()),
+        'get_expired_chats': lambda: db.get_expired_chats(expired_before, 200),
+        # ---- نوشتن ----
+        'ensure_user (known)': lambda: db.ensure_user(user_ids[0], 'user1', 'User 1'),
+        'ensure_user (new)': lambda: db.ensure_user(next(new_users), 'bench', 'Bench'),
+        'admit_message': lambda: db.admit_message(user()),
+        'refund_message': lambda: db.refund_message(user()),
+        'increment_daily_usage': lambda: db.increment_daily_usage(user()),
+        'add_message': lambda: db.add_message(chat(), 'user', _text(rng, 20)),
+        'record_turn': lambda: db.record_turn(chat(), _text(rng, 20), _text(rng, 80)),
+        'set_user_limit': lambda: db.set_user_limit(user(), rng.choice((20, 50, -1))),
+        'set_chat_model': lambda: db.set_chat_model(user(), chat(), None),
+        'save_user_data': lambda: db.save_user_data(user(), {'bench': rng.random()}),
+    }
+
+
+def main(args: argparse.Namespace):
+    database_path = prepare_environment(args.database)
+    # دیتابیس با import ماژول database (و مهاجرت‌ها) ساخته می‌شود
+    from database import db
+    
+    rng = random.Random(args.seed)
+    seconds = None
+    with db.connection() as conn:
+        seeded = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    if not seeded:
+        seconds = seed(db, args.users, args.chats, args.messages, rng)
+        print(f'seeded {args.users} users, {args.users * args.chats} chats and '
+              f'{args.users * args.chats * args.messages} messages in {seconds:.1f}s')
+    
+    user_ids, chats = load_fixtures(db)
+    cases = benchmarks(db, user_ids, chats, rng)
+    if args.only:
+        selected = {name.strip() for name in args.only.split(',')}
+        cases = {name: case for name, case in cases.items() if name in selected or name.split(' ')[0] in selected}
+    
+    results = {}
+    for name, case in cases.items():
+        for _ in range(min(50, args.iterations)):
+            case()
+        samples = []
+        for _ in range(args.iterations):
+            started = time.perf_counter()
+            case()
+            samples.append(time.perf_counter() - started)
+        results[name] = summarize(samples)
+    db.close()
+    
+    with_counts = dict(vars(args), database=database_path, backend=db.backend.name)
+    with_counts.pop('output')
+    extra = {'seed_seconds': round(seconds, 2) if seconds is not None else None,
+             'rows': {'users': len(user_ids), 'chats': sum(len(ids) for ids in chats.values())}}
+    print_table(results)
+    write_report(args.output, 'database', with_counts, results, extra)
+    print(f'report written to {args.output}')
+
+
+if __name__ == '__main__':
+    main(parse_args())
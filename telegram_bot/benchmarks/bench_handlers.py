@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+بنچمارک بار هندلرهای ربات: Updateهای مصنوعی با همزمانی قابل تنظیم، از مسیر کامل
+Application (هندلرها، دیتابیس، صف API) در برابر تلگرام جعلی و سرور chat-completions جعلی
+Load test of message_handler and callback_handler against fake Telegram and a stub API
+
+اجرا: python benchmarks/bench_handlers.py --users 100 --concurrency 32 --api-latency 0.5
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List
+
+from common import BENCH_DIR, prepare_environment, summarize, write_report, print_table
+from stub_api import StubSettings, free_port, launch
+
+# callbackهای منوی کاربر، به ترتیب تکرار در سناریوی menu
+MENU_CALLBACKS = ['my_stats', 'my_chats', 'select_model', 'back_main', 'new_chat']
+# callbackهای پنل ادمین در سناریوی admin
+ADMIN_CALLBACKS = ['admin_users', 'back_main']
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Handler load benchmark')
+    parser.add_argument('--scenarios', default='chat,menu,admin',
+                        help='comma separated: chat, menu, admin')
+    parser.add_argument('--users', type=int, default=50, help='distinct synthetic users')
+    parser.add_argument('--messages', type=int, default=4, help='chat messages per user')
+    parser.add_argument('--callbacks', type=int, default=10, help='menu callbacks per user')
+    parser.add_argument('--concurrency', type=int, default=32, help='updates processed at once')
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=True,
+                        help='stream replies (STREAM_RESPONSES)')
+    parser.add_argument('--edit-interval', type=float, default=0.2, help='STREAM_EDIT_INTERVAL')
+    parser.add_argument('--api-latency', type=float, default=0.2, help='stub time to first byte')
+    parser.add_argument('--api-jitter', type=float, default=0.0)
+    parser.add_argument('--chunks', type=int, default=10, help='stub stream chunks per reply')
+    parser.add_argument('--chunk-interval', type=float, default=0.02)
+    parser.add_argument('--reply-chars', type=int, default=400)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='stub 500 ratio')
+    parser.add_argument('--telegram-latency', type=float, default=0.0,
+                        help='simulated Bot API round trip (seconds)')
+    parser.add_argument('--telegram-chat-limit', type=float, default=0,
+                        help='fake Telegram answers 429 above this many messages/s per chat (0 = off)')
+    parser.add_argument('--database', default=None, help='database file (default: fresh temp file)')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results', 'handlers.json'))
+    parser.add_argument('--verbose', action='store_true', help='keep the bot INFO logs')
+    return parser.parse_args(argv)
+
+
+async def run_updates(application, updates: List, concurrency: int, failures: List) -> Dict:
+    """پردازش Updateها با حداکثر concurrency همزمان و اندازه‌گیری زمان هر کدام"""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    samples = []
+    errors_before = len(failures)
+    
+    async def process(update):
+        async with semaphore:
+            started = time.perf_counter()
+            await application.process_update(update)
+            samples.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(process(update) for update in updates))
+    return summarize(samples, time.perf_counter() - started, len(failures) - errors_before)
+
+
+async def main(args: argparse.Namespace):
+    port = free_port()
+    stub = launch(port, StubSettings(
+        args.api_latency, args.api_jitter, args.chunks, args.chunk_interval,
+        args.reply_chars, args.error_rate,
+    ))
+    admin_id = 1
+    database_path = prepare_environment(
+        args.database,
+        API_BASE_URL=f'http://127.0.0.1:{port}',
+        CHAT01_API_KEY='benchmark',
+        BOT_TOKEN='123456:BENCHMARK',
+        ADMIN_ID=admin_id,
+        STREAM_RESPONSES='1' if args.stream else '0',
+        STREAM_EDIT_INTERVAL=args.edit_interval,
+        # سرور جعلی HTTP/1.1 بدون TLS است
+        API_HTTP2=0,
+        METRICS_PORT=0,
+        MAINTENANCE_INTERVAL=0,
+    )
+    
+    # ماژول‌های ربات پس از تنظیم محیط import می‌شوند
+    import bot
+    from database import async_db
+    from fake_telegram import FakeTelegramRequest, UpdateFactory
+    
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    request = FakeTelegramRequest(args.telegram_latency, args.telegram_chat_limit)
+    application = bot.build_application(request)
+    failures = []
+    
+    async def on_error(update, context):
+        failures.append(repr(context.error))
+    
+    application.add_error_handler(on_error)
+    await application.initialize()
+    await bot.post_init(application)
+    
+    factory = UpdateFactory(application.bot)
+    users = list(range(1001, 1001 + args.users))
+    results = {}
+    try:
+        # کاربران پیش از اندازه‌گیری ساخته می‌شوند؛ محدودیت روزانه برداشته می‌شود
+        for user_id in users:
+            await application.process_update(factory.message(user_id, '/start'))
+            await async_db.set_user_limit(user_id, -1)
+        
+        scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+        for name in scenarios:
+            if name == 'chat':
+                updates = [
+                    factory.message(user_id, f'benchmark question {turn} from {user_id}')
+                    for turn in range(args.messages) for user_id in users
+                ]
+            elif name == 'menu':
+                updates = [
+                    factory.callback(user_id, MENU_CALLBACKS[turn % len(MENU_CALLBACKS)])
+                    for turn in range(args.callbacks) for user_id in users
+                ]
+            elif name == 'admin':
+                updates = [
+                    factory.callback(admin_id, ADMIN_CALLBACKS[turn % len(ADMIN_CALLBACKS)])
+                    for turn in range(args.callbacks * 2)
+                ]
+            else:
+                raise SystemExit(f'unknown scenario: {name}')
+            results[name] = await run_updates(application, updates, args.concurrency, failures)
+        await async_db.flush_writes()
+    finally:
+        # همان ترتیب run_polling: ذخیره‌ی persistence پیش از بستن دیتابیس
+        await application.shutdown()
+        await bot.post_shutdown(application)
+        stub.terminate()
+        stub.wait()
+    
+    parameters = {key: value for key, value in vars(args).items() if key not in ('output', 'verbose')}
+    parameters['database'] = database_path
+    extra = {
+        'telegram_calls': dict(request.calls),
+        'outbound': bot.outbound_limiter.stats(),
+        'first_errors': failures[:5],
+    }
+    print_table(results)
+    write_report(args.output, 'handlers', parameters, results, extra)
+    print(f'report written to {args.output}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+ابزارهای مشترک بنچمارک‌ها: آماده‌سازی محیط جدا، اندازه‌گیری و گزارش JSON
+Shared helpers for the benchmark scripts
+"""
+
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def prepare_environment(database_path: Optional[str] = None, **settings) -> str:
+    """
+    تنظیم متغیرهای محیطی پیش از import ماژول‌های ربات
+    دیتابیس در یک پوشه‌ی موقت ساخته می‌شود تا دیتابیس اصلی دست نخورد؛ مسیر دیتابیس برگردانده می‌شود.
+    """
+    if database_path is None:
+        database_path = os.path.join(tempfile.mkdtemp(prefix='bot-bench-'), 'bench.db')
+    os.environ['DATABASE_PATH'] = database_path
+    for name, value in settings.items():
+        os.environ[name] = str(value)
+    if BOT_DIR not in sys.path:
+        sys.path.insert(0, BOT_DIR)
+    return database_path
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """صدک q (بین 0 و 1) از لیست مرتب‌شده با درون‌یابی خطی"""
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    if lower == upper:
+        return ordered[lower]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(samples: List[float], elapsed: Optional[float] = None, errors: int = 0) -> Dict:
+    """خلاصه‌ی یک سری زمان (ثانیه): تعداد، توان عملیاتی و صدک‌ها به میلی‌ثانیه"""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    if elapsed is None:
+        elapsed = total
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(ordered) / elapsed, 2) if elapsed > 0 else 0.0,
+        'mean_ms': round(total / len(ordered) * 1000, 4) if ordered else 0.0,
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 4),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 4),
+        'max_ms': round(ordered[-1] * 1000, 4) if ordered else 0.0,
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BOT_DIR,
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def write_report(path: str, benchmark: str, parameters: Dict, results: Dict,
+                 extra: Optional[Dict] = None) -> Dict:
+    """نوشتن گزارش JSON (همراه با پارامترها و مشخصات اجرا برای مقایسه‌ی اجراها)"""
+    report = {
+        'benchmark': benchmark,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+        **(extra or {}),
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def print_table(results: Dict[str, Dict]):
+    """نمایش خلاصه‌ی نتایج در خروجی"""
+    print(f"{'name':<34} {'count':>7} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, row in results.items():
+        print(
+            f"{name:<34} {row['count']:>7} {row['throughput']:>10.1f} "
+            f"{row['p50_ms']:>9.3f} {row['p95_ms']:>9.3f} {row['p99_ms']:>9.3f}"
+        )
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+تلگرام جعلی برای بنچمارک‌ها: لایه‌ی درخواست Bot API بدون شبکه و سازنده‌ی Updateهای مصنوعی
+Fake Telegram transport and synthetic Update factory
+"""
+
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict, deque
+from typing import Optional, Tuple
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {'id': 1000000, 'is_bot': True, 'first_name': 'BenchBot', 'username': 'bench_bot'}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    پاسخ به متدهای Bot API با نتیجه‌ی ساختگی و تأخیر قابل تنظیم
+    مسیر سریال‌سازی درخواست و ساخت اشیای پاسخ python-telegram-bot مثل محیط واقعی طی می‌شود.
+    chat_limit: بیش از این تعداد پیام در ثانیه در یک گفتگو با 429 (RetryAfter) رد می‌شود (0 = خاموش)
+    """
+    
+    def __init__(self, latency: float = 0.0, chat_limit: float = 0.0):
+        self.latency = latency
+        self.chat_limit = chat_limit
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._recent = defaultdict(deque)  # chat_id -> زمان پیام‌های ثانیه‌ی اخیر
+    
+    def _flooded(self, chat_id) -> bool:
+        if not self.chat_limit or chat_id is None:
+            return False
+        now = time.monotonic()
+        recent = self._recent[chat_id]
+        while recent and recent[0] <= now - 1:
+            recent.popleft()
+        if len(recent) >= self.chat_limit:
+            return True
+        recent.append(now)
+        return False
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def _message(self, parameters: dict) -> dict:
+        return {
+            'message_id': int(parameters.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(parameters.get('chat_id', 0)), 'type': 'private'},
+            'from': BOT_USER,
+            'text': parameters.get('text', ''),
+        }
+    
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         *args, **kwargs) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = request_data.parameters if request_data is not None else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        if endpoint in ('sendMessage', 'editMessageText') and self._flooded(parameters.get('chat_id')):
+            self.calls['429'] += 1
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }).encode('utf-8')
+        
+        if endpoint == 'getMe':
+            result = {**BOT_USER, 'can_join_groups': False, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = self._message(parameters)
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+class UpdateFactory:
+    """ساخت Updateهای مصنوعی پیام متنی، دستور و callback برای کاربران مختلف"""
+    
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+    
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'}
+    
+    def _message(self, user_id: int, text: str) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return message
+    
+    def message(self, user_id: int, text: str) -> Update:
+        """پیام متنی (یا دستور، اگر با / شروع شود)"""
+        return Update.de_json({
+            'update_id': next(self._update_ids),
+            'message': self._message(user_id, text),
+        }, self.bot)
+    
+    def callback(self, user_id: int, data: str) -> Update:
+        """فشردن دکمه‌ی اینلاین روی یک پیام ربات"""
+        update_id = next(self._update_ids)
+        message = {**self._message(user_id, 'menu'), 'from': BOT_USER}
+        return Update.de_json({
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'message': message,
+                'data': data,
+            },
+        }, self.bot)
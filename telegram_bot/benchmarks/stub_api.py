@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+سرور جعلی chat-completions (سازگار با chat01.ai) برای بنچمارک‌ها
+Local stub of the chat-completions API with configurable latency and streaming
+
+اجرا: python benchmarks/stub_api.py --port 8900 --latency 0.5 --chunks 20
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Optional
+
+
+class StubSettings:
+    """رفتار سرور جعلی"""
+    
+    def __init__(self, latency: float = 0.2, jitter: float = 0.0, chunks: int = 10,
+                 chunk_interval: float = 0.02, reply_chars: int = 400, error_rate: float = 0.0):
+        self.latency = latency  # زمان تا ارسال هدرها / اولین تکه
+        self.jitter = jitter  # تغییر تصادفی latency (±)
+        self.chunks = max(1, chunks)
+        self.chunk_interval = chunk_interval
+        self.reply_chars = reply_chars
+        self.error_rate = error_rate  # سهم پاسخ‌های 500
+    
+    def delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+
+def _reply_text(settings: StubSettings, prompt: str) -> str:
+    seed = f'echo: {prompt} '
+    return (seed * (settings.reply_chars // max(1, len(seed)) + 1))[:settings.reply_chars]
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[tuple]:
+    """خواندن یک درخواست HTTP/1.1؛ None در پایان اتصال"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return request_line.decode('latin-1').split(), headers, body
+
+
+def _response(status: str, body: bytes, content_type: str = 'application/json') -> bytes:
+    return (
+        f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+    )
+
+
+async def _stream(writer: asyncio.StreamWriter, settings: StubSettings, model: str, text: str):
+    """ارسال پاسخ به صورت SSE با chunked transfer encoding"""
+    writer.write(
+        b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+        b'Transfer-Encoding: chunked\r\n\r\n'
+    )
+    size = len(text) // settings.chunks + 1
+    for i in range(0, len(text), size):
+        if i:
+            await asyncio.sleep(settings.chunk_interval)
+        event = {'model': model, 'choices': [{'index': 0, 'delta': {'content': text[i:i + size]}}]}
+        data = f'data: {json.dumps(event, ensure_ascii=False)}\n\n'.encode('utf-8')
+        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        await writer.drain()
+    done = b'data: [DONE]\n\n'
+    writer.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(done), done))
+
+
+def make_handler(settings: StubSettings):
+    """هندلر اتصال‌ها (keep-alive، چند درخواست در هر اتصال)"""
+    
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                parts, headers, body = request
+                if len(parts) < 2 or parts[0] != 'POST' or not parts[1].endswith('/chat/completions'):
+                    writer.write(_response('404 Not Found', b'{"error":"not found"}'))
+                    await writer.drain()
+                    continue
+                
+                payload = json.loads(body or b'{}')
+                model = payload.get('model', 'stub')
+                await asyncio.sleep(settings.delay())
+                if settings.error_rate and random.random() < settings.error_rate:
+                    writer.write(_response('500 Internal Server Error', b'{"error":"stub failure"}'))
+                    await writer.drain()
+                    continue
+                
+                messages = payload.get('messages') or [{}]
+                text = _reply_text(settings, str(messages[-1].get('content', ''))[:40])
+                if payload.get('stream'):
+                    await _stream(writer, settings, model, text)
+                else:
+                    data = {
+                        'model': model,
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}}],
+                    }
+                    writer.write(_response('200 OK', json.dumps(data, ensure_ascii=False).encode('utf-8')))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    return handle
+
+
+async def serve(host: str, port: int, settings: StubSettings):
+    server = await asyncio.start_server(make_handler(settings), host, port)
+    print(f'stub api listening on http://{host}:{port}', flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def free_port() -> int:
+    """یک پورت آزاد محلی"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def launch(port: int, settings: StubSettings, timeout: float = 10) -> subprocess.Popen:
+    """
+    اجرای سرور جعلی در یک پروسه‌ی جدا (تا CPU حلقه‌ی رویداد ربات را با آن تقسیم نکند)
+    و انتظار تا آماده شدن پورت
+    """
+    process = subprocess.Popen([
+        sys.executable, __file__, '--port', str(port),
+        '--latency', str(settings.latency), '--jitter', str(settings.jitter),
+        '--chunks', str(settings.chunks), '--chunk-interval', str(settings.chunk_interval),
+        '--reply-chars', str(settings.reply_chars), '--error-rate', str(settings.error_rate),
+    ], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('stub api did not start')
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Stub chat-completions API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds before the first byte')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +/- added to latency')
+    parser.add_argument('--chunks', type=int, default=10, help='stream chunks per reply')
+    parser.add_argument('--chunk-interval', type=float, default=0.02, help='seconds between chunks')
+    parser.add_argument('--reply-chars', type=int, default=400, help='reply length')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 500 responses')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, StubSettings(
+            args.latency, args.jitter, args.chunks, args.chunk_interval,
+            args.reply_chars, args.error_rate,
+        )))
+    except KeyboardInterrupt:
+        pass
@@ -7,10 +7,11 @@ Telegram Bot with chat01.ai API
 
 import asyncio
 import logging
-import httpx
-from typing import Optional
+import time
+from typing import Optional, Dict, List, Tuple, Callable, Awaitable
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, Message, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -19,16 +20,44 @@ from telegram.ext import (
     filters,
     ContextTypes,
 )
+from telegram.request import BaseRequest
 
 from config import (
     BOT_TOKEN,
-    CHAT01_API_KEY,
     ADMIN_ID,
-    API_ENDPOINT,
-    DEFAULT_MODEL,
     MESSAGES,
+    STREAM_RESPONSES,
+    STREAM_EDIT_INTERVAL,
+    TELEGRAM_MAX_MESSAGE_LENGTH,
+    TELEGRAM_MAX_RETRIES,
+    COALESCE_MESSAGES,
+    CONCURRENT_UPDATES,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_CERT,
+    WEBHOOK_KEY,
+    DEFAULT_MODEL,
+    AVAILABLE_MODELS,
+)
+from database import async_db
+from persistence import DatabasePersistence
+from context_builder import build_context
+from response_cache import response_cache
+from compaction import history_compactor
+from maintenance import db_maintenance, format_size
+from metrics import timed_handler, perf_summary, start_metrics_server, stop_metrics_server
+from outbound import outbound_limiter, PROGRESS_SUFFIX
+from broadcast import broadcaster, format_report, CANCEL_CALLBACK
+from ai_client import (
+    chat_with_ai,
+    stream_chat_with_ai,
+    init_http_client,
+    close_http_client,
 )
-from database import db
 
 # تنظیمات لاگ
 logging.basicConfig(
@@ -37,6 +66,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# فقط آپدیت‌هایی که هندلرها پردازش می‌کنند از تلگرام دریافت می‌شوند
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 
 # ==================== کیبوردها ====================
 
@@ -46,6 +78,7 @@ def get_main_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("✨ گفتگوی جدید", callback_data="new_chat")],
         [InlineKeyboardButton("📝 گفتگوهای من", callback_data="my_chats")],
         [InlineKeyboardButton("🗑 پاک کردن تاریخچه", callback_data="clear_history")],
+        [InlineKeyboardButton("🤖 انتخاب مدل", callback_data="select_model")],
         [InlineKeyboardButton("📊 آمار من", callback_data="my_stats")],
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -55,15 +88,39 @@ def get_admin_keyboard() -> InlineKeyboardMarkup:
     """کیبورد ادمین"""
     keyboard = [
         [InlineKeyboardButton("👥 لیست کاربران", callback_data="admin_users")],
+        [InlineKeyboardButton("🔍 جستجوی کاربر", callback_data="admin_search")],
+        [InlineKeyboardButton("📢 ارسال همگانی", callback_data="admin_broadcast")],
         [InlineKeyboardButton("🔙 بازگشت", callback_data="back_main")],
     ]
     return InlineKeyboardMarkup(keyboard)
 
 
-def get_chats_keyboard(chats: list) -> InlineKeyboardMarkup:
+def get_page_buttons(prefix: str, items: list, key: str,
+                     has_prev: bool, has_next: bool) -> List[InlineKeyboardButton]:
+    """
+    دکمه‌های صفحه‌ی قبل و بعد؛ callback_data فشرده به شکل prefix:p|n:شناسه
+    شناسه‌ی اولین یا آخرین ردیف صفحه مرجع صفحه‌بندی keyset است.
+    """
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"{prefix}:p:{items[0][key]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"{prefix}:n:{items[-1][key]}"))
+    return buttons
+
+
+def parse_page_data(data: str) -> Tuple[Optional[str], Optional[str]]:
+    """استخراج (after, before) از callback_data صفحه‌بندی؛ صفحه‌ی اول: (None, None)"""
+    parts = data.split(":", 2)
+    if len(parts) < 3:
+        return None, None
+    return (parts[2], None) if parts[1] == "n" else (None, parts[2])
+
+
+def get_chats_keyboard(chats: list, has_prev: bool = False, has_next: bool = False) -> InlineKeyboardMarkup:
     """کیبورد لیست گفتگوها"""
     keyboard = []
-    for chat in chats[:10]:  # حداکثر 10 گفتگو
+    for chat in chats:
         status = "✅" if chat['is_active'] else "⚪"
         keyboard.append([
             InlineKeyboardButton(
@@ -71,6 +128,44 @@ def get_chats_keyboard(chats: list) -> InlineKeyboardMarkup:
                 callback_data=f"switch_chat:{chat['chat_id']}"
             )
         ])
+    page_buttons = get_page_buttons("mc", chats, 'chat_id', has_prev, has_next)
+    if page_buttons:
+        keyboard.append(page_buttons)
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_main")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_users_view(users: list, title: str, has_prev: bool = False,
+                   has_next: bool = False) -> Tuple[str, InlineKeyboardMarkup]:
+    """متن و کیبورد لیست کاربران (پنل ادمین و نتایج جستجو)"""
+    text = f"{title}\n\n"
+    keyboard = []
+    for u in users:
+        status = "🔴" if u['is_blocked'] else "🟢"
+        limit = "♾" if u['daily_limit'] == -1 else str(u['daily_limit'])
+        name = u['first_name'] or u['username'] or str(u['user_id'])
+        text += f"{status} {name} (ID: {u['user_id']}) - محدودیت: {limit}\n"
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{status} {name[:20]}",
+                callback_data=f"user_actions:{u['user_id']}"
+            )
+        ])
+    page_buttons = get_page_buttons("au", users, 'user_id', has_prev, has_next)
+    if page_buttons:
+        keyboard.append(page_buttons)
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_main")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def get_models_keyboard(current: str) -> InlineKeyboardMarkup:
+    """کیبورد انتخاب مدل گفتگو"""
+    keyboard = []
+    for model in AVAILABLE_MODELS:
+        status = "✅" if model == current else "⚪"
+        keyboard.append([
+            InlineKeyboardButton(f"{status} {model}", callback_data=f"set_model:{model}")
+        ])
     keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_main")])
     return InlineKeyboardMarkup(keyboard)
 
@@ -93,49 +188,211 @@ def get_user_actions_keyboard(user_id: int, is_blocked: bool) -> InlineKeyboardM
     return InlineKeyboardMarkup(keyboard)
 
 
-# ==================== توابع API ====================
+# ==================== نمایش پاسخ ====================
+
+def split_point(text: str, start: int, limit: int) -> int:
+    """یافتن محل مناسب برای شکستن متن طولانی (ترجیحاً سر خط یا فاصله)"""
+    end = start + limit
+    if end >= len(text):
+        return len(text)
+    for sep in ('\n', ' '):
+        pos = text.rfind(sep, start, end)
+        if pos > start + limit // 2:
+            return pos + 1
+    return end
+
+
+class StreamingReply:
+    """
+    نمایش تدریجی پاسخ با ویرایش پیام «در حال پردازش»
+    ویرایش‌ها با فاصله‌ی حداقل STREAM_EDIT_INTERVAL انجام می‌شوند و متن بیش از
+    سقف طول پیام تلگرام در پیام‌های بعدی ادامه پیدا می‌کند. ویرایش‌های میانی در پس‌زمینه
+    ارسال می‌شوند تا انتظار در صف ارسال تلگرام دریافت پاسخ را کند نکند.
+    """
+    
+    CURSOR = PROGRESS_SUFFIX
+    
+    def __init__(self, message: Message, interval: float = STREAM_EDIT_INTERVAL,
+                 limit: int = TELEGRAM_MAX_MESSAGE_LENGTH):
+        self.messages = [message]
+        self.interval = interval
+        self.limit = limit
+        self.text = ''
+        self._offset = 0  # شروع متن پیام فعلی در self.text
+        self._shown = None
+        self._next_edit = 0.0
+        self._progress = set()  # ویرایش‌های میانی در جریان
+    
+    async def _edit(self, text: str, message: Optional[Message] = None):
+        message = message or self.messages[-1]
+        if not text.strip() or (message is self.messages[-1] and text == self._shown):
+            return
+        try:
+            await message.edit_text(text)
+            if message is self.messages[-1]:
+                self._shown = text
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+    
+    async def _edit_progress(self, text: str, message: Message):
+        try:
+            await self._edit(text, message)
+        except RetryAfter as e:
+            # در ویرایش‌های میانی فقط ویرایش بعدی را عقب می‌اندازیم
+            self._next_edit = time.monotonic() + e.retry_after
+        except Exception as e:
+            logger.warning(f"Progress edit failed: {e}")
+    
+    async def _edit_final(self, text: str):
+        """
+        ویرایش نهایی یا بستن پیام در rollover؛ از دست رفتن آن بخشی از پاسخ را حذف می‌کند،
+        پس پس از RetryAfter صبر و دوباره تلاش می‌شود و در نهایت خطا به فراخواننده برمی‌گردد.
+        """
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            try:
+                await self._edit(text)
+                return
+            except RetryAfter as e:
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(float(e.retry_after))
+    
+    async def _settle(self):
+        """لغو ویرایش‌های میانی باقی‌مانده پیش از ویرایش نهایی (ویرایش نهایی جای آن‌ها را می‌گیرد)"""
+        tasks = list(self._progress)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def _rollover(self):
+        """بستن پیام فعلی و ادامه‌ی متن در پیام جدید"""
+        await self._settle()
+        cut = split_point(self.text, self._offset, self.limit)
+        await self._edit_final(self.text[self._offset:cut])
+        self._offset = cut
+        chunk = self.text[cut:cut + self.limit - len(self.CURSOR)]
+        message = await self.messages[-1].reply_text(chunk + self.CURSOR)
+        self.messages.append(message)
+        self._shown = chunk + self.CURSOR
+        self._next_edit = time.monotonic() + self.interval
+    
+    async def append(self, delta: str):
+        """افزودن تکه‌ی جدید و ویرایش پیام در صورت رسیدن نوبت"""
+        self.text += delta
+        while len(self.text) - self._offset > self.limit - len(self.CURSOR):
+            await self._rollover()
+        
+        now = time.monotonic()
+        if now >= self._next_edit:
+            self._next_edit = now + self.interval
+            task = asyncio.get_running_loop().create_task(
+                self._edit_progress(self.text[self._offset:] + self.CURSOR, self.messages[-1])
+            )
+            self._progress.add(task)
+            task.add_done_callback(self._progress.discard)
+    
+    async def finish(self):
+        """نمایش متن نهایی بدون نشانگر"""
+        await self._settle()
+        while len(self.text) - self._offset > self.limit:
+            await self._rollover()
+        await self._edit_final(self.text[self._offset:])
+
 
-async def chat_with_ai(messages: list) -> Optional[str]:
-    """ارسال درخواست به API و دریافت پاسخ"""
-    headers = {
-        "Authorization": f"Bearer {CHAT01_API_KEY}",
-        "Content-Type": "application/json",
-    }
+async def generate_reply(processing_msg: Message, chat_history: list,
+                         user_id: Optional[int] = None,
+                         model: Optional[str] = None) -> Optional[str]:
+    """دریافت پاسخ از API و نمایش آن به جای پیام در حال پردازش؛ در صورت خطا None"""
+    reply = StreamingReply(processing_msg)
     
-    payload = {
-        "model": DEFAULT_MODEL,
-        "messages": messages,
-    }
+    if STREAM_RESPONSES:
+        try:
+            async for delta in stream_chat_with_ai(chat_history, user_id, model):
+                await reply.append(delta)
+        except Exception as e:
+            logger.error(f"API stream error: {e}")
+            if reply.text:
+                # بخشی از پاسخ نمایش داده شده؛ آن را نگه می‌داریم و خطا را جداگانه اعلام می‌کنیم
+                await reply.finish()
+                await reply.messages[-1].reply_text(MESSAGES['error'])
+                return None
+    else:
+        response = await chat_with_ai(chat_history, user_id, model)
+        if response:
+            await reply.append(response)
     
-    try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(API_ENDPOINT, json=payload, headers=headers)
-            response.raise_for_status()
-            data = response.json()
-            return data['choices'][0]['message']['content']
-    except httpx.TimeoutException:
-        logger.error("API request timed out")
+    if not reply.text:
+        await processing_msg.edit_text(MESSAGES['error'])
         return None
-    except Exception as e:
-        logger.error(f"API error: {e}")
+    
+    try:
+        await reply.finish()
+    except RetryAfter as e:
+        # پاسخ کامل نمایش داده نشد؛ نوبت ناموفق حساب می‌شود تا ذخیره و از سهمیه کم نشود
+        logger.error(f"Final reply edit failed: {e}")
         return None
+    return reply.text
+
+
+# ==================== صف نوبت کاربران ====================
+
+class UserTurnQueue:
+    """
+    اجرای ترتیبی نوبت‌های هر کاربر
+    پیام‌هایی که در حین پردازش نوبت قبلی می‌رسند در صف می‌مانند و (در صورت فعال بودن
+    ادغام) همگی در یک درخواست به API ارسال می‌شوند. کاربران مختلف به صورت موازی اجرا می‌شوند.
+    """
+    
+    def __init__(self, coalesce: bool = COALESCE_MESSAGES):
+        self.coalesce = coalesce
+        self._pending: Dict[int, List[Tuple[Message, str]]] = {}
+        self._running = set()
+    
+    async def submit(self, user_id: int, message: Message, text: str,
+                     run_turn: Callable[[List[Tuple[Message, str]]], Awaitable[None]]):
+        """
+        افزودن پیام به صف کاربر؛ اگر نوبتی در جریان باشد همان نوبت پیام را برمی‌دارد
+        و این فراخوانی بلافاصله برمی‌گردد.
+        """
+        self._pending.setdefault(user_id, []).append((message, text))
+        if user_id in self._running:
+            return
+        
+        self._running.add(user_id)
+        try:
+            while self._pending.get(user_id):
+                batch = self._pending.pop(user_id)
+                if not self.coalesce and len(batch) > 1:
+                    self._pending[user_id] = batch[1:]
+                    batch = batch[:1]
+                try:
+                    await run_turn(batch)
+                except Exception as e:
+                    logger.exception(f"Turn failed for user {user_id}: {e}")
+        finally:
+            self._running.discard(user_id)
+
+
+user_turns = UserTurnQueue()
 
 
 # ==================== هندلرهای دستورات ====================
 
+@timed_handler
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """دستور /start"""
     user = update.effective_user
-    db.get_or_create_user(user.id, user.username, user.first_name)
+    await async_db.ensure_user(user.id, user.username, user.first_name)
     
     # بررسی بلاک
-    if db.is_user_blocked(user.id):
+    if await async_db.is_user_blocked(user.id):
         await update.message.reply_text(MESSAGES['blocked'])
         return
     
     # ایجاد گفتگوی جدید اگر وجود ندارد
-    if not db.get_active_chat(user.id):
-        db.create_chat(user.id)
+    if not await async_db.get_active_chat_id(user.id):
+        await async_db.create_chat(user.id)
     
     await update.message.reply_text(
         MESSAGES['welcome'],
@@ -143,6 +400,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@timed_handler
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """دستور /admin برای پنل مدیریت"""
     user = update.effective_user
@@ -157,6 +415,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@timed_handler
 async def block_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """دستور /block [user_id]"""
     user = update.effective_user
@@ -171,7 +430,7 @@ async def block_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         target_id = int(context.args[0])
-        if db.block_user(target_id):
+        if await async_db.block_user(target_id):
             await update.message.reply_text(MESSAGES['user_blocked'].format(user_id=target_id))
         else:
             await update.message.reply_text(MESSAGES['user_not_found'])
@@ -179,6 +438,7 @@ async def block_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("آیدی نامعتبر است.")
 
 
+@timed_handler
 async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """دستور /unblock [user_id]"""
     user = update.effective_user
@@ -193,7 +453,7 @@ async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         target_id = int(context.args[0])
-        if db.unblock_user(target_id):
+        if await async_db.unblock_user(target_id):
             await update.message.reply_text(MESSAGES['user_unblocked'].format(user_id=target_id))
         else:
             await update.message.reply_text(MESSAGES['user_not_found'])
@@ -201,6 +461,7 @@ async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("آیدی نامعتبر است.")
 
 
+@timed_handler
 async def setlimit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """دستور /setlimit [user_id] [limit]"""
     user = update.effective_user
@@ -217,7 +478,7 @@ async def setlimit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_id = int(context.args[0])
         limit = int(context.args[1])
         
-        if db.set_user_limit(target_id, limit):
+        if await async_db.set_user_limit(target_id, limit):
             if limit == -1:
                 await update.message.reply_text(MESSAGES['limit_removed'].format(user_id=target_id))
             else:
@@ -228,8 +489,90 @@ async def setlimit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("مقادیر نامعتبر هستند.")
 
 
+@timed_handler
+async def maintenance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """دستور /maintenance [full] برای نگهداری دیتابیس"""
+    user = update.effective_user
+    
+    if user.id != ADMIN_ID:
+        await update.message.reply_text(MESSAGES['admin_only'])
+        return
+    
+    if db_maintenance.running:
+        await update.message.reply_text(MESSAGES['maintenance_busy'])
+        return
+    
+    full = bool(context.args) and context.args[0].lower() == 'full'
+    await update.message.reply_text(MESSAGES['maintenance_started'])
+    try:
+        report = await db_maintenance.run(full=full)
+    except Exception as e:
+        logger.error(f"Database maintenance failed: {e}")
+        await update.message.reply_text(MESSAGES['error'])
+        return
+    
+    await update.message.reply_text(MESSAGES['maintenance_report'].format(
+        chats=report['chats'],
+        messages=report['messages'],
+        usage=report['usage'],
+        size_before=format_size(report['size_before']),
+        size_after=format_size(report['size_after']),
+        reclaimed=format_size(report['reclaimed']),
+        seconds=report['seconds'],
+    ))
+
+
+@timed_handler
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """دستور /perf برای خلاصه‌ی متریک‌های کارایی"""
+    user = update.effective_user
+    
+    if user.id != ADMIN_ID:
+        await update.message.reply_text(MESSAGES['admin_only'])
+        return
+    
+    await update.message.reply_text(perf_summary())
+
+
+@timed_handler
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """دستور /broadcast [متن] برای ارسال پیام به همه‌ی کاربران (بدون متن: وضعیت ارسال فعلی)"""
+    user = update.effective_user
+    
+    if user.id != ADMIN_ID:
+        await update.message.reply_text(MESSAGES['admin_only'])
+        return
+    
+    # متن پس از دستور با حفظ خط‌های جدید (context.args فاصله‌ها را از بین می‌برد)
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) > 1:
+        await start_broadcast(update.message, user.id, parts[1])
+        return
+    
+    active = await broadcaster.active()
+    if active is not None:
+        text, keyboard = format_report(active)
+        await update.message.reply_text(text, reply_markup=keyboard)
+        return
+    
+    context.user_data['broadcasting'] = True
+    await update.message.reply_text(MESSAGES['broadcast_prompt'])
+
+
+async def start_broadcast(message: Message, admin_id: int, text: str):
+    """شروع ارسال همگانی؛ پیام پاسخ همان گزارش زنده‌ی پیشرفت است"""
+    if await broadcaster.active() is not None:
+        await message.reply_text(MESSAGES['broadcast_busy'])
+        return
+    
+    report = await message.reply_text(MESSAGES['broadcast_started'])
+    if await broadcaster.begin(admin_id, text, report.chat_id, report.message_id) is None:
+        await report.edit_text(MESSAGES['broadcast_busy'])
+
+
 # ==================== هندلرهای Callback ====================
 
+@timed_handler
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """هندلر callback های دکمه‌ها"""
     query = update.callback_query
@@ -239,21 +582,22 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     
     # بررسی بلاک
-    if db.is_user_blocked(user.id):
+    if await async_db.is_user_blocked(user.id):
         await query.edit_message_text(MESSAGES['blocked'])
         return
     
     # گفتگوی جدید
     if data == "new_chat":
-        db.create_chat(user.id)
+        await async_db.create_chat(user.id)
         await query.edit_message_text(
             MESSAGES['new_chat'],
             reply_markup=get_main_keyboard()
         )
     
     # لیست گفتگوها
-    elif data == "my_chats":
-        chats = db.get_user_chats(user.id)
+    elif data == "my_chats" or data.startswith("mc:"):
+        after, before = parse_page_data(data)
+        chats, has_prev, has_next = await async_db.get_user_chats_page(user.id, after=after, before=before)
         if not chats:
             await query.edit_message_text(
                 MESSAGES['no_chats'],
@@ -262,14 +606,14 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.edit_message_text(
                 MESSAGES['select_chat'],
-                reply_markup=get_chats_keyboard(chats)
+                reply_markup=get_chats_keyboard(chats, has_prev, has_next)
             )
     
     # پاک کردن تاریخچه
     elif data == "clear_history":
-        active_chat = db.get_active_chat(user.id)
-        if active_chat:
-            db.clear_chat_history(active_chat['chat_id'])
+        active_chat_id = await async_db.get_active_chat_id(user.id)
+        if active_chat_id:
+            await async_db.clear_chat_history(active_chat_id)
         await query.edit_message_text(
             MESSAGES['chat_cleared'],
             reply_markup=get_main_keyboard()
@@ -277,7 +621,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # آمار کاربر
     elif data == "my_stats":
-        stats = db.get_user_stats(user.id)
+        stats = await async_db.get_user_stats(user.id)
         await query.edit_message_text(
             MESSAGES['stats'].format(**stats),
             reply_markup=get_main_keyboard()
@@ -290,14 +634,34 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_main_keyboard()
         )
     
+    # انتخاب مدل گفتگوی فعال
+    elif data == "select_model":
+        model = await async_db.get_active_chat_model(user.id) or DEFAULT_MODEL
+        await query.edit_message_text(
+            MESSAGES['select_model'].format(model=model),
+            reply_markup=get_models_keyboard(model)
+        )
+    
+    elif data.startswith("set_model:"):
+        model = data.split(":", 1)[1]
+        if model not in AVAILABLE_MODELS:
+            return
+        chat_id = await async_db.get_active_chat_id(user.id)
+        if not chat_id:
+            chat_id = await async_db.create_chat(user.id)
+        await async_db.set_chat_model(user.id, chat_id, model)
+        await query.edit_message_text(
+            MESSAGES['model_set'].format(model=model),
+            reply_markup=get_main_keyboard()
+        )
+    
     # تغییر گفتگو
     elif data.startswith("switch_chat:"):
         chat_id = data.split(":")[1]
-        chats = db.get_user_chats(user.id)
-        chat = next((c for c in chats if c['chat_id'] == chat_id), None)
+        chat = await async_db.get_user_chat(user.id, chat_id)
         
         if chat:
-            db.switch_chat(user.id, chat_id)
+            await async_db.switch_chat(user.id, chat_id)
             await query.edit_message_text(
                 MESSAGES['chat_switched'].format(chat_name=chat['chat_name']),
                 reply_markup=get_main_keyboard()
@@ -306,29 +670,51 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # === عملیات ادمین ===
     
     # لیست کاربران
-    elif data == "admin_users":
+    elif data == "admin_users" or data.startswith("au:"):
         if user.id != ADMIN_ID:
             await query.edit_message_text(MESSAGES['admin_only'])
             return
         
-        users = db.get_all_users()
-        text = "👥 لیست کاربران:\n\n"
-        keyboard = []
+        after, before = parse_page_data(data)
+        try:
+            users, has_prev, has_next = await async_db.get_users_page(
+                after=int(after) if after else None,
+                before=int(before) if before else None
+            )
+        except ValueError:
+            return
+        text, keyboard = get_users_view(users, "👥 لیست کاربران:", has_prev, has_next)
+        await query.edit_message_text(text, reply_markup=keyboard)
+    
+    # جستجوی کاربر (نیاز به ورود شناسه یا نام کاربری)
+    elif data == "admin_search":
+        if user.id != ADMIN_ID:
+            return
         
-        for u in users[:20]:  # حداکثر 20 کاربر
-            status = "🔴" if u['is_blocked'] else "🟢"
-            limit = "♾" if u['daily_limit'] == -1 else str(u['daily_limit'])
-            name = u['first_name'] or u['username'] or str(u['user_id'])
-            text += f"{status} {name} (ID: {u['user_id']}) - محدودیت: {limit}\n"
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{status} {name[:20]}",
-                    callback_data=f"user_actions:{u['user_id']}"
-                )
-            ])
+        context.user_data['searching_user'] = True
+        await query.edit_message_text(MESSAGES['search_user'])
+    
+    # ارسال همگانی (نیاز به ورود متن پیام)
+    elif data == "admin_broadcast":
+        if user.id != ADMIN_ID:
+            return
         
-        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_main")])
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        active = await broadcaster.active()
+        if active is not None:
+            text, keyboard = format_report(active)
+            await query.edit_message_text(text, reply_markup=keyboard)
+            return
+        
+        context.user_data['broadcasting'] = True
+        await query.edit_message_text(MESSAGES['broadcast_prompt'])
+    
+    # لغو ارسال همگانی (گزارش لغو روی پیام گزارش نوشته می‌شود)
+    elif data == CANCEL_CALLBACK:
+        if user.id != ADMIN_ID:
+            return
+        
+        if await broadcaster.cancel() is None:
+            await query.edit_message_text(MESSAGES['broadcast_none'])
     
     # عملیات روی کاربر
     elif data.startswith("user_actions:"):
@@ -336,8 +722,8 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         target_id = int(data.split(":")[1])
-        is_blocked = db.is_user_blocked(target_id)
-        limit = db.get_user_limit(target_id)
+        is_blocked = await async_db.is_user_blocked(target_id)
+        limit = await async_db.get_user_limit(target_id)
         
         text = f"👤 کاربر: {target_id}\n"
         text += f"وضعیت: {'🔴 بلاک شده' if is_blocked else '🟢 فعال'}\n"
@@ -354,14 +740,14 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         target_id = int(data.split(":")[1])
-        if db.is_user_blocked(target_id):
-            db.unblock_user(target_id)
+        if await async_db.is_user_blocked(target_id):
+            await async_db.unblock_user(target_id)
         else:
-            db.block_user(target_id)
+            await async_db.block_user(target_id)
         
         # بروزرسانی منو
-        is_blocked = db.is_user_blocked(target_id)
-        limit = db.get_user_limit(target_id)
+        is_blocked = await async_db.is_user_blocked(target_id)
+        limit = await async_db.get_user_limit(target_id)
         
         text = f"👤 کاربر: {target_id}\n"
         text += f"وضعیت: {'🔴 بلاک شده' if is_blocked else '🟢 فعال'}\n"
@@ -378,9 +764,9 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         target_id = int(data.split(":")[1])
-        db.set_user_limit(target_id, -1)
+        await async_db.set_user_limit(target_id, -1)
         
-        is_blocked = db.is_user_blocked(target_id)
+        is_blocked = await async_db.is_user_blocked(target_id)
         text = f"👤 کاربر: {target_id}\n"
         text += f"وضعیت: {'🔴 بلاک شده' if is_blocked else '🟢 فعال'}\n"
         text += f"محدودیت: ♾ نامحدود\n"
@@ -406,13 +792,14 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== هندلر پیام‌ها ====================
 
+@timed_handler
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """هندلر پیام‌های متنی"""
     user = update.effective_user
     message_text = update.message.text
     
     # بررسی بلاک
-    if db.is_user_blocked(user.id):
+    if await async_db.is_user_blocked(user.id):
         await update.message.reply_text(MESSAGES['blocked'])
         return
     
@@ -423,7 +810,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_id = int(context.user_data['setting_limit_for'])
             del context.user_data['setting_limit_for']
             
-            if db.set_user_limit(target_id, limit):
+            if await async_db.set_user_limit(target_id, limit):
                 if limit == -1:
                     await update.message.reply_text(
                         MESSAGES['limit_removed'].format(user_id=target_id),
@@ -441,11 +828,26 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("لطفاً یک عدد معتبر وارد کنید.")
             return
     
-    # اطمینان از وجود کاربر
-    db.get_or_create_user(user.id, user.username, user.first_name)
+    # بررسی اینکه آیا ادمین در حال جستجوی کاربر است
+    if user.id == ADMIN_ID and context.user_data.pop('searching_user', None):
+        users = await async_db.search_users(message_text)
+        if not users:
+            await update.message.reply_text(MESSAGES['user_not_found'], reply_markup=get_admin_keyboard())
+            return
+        text, keyboard = get_users_view(users, "🔍 نتایج جستجو:")
+        await update.message.reply_text(text, reply_markup=keyboard)
+        return
+    
+    # بررسی اینکه آیا ادمین در حال نوشتن پیام همگانی است
+    if user.id == ADMIN_ID and context.user_data.pop('broadcasting', None):
+        await start_broadcast(update.message, user.id, message_text)
+        return
+    
+    # اطمینان از وجود کاربر (کاربران شناخته‌شده از حافظه)
+    await async_db.ensure_user(user.id, user.username, user.first_name)
     
-    # بررسی محدودیت
-    can_send, limit, usage = db.can_send_message(user.id)
+    # بررسی محدودیت و رزرو سهمیه در یک دستور اتمی
+    can_send, limit, usage = await async_db.admit_message(user.id)
     if not can_send:
         await update.message.reply_text(
             MESSAGES['limit_reached'].format(limit=limit),
@@ -453,42 +855,106 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # دریافت یا ایجاد گفتگوی فعال
-    active_chat = db.get_active_chat(user.id)
-    if not active_chat:
-        chat_id = db.create_chat(user.id)
-        active_chat = {'chat_id': chat_id}
-    
-    # ذخیره پیام کاربر
-    db.add_message(active_chat['chat_id'], 'user', message_text)
-    
-    # نمایش پیام در حال پردازش
-    processing_msg = await update.message.reply_text(MESSAGES['processing'])
-    
-    # دریافت تاریخچه و ارسال به API
-    chat_history = db.get_chat_messages(active_chat['chat_id'])
+    # اجرای ترتیبی نوبت‌های کاربر (پیام‌های رسیده در حین پردازش ادغام می‌شوند)
+    await user_turns.submit(
+        user.id, update.message, message_text,
+        lambda batch: process_turn(user.id, batch)
+    )
+
+
+async def process_turn(user_id: int, batch: List[Tuple[Message, str]]):
+    """پردازش یک نوبت: ارسال پیام(های) کاربر به API و ذخیره‌ی نتیجه"""
+    message_text = '\n\n'.join(text for _, text in batch)
+    last_message = batch[-1][0]
     
-    response = await chat_with_ai(chat_history)
+    # دریافت یا ایجاد گفتگوی فعال و مدل آن
+    state = await async_db.get_user_state(user_id)
+    chat_id = state['active_chat_id']
+    if not chat_id:
+        chat_id = await async_db.create_chat(user_id)
+    model = state['active_chat_model'] or DEFAULT_MODEL
     
-    if response:
-        # افزایش شمارنده استفاده
-        db.increment_daily_usage(user.id)
+    response = None
+    reserved = len(batch)
+    try:
+        # پیام‌های ادغام‌شده یک پاسخ می‌گیرند و فقط یک واحد از سهمیه‌ی روزانه مصرف می‌کنند
+        if reserved > 1:
+            await async_db.refund_message(user_id, reserved - 1)
+            reserved = 1
         
-        # ذخیره پاسخ
-        db.add_message(active_chat['chat_id'], 'assistant', response)
+        # نمایش پیام در حال پردازش
+        processing_msg = await last_message.reply_text(MESSAGES['processing'])
         
-        # ویرایش پیام در حال پردازش با پاسخ
-        await processing_msg.edit_text(response)
-    else:
-        await processing_msg.edit_text(MESSAGES['error'])
+        # دریافت تاریخچه (در حد بودجه‌ی توکن) و ارسال به API؛ پاسخ به صورت تدریجی نمایش داده می‌شود
+        user_message = {'role': 'user', 'content': message_text}
+        chat_history = await build_context(chat_id, model, pending=[user_message])
+        
+        # پرسش تکراری در گفتگوی تازه از کش پاسخ داده می‌شود
+        cache_key = response_cache.key_for(model, chat_history)
+        cached = response_cache.get(cache_key) if cache_key else None
+        if cached:
+            reply = StreamingReply(processing_msg)
+            await reply.append(cached)
+            await reply.finish()
+            response = cached
+        else:
+            response = await generate_reply(processing_msg, chat_history, user_id, model)
+            if response and cache_key:
+                response_cache.set(cache_key, response)
+        
+        if response:
+            # ذخیره پیام کاربر و پاسخ در یک تراکنش
+            await async_db.record_turn(chat_id, message_text, response)
+            # خلاصه‌سازی پیام‌های قدیمی گفتگوهای طولانی در پس‌زمینه
+            history_compactor.schedule(chat_id, user_id)
+    finally:
+        if not response:
+            # پیام‌های ناموفق از سهمیه‌ی روزانه کم نمی‌شوند
+            await async_db.refund_message(user_id, reserved)
 
 
 # ==================== اجرای ربات ====================
 
-def main():
-    """تابع اصلی اجرای ربات"""
-    # ایجاد اپلیکیشن
-    application = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application):
+    """آماده‌سازی منابع مشترک پس از راه‌اندازی ربات"""
+    await init_http_client()
+    async_db.start_write_behind()
+    async_db.start_cache_sync()
+    db_maintenance.start()
+    broadcaster.start(application.bot)
+    await start_metrics_server()
+
+
+async def post_stop(application: Application):
+    """توقف ارسال همگانی پیش از بسته شدن اتصال و صف ارسال تلگرام (ادامه در اجرای بعدی)"""
+    await broadcaster.close()
+
+
+async def post_shutdown(application: Application):
+    """آزادسازی منابع هنگام خاموش شدن ربات"""
+    await history_compactor.close()
+    await db_maintenance.close()
+    await stop_metrics_server()
+    await close_http_client()
+    async_db.close()
+
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    """ساخت اپلیکیشن با همه‌ی هندلرها (request: لایه‌ی درخواست Bot API، مثلاً نسخه‌ی جعلی بنچمارک‌ها)"""
+    builder = Application.builder().token(BOT_TOKEN)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = (
+        builder
+        # همه‌ی ارسال‌ها و ویرایش‌ها از صف ارسال با محدودیت نرخ تلگرام عبور می‌کنند
+        .rate_limiter(outbound_limiter)
+        .persistence(DatabasePersistence())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .build()
+    )
     
     # افزودن هندلرها
     application.add_handler(CommandHandler("start", start_command))
@@ -496,13 +962,37 @@ def main():
     application.add_handler(CommandHandler("block", block_command))
     application.add_handler(CommandHandler("unblock", unblock_command))
     application.add_handler(CommandHandler("setlimit", setlimit_command))
+    application.add_handler(CommandHandler("maintenance", maintenance_command))
+    application.add_handler(CommandHandler("perf", perf_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
     
     application.add_handler(CallbackQueryHandler(callback_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    return application
+
+
+def main():
+    """تابع اصلی اجرای ربات"""
+    application = build_application()
     
     # اجرای ربات
-    logger.info("Bot started...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        url_path = WEBHOOK_PATH.strip('/')
+        logger.info(f"Bot started (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{url_path})...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            cert=WEBHOOK_CERT or None,
+            key=WEBHOOK_KEY or None,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        logger.info("Bot started (polling)...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+ارسال همگانی ادمین: پخش دسته‌ای پیام به همه‌ی کاربران با محدودیت نرخ، گزارش زنده و ادامه پس از راه‌اندازی مجدد
+Admin broadcast fan-out with resumable progress
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from config import (
+    BROADCAST_WORKERS,
+    BROADCAST_BATCH,
+    BROADCAST_PROGRESS_INTERVAL,
+    BROADCAST_LEASE,
+    MESSAGES,
+)
+from database import async_db
+from metrics import registry
+from outbound import BULK
+
+logger = logging.getLogger(__name__)
+
+# callback دکمه‌ی لغو در گزارش ادمین
+CANCEL_CALLBACK = 'broadcast_cancel'
+
+# تلاش‌های ارسال به هر کاربر پس از RetryAfter (علاوه بر تلاش‌های صف ارسال)
+SEND_ATTEMPTS = 3
+
+# حداکثر انتظار برای پایان ارسال‌های در جریان هنگام توقف یا لغو (ثانیه)
+STOP_TIMEOUT = 10.0
+
+
+def timestamp(offset: float = 0.0) -> str:
+    """زمان UTC (به اضافه‌ی offset ثانیه) در قالب ستون‌های زمان دیتابیس"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() + offset))
+
+
+def format_report(broadcast: Dict) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """متن گزارش ارسال همگانی و دکمه‌ی لغو (فقط برای ارسال در حال انجام)"""
+    delivered = broadcast['delivered']
+    failed = broadcast['failed']
+    done = delivered + failed
+    if broadcast['status'] == 'done':
+        return MESSAGES['broadcast_done'].format(delivered=delivered, failed=failed, done=done), None
+    if broadcast['status'] == 'cancelled':
+        return MESSAGES['broadcast_cancelled'].format(delivered=delivered, failed=failed), None
+    
+    # کاربرانی که در حین ارسال عضو می‌شوند هم پیام را می‌گیرند، پس done ممکن است از total بیشتر شود
+    total = max(broadcast['total'], done)
+    percent = done * 100 // total if total else 100
+    text = MESSAGES['broadcast_progress'].format(
+        delivered=delivered, failed=failed, done=done, total=total, percent=percent
+    )
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🛑 لغو ارسال", callback_data=CANCEL_CALLBACK)]])
+    return text, keyboard
+
+
+def finished_prefix(outcome: List[Optional[bool]]) -> int:
+    """طول بلندترین پیشوند پیوسته از ارسال‌های تمام‌شده (None = ارسال ناتمام)"""
+    done = 0
+    for sent in outcome:
+        if sent is None:
+            break
+        done += 1
+    return done
+
+
+class Broadcaster:
+    """
+    ارسال پیام ادمین به همه‌ی کاربران غیربلاک
+    گیرندگان به صورت دسته‌ای با پیمایش keyset روی user_id از دیتابیس خوانده می‌شوند و چند
+    ارسال همزمان آن‌ها را با اولویت BULK از صف ارسال می‌فرستند؛ صف ارسال پیام‌های عادی
+    گفتگوها را جلوتر می‌فرستد و نرخ ارسال همگانی را جداگانه محدود می‌کند.
+    پس از هر دسته جایگاه و تعداد ارسال‌ها در جدول broadcasts ذخیره می‌شود، پس ارسال پس از
+    راه‌اندازی مجدد (یا توسط پروسه‌ی دیگر پس از پایان lease) از همان‌جا ادامه می‌یابد.
+    lease در حین ارسال هر یک‌سوم مدت آن تمدید می‌شود و با شکست تمدید ارسال متوقف می‌شود.
+    """
+    
+    def __init__(self, workers: int = BROADCAST_WORKERS, batch: int = BROADCAST_BATCH,
+                 progress_interval: float = BROADCAST_PROGRESS_INTERVAL, lease: float = BROADCAST_LEASE):
+        self.workers = max(1, workers)
+        self.batch = max(1, batch)
+        self.progress_interval = progress_interval
+        self.lease = max(1.0, lease)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._bot: Optional[Bot] = None
+        self._lock = asyncio.Lock()
+        self._watcher: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._current: Optional[Dict] = None
+        self._stopping = False
+        
+        # آمار
+        self.delivered = 0
+        self.failed = 0
+        self.completed = 0
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def start(self, bot: Bot):
+        """شروع پایش ارسال‌های ناتمام (در post_init اپلیکیشن)"""
+        self._bot = bot
+        if self._watcher is None:
+            self._watcher = asyncio.get_running_loop().create_task(self._watch())
+    
+    async def _watch(self):
+        # ارسال رهاشده در خاموشی عادی بلافاصله و ارسال پروسه‌ی متوقف‌شده پس از پایان lease ادامه می‌یابد
+        while True:
+            try:
+                await self._resume()
+            except Exception as e:
+                logger.error(f"Broadcast resume failed: {e}")
+            await asyncio.sleep(self.lease)
+    
+    async def _resume(self):
+        async with self._lock:
+            if self.running:
+                return
+            broadcast = await async_db.get_running_broadcast()
+            if broadcast is None:
+                return
+            claimed = await async_db.claim_broadcast(
+                broadcast['broadcast_id'], self.owner, timestamp(), timestamp(-self.lease)
+            )
+            if claimed:
+                logger.info(f"Resuming broadcast {broadcast['broadcast_id']} after user {broadcast['cursor_user_id']}")
+                self._launch(broadcast)
+    
+    def _launch(self, broadcast: Dict):
+        self._current = broadcast
+        self._task = asyncio.get_running_loop().create_task(self._run(broadcast))
+    
+    async def active(self) -> Optional[Dict]:
+        """ارسال همگانی در حال انجام (در این پروسه یا پروسه‌ی دیگر)"""
+        if self.running:
+            return await async_db.get_broadcast(self._current['broadcast_id'])
+        return await async_db.get_running_broadcast()
+    
+    async def begin(self, admin_id: int, text: str, report_chat_id: int,
+                    report_message_id: int) -> Optional[Dict]:
+        """شروع ارسال همگانی جدید؛ None اگر ارسال دیگری در حال انجام باشد"""
+        async with self._lock:
+            if self.running or await async_db.get_running_broadcast() is not None:
+                return None
+            broadcast = await async_db.create_broadcast(
+                admin_id, text, report_chat_id, report_message_id, self.owner, timestamp()
+            )
+            if broadcast is None:
+                # پروسه‌ی دیگری همزمان ارسالی را شروع کرده است
+                return None
+            logger.info(f"Broadcast {broadcast['broadcast_id']} started for {broadcast['total']} users")
+            self._launch(broadcast)
+            return broadcast
+    
+    async def cancel(self) -> Optional[Dict]:
+        """لغو ارسال همگانی در حال انجام؛ None اگر ارسالی در جریان نباشد"""
+        async with self._lock:
+            broadcast = await self.active()
+            if broadcast is None:
+                return None
+            if self.running and self._current['broadcast_id'] == broadcast['broadcast_id']:
+                await self._stop()
+                self._current = None
+            await async_db.finish_broadcast(broadcast['broadcast_id'], 'cancelled', timestamp())
+        logger.info(f"Broadcast {broadcast['broadcast_id']} cancelled")
+        return await self._report(broadcast['broadcast_id'])
+    
+    async def _stop(self):
+        """توقف ارسال پس از پایان ارسال‌های در جریان؛ پیشرفت تا همان‌جا ذخیره می‌شود"""
+        if not self.running:
+            return
+        self._stopping = True
+        try:
+            done, _ = await asyncio.wait({self._task}, timeout=STOP_TIMEOUT)
+            if not done:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+        finally:
+            self._stopping = False
+    
+    # ==================== ارسال ====================
+    
+    async def _run(self, broadcast: Dict):
+        broadcast_id = broadcast['broadcast_id']
+        text = broadcast['text']
+        after = broadcast['cursor_user_id']
+        semaphore = asyncio.Semaphore(self.workers)
+        reported = time.monotonic()
+        lost = asyncio.Event()
+        heartbeat = asyncio.get_running_loop().create_task(self._heartbeat(broadcast_id, lost))
+        
+        try:
+            while not self._stopping:
+                recipients = await async_db.get_broadcast_recipients(after, self.batch)
+                if not recipients:
+                    break
+                
+                outcome: List[Optional[bool]] = [None] * len(recipients)
+                unreachable: List[int] = []
+                try:
+                    await asyncio.gather(*(
+                        self._deliver(semaphore, text, recipients, outcome, unreachable, index, lost)
+                        for index in range(len(recipients))
+                    ))
+                except asyncio.CancelledError:
+                    await self._save_partial(broadcast_id, recipients, outcome, unreachable)
+                    raise
+                
+                if self._stopping:
+                    await self._save_partial(broadcast_id, recipients, outcome, unreachable)
+                    return
+                
+                if lost.is_set():
+                    await self._save_partial(broadcast_id, recipients, outcome, unreachable)
+                    logger.warning(f"Broadcast {broadcast_id} stopped: lease renewal failed")
+                    self._current = None
+                    return
+                
+                if not await self._save(broadcast_id, recipients[-1], outcome, unreachable):
+                    # ارسال لغو شده یا در اختیار پروسه‌ی دیگری است
+                    logger.info(f"Broadcast {broadcast_id} stopped (cancelled or claimed elsewhere)")
+                    self._current = None
+                    return
+                after = recipients[-1]
+                
+                if time.monotonic() - reported >= self.progress_interval:
+                    reported = time.monotonic()
+                    await self._report(broadcast_id)
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+        
+        if self._stopping:
+            return
+        await async_db.finish_broadcast(broadcast_id, 'done', timestamp())
+        self._current = None
+        self.completed += 1
+        report = await self._report(broadcast_id)
+        if report is not None:
+            logger.info(f"Broadcast {broadcast_id} finished: {report['delivered']} delivered, {report['failed']} failed")
+    
+    async def _heartbeat(self, broadcast_id: str, lost: asyncio.Event):
+        """تمدید lease هر یک‌سوم مدت آن، مستقل از طول دسته‌ها؛ با شکست تمدید lost تنظیم می‌شود"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await async_db.renew_broadcast(broadcast_id, self.owner, timestamp())
+            except Exception as e:
+                logger.error(f"Broadcast lease renewal failed: {e}")
+                renewed = False
+            if not renewed:
+                lost.set()
+                return
+    
+    async def _deliver(self, semaphore: asyncio.Semaphore, text: str, recipients: List[int],
+                       outcome: List[Optional[bool]], unreachable: List[int], index: int,
+                       lost: asyncio.Event):
+        async with semaphore:
+            if not self._stopping and not lost.is_set():
+                outcome[index] = await self._send(recipients[index], text, unreachable)
+    
+    async def _send(self, user_id: int, text: str, unreachable: List[int]) -> bool:
+        """ارسال به یک کاربر؛ False برای کاربری که پیام به او نرسید (Forbidden: افزوده به unreachable)"""
+        for _ in range(SEND_ATTEMPTS):
+            try:
+                await self._bot.send_message(user_id, text, rate_limit_args={'priority': BULK})
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after))
+            except Forbidden:
+                # کاربر ربات را بلاک کرده یا حسابش حذف شده است؛ تا پیام بعدی‌اش دیگر ارسالی نمی‌گیرد
+                unreachable.append(user_id)
+                return False
+            except TelegramError as e:
+                logger.debug(f"Broadcast to {user_id} failed: {e}")
+                return False
+        return False
+    
+    async def _save(self, broadcast_id: str, cursor_user_id: int, outcome: List[Optional[bool]],
+                    unreachable: List[int]) -> bool:
+        delivered = sum(1 for sent in outcome if sent)
+        failed = len(outcome) - delivered
+        self.delivered += delivered
+        self.failed += failed
+        return await async_db.save_broadcast_progress(
+            broadcast_id, self.owner, cursor_user_id, delivered, failed, timestamp(), unreachable
+        )
+    
+    async def _save_partial(self, broadcast_id: str, recipients: List[int], outcome: List[Optional[bool]],
+                            unreachable: List[int]):
+        """
+        ذخیره‌ی بخش ارسال‌شده‌ی دسته‌ای که نیمه‌کاره متوقف شد تا پس از ادامه دوباره ارسال نشود
+        ارسال‌ها همزمان‌اند، پس پس از یک ارسال ناتمام ممکن است ارسال‌های تمام‌شده‌ای هم باشند؛ cursor فقط تا
+        انتهای پیشوند پیوسته‌ی تمام‌شده جلو می‌رود و فقط همان پیشوند شمرده می‌شود (بقیه پس از ادامه دوباره ارسال می‌شوند).
+        """
+        done = finished_prefix(outcome)
+        if done:
+            await self._save(broadcast_id, recipients[done - 1], outcome[:done], unreachable)
+    
+    async def _report(self, broadcast_id: str) -> Optional[Dict]:
+        """به‌روزرسانی پیام گزارش ادمین با آخرین وضعیت ذخیره‌شده"""
+        broadcast = await async_db.get_broadcast(broadcast_id)
+        if broadcast is None or not broadcast['report_message_id']:
+            return broadcast
+        text, keyboard = format_report(broadcast)
+        try:
+            await self._bot.edit_message_text(
+                text,
+                chat_id=broadcast['report_chat_id'],
+                message_id=broadcast['report_message_id'],
+                reply_markup=keyboard,
+            )
+        except BadRequest:
+            # گزارش تغییری نکرده یا پیام آن حذف شده است
+            pass
+        except TelegramError as e:
+            logger.warning(f"Broadcast report update failed: {e}")
+        return broadcast
+    
+    def stats(self) -> Dict:
+        """آمار ارسال همگانی: وضعیت و تعداد ارسال‌های موفق و ناموفق این پروسه"""
+        return {
+            'running': self.running,
+            'delivered': self.delivered,
+            'failed': self.failed,
+            'completed': self.completed,
+        }
+    
+    async def close(self):
+        """توقف ارسال و رها کردن آن برای ادامه در اجرای بعدی (پیش از بسته شدن صف ارسال)"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        await self._stop()
+        self._watcher = None
+        self._task = None
+        if self._current is not None:
+            await async_db.release_broadcast(self._current['broadcast_id'], self.owner)
+            self._current = None
+
+
+# نمونه singleton
+broadcaster = Broadcaster()
+registry.register_stats('broadcast', broadcaster.stats)
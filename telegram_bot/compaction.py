@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+خلاصه‌سازی پیام‌های قدیمی گفتگوهای طولانی
+Background history compaction into a stored per-chat summary
+"""
+
+import asyncio
+import logging
+from typing import Optional, List, Dict
+
+from config import (
+    COMPACT_HISTORY,
+    COMPACT_THRESHOLD_TOKENS,
+    COMPACT_KEEP_TOKENS,
+    COMPACT_BATCH_TOKENS,
+    COMPACT_MODEL,
+)
+from database import async_db
+from ai_client import chat_with_ai
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the previous summary (if any) with the new messages into one concise summary. "
+    "Keep facts, names, numbers, decisions, open questions and the user's preferences; "
+    "drop greetings and small talk. Write the summary in the language of the conversation "
+    "and reply with the summary only."
+)
+
+# حداکثر تعداد دسته‌ها در هر اجرا (گفتگوهای خیلی طولانی در نوبت‌های بعدی ادامه می‌یابند)
+MAX_ROUNDS = 4
+
+
+def format_transcript(summary: Optional[str], messages: List[Dict]) -> str:
+    """متن ارسالی برای خلاصه‌سازی"""
+    parts = []
+    if summary:
+        parts.append(f"Previous summary:\n{summary}")
+    lines = [f"{m['role'].capitalize()}: {m['content']}" for m in messages]
+    parts.append("New messages:\n" + '\n\n'.join(lines))
+    return '\n\n'.join(parts)
+
+
+class HistoryCompactor:
+    """
+    وقتی توکن‌های بایگانی‌نشده‌ی یک گفتگو از آستانه بیشتر شود، قدیمی‌ترین پیام‌ها
+    در پس‌زمینه خلاصه و بایگانی می‌شوند؛ برای هر گفتگو فقط یک خلاصه‌سازی همزمان اجرا می‌شود.
+    """
+    
+    def __init__(self, enabled: bool = COMPACT_HISTORY, threshold: int = COMPACT_THRESHOLD_TOKENS,
+                 keep_tokens: int = COMPACT_KEEP_TOKENS, batch_tokens: int = COMPACT_BATCH_TOKENS,
+                 model: str = COMPACT_MODEL):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.keep_tokens = keep_tokens
+        self.batch_tokens = batch_tokens
+        self.model = model
+        self._running = set()
+        self._tasks = set()
+        
+        # آمار
+        self.compactions = 0
+        self.archived_messages = 0
+    
+    def schedule(self, chat_id: str, user_id: Optional[int] = None):
+        """بررسی و خلاصه‌سازی گفتگو در پس‌زمینه (پس از ذخیره‌ی هر نوبت)"""
+        if not self.enabled or chat_id in self._running:
+            return
+        self._running.add(chat_id)
+        task = asyncio.get_running_loop().create_task(self._run(chat_id, user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, chat_id: str, user_id: Optional[int]):
+        try:
+            await self.compact(chat_id, user_id)
+        except Exception as e:
+            logger.error(f"History compaction failed for {chat_id}: {e}")
+        finally:
+            self._running.discard(chat_id)
+    
+    async def compact(self, chat_id: str, user_id: Optional[int] = None) -> int:
+        """خلاصه‌سازی تا رسیدن به زیر آستانه؛ تعداد پیام‌های بایگانی‌شده"""
+        archived = 0
+        for _ in range(MAX_ROUNDS):
+            if await async_db.get_history_tokens(chat_id) <= self.threshold:
+                break
+            # پیام‌های بافر شده باید پیش از انتخاب دسته در دیتابیس باشند
+            await async_db.flush_writes()
+            summary, batch = await async_db.get_compaction_batch(
+                chat_id, self.keep_tokens, self.batch_tokens
+            )
+            if not batch:
+                break
+            
+            new_summary = await chat_with_ai([
+                {'role': 'system', 'content': SUMMARY_PROMPT},
+                {'role': 'user', 'content': format_transcript(summary, batch)},
+            ], user_id, self.model)
+            if not new_summary:
+                break
+            
+            saved = await async_db.set_chat_summary(
+                chat_id, new_summary.strip(), batch[-1]['message_id'], len(batch)
+            )
+            if not saved:
+                break
+            archived += len(batch)
+        
+        if archived:
+            self.compactions += 1
+            self.archived_messages += archived
+            logger.info(f"Compacted {archived} messages of chat {chat_id}")
+        return archived
+    
+    def stats(self) -> Dict:
+        """آمار خلاصه‌سازی: گفتگوهای در حال خلاصه‌سازی و مجموع پیام‌های بایگانی‌شده"""
+        return {
+            'running': len(self._running),
+            'compactions': self.compactions,
+            'archived_messages': self.archived_messages,
+        }
+    
+    async def close(self):
+        """لغو خلاصه‌سازی‌های در حال اجرا (هنگام خاموش شدن)"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# نمونه singleton
+history_compactor = HistoryCompactor()
+registry.register_stats('compactor', history_compactor.stats)
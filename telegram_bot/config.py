@@ -4,6 +4,7 @@
 Configuration for Telegram Bot
 """
 
+import json
 import os
 
 # توکن ربات تلگرام
@@ -16,17 +17,170 @@ CHAT01_API_KEY = os.environ.get('CHAT01_API_KEY', 'YOUR_API_KEY')
 ADMIN_ID = int(os.environ.get('ADMIN_ID', '0'))
 
 # تنظیمات API
-API_BASE_URL = "https://chat01.ai"
+API_BASE_URL = os.environ.get('API_BASE_URL', 'https://chat01.ai').rstrip('/')
 API_ENDPOINT = f"{API_BASE_URL}/v1/chat/completions"
 
+# تنظیمات اتصال HTTP به API (زمان‌ها به ثانیه)
+API_CONNECT_TIMEOUT = float(os.environ.get('API_CONNECT_TIMEOUT', '10'))
+API_READ_TIMEOUT = float(os.environ.get('API_READ_TIMEOUT', '120'))
+API_WRITE_TIMEOUT = float(os.environ.get('API_WRITE_TIMEOUT', '30'))
+API_POOL_TIMEOUT = float(os.environ.get('API_POOL_TIMEOUT', '10'))
+API_MAX_CONNECTIONS = int(os.environ.get('API_MAX_CONNECTIONS', '100'))
+API_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('API_MAX_KEEPALIVE_CONNECTIONS', '20'))
+API_KEEPALIVE_EXPIRY = float(os.environ.get('API_KEEPALIVE_EXPIRY', '60'))
+API_HTTP2 = os.environ.get('API_HTTP2', '1') == '1'
+
+# صف درخواست‌های API: حداکثر درخواست همزمان و نرخ در دقیقه (0 = نامحدود)
+API_MAX_CONCURRENCY = int(os.environ.get('API_MAX_CONCURRENCY', '16'))
+API_RATE_LIMIT_RPM = float(os.environ.get('API_RATE_LIMIT_RPM', '0'))
+API_RATE_BURST = float(os.environ.get('API_RATE_BURST', '0'))  # 0 = یک‌ششم نرخ دقیقه‌ای
+
+# تلاش مجدد فقط برای خطاهایی که درخواست به API نرسیده (اتصال) و کدهای 429/502/503/504
+API_MAX_RETRIES = int(os.environ.get('API_MAX_RETRIES', '2'))
+API_RETRY_BASE_DELAY = float(os.environ.get('API_RETRY_BASE_DELAY', '0.5'))  # ثانیه
+API_RETRY_MAX_DELAY = float(os.environ.get('API_RETRY_MAX_DELAY', '10'))  # سقف backoff (ثانیه)
+# مهلت کل یک درخواست با همه‌ی تلاش‌ها و انتظارها (stream: تا رسیدن اولین تکه)؛
+# Retry-After طولانی‌تر از باقی‌مانده‌ی مهلت به جای کوتاه شدن، خطا برمی‌گرداند
+API_REQUEST_DEADLINE = float(os.environ.get('API_REQUEST_DEADLINE', '150'))  # ثانیه
+
+# قطع‌کننده‌ی مدار: پس از چند خطای پیاپی، درخواست‌ها تا زمان بازیابی فوراً رد می‌شوند
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RECOVERY_TIME = float(os.environ.get('CIRCUIT_RECOVERY_TIME', '30'))  # ثانیه
+
+# نمایش تدریجی پاسخ (stream)
+STREAM_RESPONSES = os.environ.get('STREAM_RESPONSES', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.0'))  # حداقل فاصله‌ی ویرایش‌ها (ثانیه)
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+# صف ارسال به تلگرام: سقف کل ربات و هر گفتگو (پیام در ثانیه؛ 0 = نامحدود)
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))  # پیام‌های پیاپی مجاز در یک گفتگو
+TELEGRAM_GROUP_RATE = float(os.environ.get('TELEGRAM_GROUP_RATE', '20'))  # پیام در دقیقه برای گروه‌ها
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '2'))  # تلاش مجدد پس از RetryAfter
+
+# ارسال همگانی ادمین (/broadcast): پیام‌ها با اولویت پایین و سقف نرخ جداگانه از صف ارسال عبور می‌کنند
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '20'))  # پیام در ثانیه (باید کمتر از TELEGRAM_GLOBAL_RATE باشد)
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', '8'))  # ارسال‌های همزمان
+BROADCAST_BATCH = int(os.environ.get('BROADCAST_BATCH', '200'))  # گیرنده در هر دسته (پیشرفت پس از هر دسته ذخیره می‌شود)
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', '5'))  # به‌روزرسانی گزارش ادمین (ثانیه)
+BROADCAST_LEASE = float(os.environ.get('BROADCAST_LEASE', '60'))  # ثانیه؛ پس از آن ارسال رهاشده‌ی پروسه‌ی دیگر ادامه داده می‌شود
+
+# حالت webhook: با تنظیم WEBHOOK_URL (آدرس عمومی HTTPS) به جای polling اجرا می‌شود
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # فقط حروف، اعداد، _ و -
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))  # 1 تا 100
+WEBHOOK_CERT = os.environ.get('WEBHOOK_CERT', '')  # خالی = TLS در reverse proxy
+WEBHOOK_KEY = os.environ.get('WEBHOOK_KEY', '')
+# آدرس webhook پروسه‌های ربات برای gateway.py (جداشده با کاما)
+WORKER_URLS = [u.strip() for u in os.environ.get('WORKER_URLS', '').split(',') if u.strip()]
+
+# همزمانی: تعداد آپدیت‌هایی که همزمان پردازش می‌شوند (نوبت‌های هر کاربر همیشه ترتیبی‌اند)
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', '64'))
+# ادغام پیام‌هایی که در حین پردازش پیام قبلی کاربر می‌رسند در یک درخواست
+COALESCE_MESSAGES = os.environ.get('COALESCE_MESSAGES', '1') == '1'
+
 # مدل پیش‌فرض
 DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'gpt-4o')
 
+# پیام سیستمی که ابتدای هر گفتگو ارسال می‌شود (خالی = بدون پیام سیستمی)
+SYSTEM_PROMPT = os.environ.get('SYSTEM_PROMPT', '')
+
+# بودجه‌ی توکن تاریخچه‌ی ارسالی به API
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '16000'))
+CONTEXT_MAX_MESSAGES = int(os.environ.get('CONTEXT_MAX_MESSAGES', '200'))
+MODEL_CONTEXT_BUDGETS = {
+    'gpt-4o': 16000,
+    'gpt-5-2': 32000,
+    'gpt-5-2-thinking': 32000,
+    'gpt-5-2-instant': 16000,
+    'gpt-5-1-thinking': 32000,
+    'gpt-5-1-instant': 16000,
+    'o3': 32000,
+}
+
+# خلاصه‌سازی خودکار پیام‌های قدیمی گفتگوهای طولانی
+COMPACT_HISTORY = os.environ.get('COMPACT_HISTORY', '1') == '1'
+COMPACT_THRESHOLD_TOKENS = int(os.environ.get('COMPACT_THRESHOLD_TOKENS', '12000'))  # شروع خلاصه‌سازی
+COMPACT_KEEP_TOKENS = int(os.environ.get('COMPACT_KEEP_TOKENS', '4000'))  # پیام‌های اخیر بدون خلاصه
+COMPACT_BATCH_TOKENS = int(os.environ.get('COMPACT_BATCH_TOKENS', '12000'))  # حداکثر متن هر خلاصه‌سازی
+COMPACT_MODEL = os.environ.get('COMPACT_MODEL', 'gpt-5-1-instant')
+
+# مدل‌هایی که کاربر می‌تواند برای هر گفتگو انتخاب کند
+AVAILABLE_MODELS = list(MODEL_CONTEXT_BUDGETS)
+
+# مسیریابی چندمدلی: فهرست backendها به صورت JSON
+# هر مورد: {"model": "...", "endpoint": "...", "weight": 1, "api_key": "...", "max_concurrency": 0}
+# خالی = فقط مدل پیش‌فرض روی API_ENDPOINT
+API_BACKENDS = json.loads(os.environ.get('API_BACKENDS', '[]'))
+# مدل‌های جایگزین وقتی backendهای مدل اصلی کند یا از دسترس خارج باشند (جداشده با کاما)
+FALLBACK_MODELS = [m.strip() for m in os.environ.get('FALLBACK_MODELS', 'gpt-5-1-instant').split(',') if m.strip()]
+ROUTER_SLOW_THRESHOLD = float(os.environ.get('ROUTER_SLOW_THRESHOLD', '30'))  # پاسخ کامل (ثانیه)
+ROUTER_SLOW_TTFT = float(os.environ.get('ROUTER_SLOW_TTFT', '10'))  # رسیدن اولین تکه‌ی stream (ثانیه)
+ROUTER_PROBE_INTERVAL = float(os.environ.get('ROUTER_PROBE_INTERVAL', '60'))  # درخواست آزمایشی به backend کند (ثانیه)
+ROUTER_DECAY_TIME = float(os.environ.get('ROUTER_DECAY_TIME', '300'))  # کاهش وزن نمونه‌های قدیمی (ثانیه)
+ROUTER_EWMA_ALPHA = float(os.environ.get('ROUTER_EWMA_ALPHA', '0.2'))
+
+# کش پاسخ پرسش‌های تکراری در گفتگوهای تازه (پیش‌فرض غیرفعال)
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', '0') == '1'
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1000'))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '3600'))  # ثانیه
+
 # محدودیت پیش‌فرض پیام روزانه
 DEFAULT_DAILY_LIMIT = 20
 
+# تعداد ردیف‌های هر صفحه در لیست کاربران ادمین و لیست گفتگوها
+USERS_PAGE_SIZE = 20
+CHATS_PAGE_SIZE = 10
+
 # تنظیمات دیتابیس
-DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'bot_database.db')
+DATABASE_PATH = os.environ.get('DATABASE_PATH') or os.path.join(os.path.dirname(__file__), 'bot_database.db')
+
+# بافر نوشتن پیام‌ها: درج‌ها به صورت دسته‌ای در یک تراکنش نوشته می‌شوند
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '1') == '1'
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '0.5'))  # ثانیه
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', '200'))  # flush فوری با رسیدن به این تعداد
+
+# نوع ذخیره‌سازی: sqlite (فایل محلی) یا postgres (مشترک بین چند پروسه، نیازمند psycopg)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+DATABASE_URL = os.environ.get('DATABASE_URL', '')  # برای postgres
+# فاصله‌ی ذخیره‌ی user_data ربات در دیتابیس (ثانیه)
+PERSISTENCE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', '10'))
+PERSISTENCE_CACHE_SIZE = int(os.environ.get('PERSISTENCE_CACHE_SIZE', '10000'))  # کاربرانی که آخرین داده‌ی ذخیره‌شده‌شان در حافظه می‌ماند
+
+# استخر اتصال دیتابیس
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', '10'))  # ثانیه
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', '16384'))  # حافظه کش صفحات هر اتصال
+DB_CACHED_STATEMENTS = int(os.environ.get('DB_CACHED_STATEMENTS', '256'))  # کش دستورات آماده
+DB_READ_WORKERS = int(os.environ.get('DB_READ_WORKERS', '3'))  # تردهای خواندن (نوشتن همیشه در یک ترد)
+
+# نگهداری دیتابیس: بایگانی و حذف داده‌های قدیمی، ANALYZE و آزادسازی فضا
+MAINTENANCE_INTERVAL = float(os.environ.get('MAINTENANCE_INTERVAL', '24'))  # ساعت (0 = فقط با دستور /maintenance)
+# نگهداری داده‌ها بر حسب روز (0 = نگهداری دائمی)
+RETENTION_CHAT_DAYS = int(os.environ.get('RETENTION_CHAT_DAYS', '0'))  # گفتگوهای غیرفعال: بایگانی و حذف
+RETENTION_SUMMARIZED_DAYS = int(os.environ.get('RETENTION_SUMMARIZED_DAYS', '0'))  # پیام‌های خلاصه‌شده: بایگانی و حذف
+RETENTION_USAGE_DAYS = int(os.environ.get('RETENTION_USAGE_DAYS', '0'))  # آمار روزانه: حذف
+# فایل‌های بایگانی JSONL فشرده (zstd با پکیج zstandard، در غیر این صورت gzip)
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(__file__), 'archive'))
+ARCHIVE_COMPRESSION = os.environ.get('ARCHIVE_COMPRESSION', 'zstd')
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', '200'))  # گفتگو یا پیام در هر فایل
+VACUUM_PAGES = int(os.environ.get('VACUUM_PAGES', '0'))  # صفحات آزادشده در هر اجرا (0 = همه)
+
+# endpoint متریک‌ها با قالب Prometheus روی http://METRICS_LISTEN:METRICS_PORT/metrics (0 = غیرفعال)
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+
+# کش وضعیت کاربران در حافظه (0 = غیرفعال)
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '300'))  # ثانیه
+# با backend مشترک (postgres) نسخه‌ی وضعیت کاربران هر چند ثانیه بررسی و در صورت تغییر توسط پروسه‌ی دیگر کش پاک می‌شود
+USER_CACHE_SYNC_INTERVAL = float(os.environ.get('USER_CACHE_SYNC_INTERVAL', '2'))  # ثانیه (0 = غیرفعال)
+# کاربران ثبت‌شده در حافظه: پیام کاربران شناخته‌شده بدون دسترسی به دیتابیس پذیرفته می‌شود
+KNOWN_USERS_SIZE = int(os.environ.get('KNOWN_USERS_SIZE', '100000'))
 
 # پیام‌های ربات
 MESSAGES = {
@@ -45,6 +199,19 @@ MESSAGES = {
     'limit_removed': '✅ محدودیت کاربر {user_id} برداشته شد (نامحدود).',
     'select_chat': '📝 یک گفتگو انتخاب کنید:',
     'no_chats': '📭 هیچ گفتگویی وجود ندارد.',
+    'search_user': '🔍 شناسه‌ی عددی یا نام کاربری (@username) کاربر را وارد کنید:',
     'chat_switched': '✅ به گفتگوی {chat_name} تغییر یافت.',
+    'select_model': '🤖 مدل این گفتگو را انتخاب کنید (فعلی: {model}):',
+    'model_set': '✅ مدل گفتگو به {model} تغییر یافت.',
+    'maintenance_started': '🧹 نگهداری دیتابیس شروع شد...',
+    'maintenance_busy': '⏳ نگهداری دیتابیس در حال اجراست.',
+    'maintenance_report': '🧹 نگهداری دیتابیس انجام شد.\n\n📦 گفتگوهای بایگانی‌شده: {chats}\n🗂 پیام‌های خلاصه‌شده‌ی بایگانی‌شده: {messages}\n📊 ردیف‌های آمار حذف‌شده: {usage}\n💾 حجم دیتابیس: {size_before} ← {size_after}\n♻️ فضای آزادشده: {reclaimed}\n⏱ مدت: {seconds:.1f} ثانیه',
+    'broadcast_prompt': '📢 متن پیام همگانی را بفرستید (برای همه‌ی کاربران به جز کاربران بلاک‌شده ارسال می‌شود):',
+    'broadcast_busy': '⏳ یک ارسال همگانی در حال انجام است.',
+    'broadcast_started': '📢 ارسال همگانی شروع شد...',
+    'broadcast_progress': '📢 ارسال همگانی در حال انجام...\n\n✅ ارسال‌شده: {delivered}\n❌ ناموفق: {failed}\n📊 پیشرفت: {done} از {total} ({percent}%)',
+    'broadcast_done': '📢 ارسال همگانی به پایان رسید.\n\n✅ ارسال‌شده: {delivered}\n❌ ناموفق: {failed}\n👥 کل گیرندگان: {done}',
+    'broadcast_cancelled': '🛑 ارسال همگانی لغو شد.\n\n✅ ارسال‌شده: {delivered}\n❌ ناموفق: {failed}',
+    'broadcast_none': '📭 ارسال همگانی در حال انجامی وجود ندارد.',
     'stats': '📊 آمار شما:\n\n📨 پیام‌های امروز: {today}\n📝 محدودیت روزانه: {limit}\n💬 تعداد گفتگوها: {chats}',
 }
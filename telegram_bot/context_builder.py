@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+ساخت تاریخچه‌ی ارسالی به API با بودجه‌ی توکن
+Token-budgeted context window builder
+"""
+
+from typing import List, Dict, Optional
+
+from config import (
+    DEFAULT_MODEL,
+    SYSTEM_PROMPT,
+    CONTEXT_TOKEN_BUDGET,
+    MODEL_CONTEXT_BUDGETS,
+)
+from database import async_db, estimate_tokens
+
+# پیشوند خلاصه‌ی پیام‌های قدیمی گفتگو
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation:\n"
+
+
+def get_token_budget(model: str = DEFAULT_MODEL) -> int:
+    """بودجه‌ی توکن تاریخچه برای هر مدل"""
+    return MODEL_CONTEXT_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET)
+
+
+async def build_context(chat_id: str, model: str = DEFAULT_MODEL,
+                        pending: Optional[List[Dict]] = None) -> List[Dict]:
+    """
+    پیام سیستمی و خلاصه‌ی گفتگو به همراه جدیدترین پیام‌هایی که در بودجه جا می‌شوند
+    فقط انتهای مورد نیاز تاریخچه از دیتابیس خوانده می‌شود.
+    pending: پیام‌هایی که هنوز ذخیره نشده‌اند (مثل پیام فعلی کاربر) و همیشه در انتها می‌آیند.
+    """
+    budget = get_token_budget(model)
+    pending = pending or []
+    messages = []
+    
+    if SYSTEM_PROMPT:
+        messages.append({'role': 'system', 'content': SYSTEM_PROMPT})
+        budget -= estimate_tokens(SYSTEM_PROMPT)
+    
+    budget -= sum(estimate_tokens(m['content']) for m in pending)
+    
+    summary, history = await async_db.get_context_window(
+        chat_id, max(budget, 0), include_newest=not pending
+    )
+    if summary:
+        messages.append({'role': 'system', 'content': SUMMARY_PREFIX + summary})
+    return messages + history + pending
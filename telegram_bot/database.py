@@ -1,164 +1,1057 @@
 # -*- coding: utf-8 -*-
 """
-مدیریت دیتابیس SQLite
+مدیریت دیتابیس (SQLite یا PostgreSQL)
 Database Management for Telegram Bot
 """
 
 import sqlite3
 import json
+import queue
+import asyncio
+import functools
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Sequence, Tuple
 import uuid
 
-from config import DATABASE_PATH, DEFAULT_DAILY_LIMIT
+from config import (
+    DATABASE_PATH,
+    DEFAULT_DAILY_LIMIT,
+    DB_POOL_SIZE,
+    DB_READ_WORKERS,
+    STORAGE_BACKEND,
+    CONTEXT_MAX_MESSAGES,
+    USERS_PAGE_SIZE,
+    CHATS_PAGE_SIZE,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    USER_CACHE_SYNC_INTERVAL,
+    KNOWN_USERS_SIZE,
+    WRITE_BEHIND,
+    WRITE_BEHIND_INTERVAL,
+    WRITE_BEHIND_BATCH,
+)
+from storage import StorageBackend, SQLiteBackend, create_backend
+from metrics import registry, timed, DB_SECONDS
 
+logger = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self, db_path: str = DATABASE_PATH):
-        self.db_path = db_path
-        self.init_db()
+
+def estimate_tokens(text: str) -> int:
+    """
+    تخمین تقریبی تعداد توکن‌های یک پیام
+    حدود 4 بایت UTF-8 به ازای هر توکن به همراه سربار ثابت هر پیام؛
+    معادل SQL آن در init_db برای پر کردن ستون tokens استفاده می‌شود.
+    """
+    return (len(text.encode('utf-8')) + 3) // 4 + 4
+
+
+# ==================== مهاجرت‌های دیتابیس ====================
+
+def _migration_create_tables(cursor: sqlite3.Cursor):
+    """ایجاد جداول اولیه"""
+    # جدول کاربران
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            is_blocked INTEGER DEFAULT 0,
+            daily_limit INTEGER DEFAULT -1,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # جدول گفتگوها
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            chat_name TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            is_active INTEGER DEFAULT 1,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
     
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+    # جدول پیام‌ها
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id TEXT PRIMARY KEY,
+            chat_id TEXT,
+            role TEXT,
+            content TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+        )
+    ''')
     
-    def init_db(self):
-        """ایجاد جداول دیتابیس"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # جدول کاربران
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                is_blocked INTEGER DEFAULT 0,
-                daily_limit INTEGER DEFAULT -1,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    # جدول آمار روزانه
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            usage_date TEXT,
+            message_count INTEGER DEFAULT 0,
+            UNIQUE(user_id, usage_date),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+
+def _migration_message_tokens(cursor: sqlite3.Cursor):
+    """ستون تخمین توکن پیام‌ها (معادل estimate_tokens)"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)')]
+    if 'tokens' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN tokens INTEGER')
+    cursor.execute(
+        'UPDATE messages SET tokens = (length(CAST(content AS BLOB)) + 3) / 4 + 4 WHERE tokens IS NULL'
+    )
+
+
+def _migration_indexes(cursor: sqlite3.Cursor):
+    """ایندکس‌های ترکیبی برای کوئری‌های پرتکرار"""
+    # get_active_chat و get_user_state
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_active ON chats(user_id, is_active)')
+    # get_user_chats
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_created ON chats(user_id, created_at)')
+    # get_chat_messages (در مهاجرت بعدی با idx_messages_chat جایگزین می‌شود)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages(chat_id, created_at)')
+    # get_all_users
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)')
+
+
+def _migration_integer_message_ids(cursor: sqlite3.Cursor):
+    """
+    کلید عددی ترتیبی برای پیام‌ها به جای UUID متنی
+    ترتیب پیام‌ها از این کلید گرفته می‌شود، نه از created_at با دقت یک ثانیه.
+    """
+    cursor.execute('''
+        CREATE TABLE messages_new (
+            message_id INTEGER PRIMARY KEY,
+            chat_id TEXT,
+            role TEXT,
+            content TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            tokens INTEGER,
+            FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO messages_new (chat_id, role, content, created_at, tokens)
+        SELECT chat_id, role, content, created_at, tokens FROM messages
+        ORDER BY created_at, rowid
+    ''')
+    cursor.execute('DROP TABLE messages')
+    cursor.execute('ALTER TABLE messages_new RENAME TO messages')
+    # ایندکس روی chat_id به صورت ضمنی شامل rowid (همان message_id) است
+    # پس پیمایش پیام‌های یک گفتگو به ترتیب message_id بدون مرتب‌سازی انجام می‌شود
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id)')
+
+
+def _migration_chat_model(cursor: sqlite3.Cursor):
+    """ستون مدل انتخابی هر گفتگو (NULL = مدل پیش‌فرض)"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(chats)')]
+    if 'model' not in columns:
+        cursor.execute('ALTER TABLE chats ADD COLUMN model TEXT')
+
+
+def _migration_user_data(cursor: sqlite3.Cursor):
+    """جدول user_data ربات (وضعیت‌های موقت مثل تنظیم محدودیت) برای persistence"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+
+
+def _migration_chat_summaries(cursor: sqlite3.Cursor):
+    """خلاصه‌ی پیام‌های قدیمی هر گفتگو و علامت بایگانی پیام‌های خلاصه‌شده"""
+    chat_columns = [row[1] for row in cursor.execute('PRAGMA table_info(chats)')]
+    if 'summary' not in chat_columns:
+        cursor.execute('ALTER TABLE chats ADD COLUMN summary TEXT')
+    message_columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)')]
+    if 'archived' not in message_columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN archived INTEGER DEFAULT 0')
+
+
+def _migration_archived_index(cursor: sqlite3.Cursor):
+    """ایندکس جزئی پیام‌های خلاصه‌شده برای بایگانی آن‌ها در نگهداری دوره‌ای"""
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_messages_archived ON messages(created_at) WHERE archived = 1'
+    )
+
+
+def _migration_pagination_indexes(cursor: sqlite3.Cursor):
+    """ایندکس‌های صفحه‌بندی keyset گفتگوها و جستجوی کاربران با نام کاربری"""
+    # get_user_chats_page: ترتیب (created_at, chat_id) مستقیماً از ایندکس خوانده می‌شود
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_page ON chats(user_id, created_at, chat_id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_chats_user_created')
+    # search_users
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(LOWER(username))')
+
+
+def _migration_broadcasts(cursor: sqlite3.Cursor):
+    """
+    جدول ارسال‌های همگانی ادمین و پیشرفت آن‌ها
+    cursor_user_id آخرین کاربری است که دسته‌ی او کامل ارسال شده؛ ارسال پس از راه‌اندازی مجدد از همان‌جا ادامه می‌یابد.
+    owner و heartbeat پروسه‌ی در حال ارسال را مشخص می‌کنند تا دو پروسه یک ارسال را همزمان ادامه ندهند.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id TEXT PRIMARY KEY,
+            admin_id INTEGER,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            cursor_user_id INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            report_chat_id INTEGER,
+            report_message_id INTEGER,
+            owner TEXT,
+            heartbeat TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, created_at)')
+
+
+def _migration_user_state_version(cursor: sqlite3.Cursor):
+    """
+    شماره‌ی نسخه‌ی وضعیت کاربران (یک ردیف)
+    بلاک، آن‌بلاک و تغییر محدودیت آن را افزایش می‌دهند تا پروسه‌های دیگر کش وضعیت خود را پاک کنند.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_state_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT INTO user_state_version (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING')
+
+
+def _migration_inactive_chats_index(cursor: sqlite3.Cursor):
+    """ایندکس جزئی گفتگوهای غیرفعال برای get_expired_chats در نگهداری دوره‌ای (بدون پیمایش کل جدول)"""
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_chats_inactive ON chats(created_at) WHERE is_active = 0'
+    )
+
+
+def _migration_single_running_broadcast(cursor: sqlite3.Cursor):
+    """
+    ایندکس یکتای جزئی: حداکثر یک ارسال همگانی با وضعیت running، حتی با شروع همزمان در چند پروسه
+    ارسال‌های ناتمام اضافه (جز قدیمی‌ترین) پیش از ساخت ایندکس لغو می‌شوند.
+    """
+    cursor.execute('''
+        UPDATE broadcasts SET status = 'cancelled', finished_at = ?, owner = NULL
+        WHERE status = 'running' AND broadcast_id NOT IN (
+            SELECT broadcast_id FROM broadcasts WHERE status = 'running' ORDER BY created_at LIMIT 1
+        )
+    ''', (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),))
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts(status) WHERE status = 'running'"
+    )
+
+
+def _migration_bot_blocked(cursor: sqlite3.Cursor):
+    """
+    ستون bot_blocked کاربرانی که ربات را بلاک کرده‌اند یا حسابشان حذف شده (Forbidden در ارسال همگانی)
+    این کاربران تا پیام بعدی خود از ارسال‌های همگانی حذف می‌شوند.
+    """
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(users)')]
+    if 'bot_blocked' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN bot_blocked INTEGER DEFAULT 0')
+
+
+def _pg_migration_create_tables(cursor):
+    """ساختار کامل جداول روی PostgreSQL (معادل مهاجرت‌های 1 تا 6 در SQLite)"""
+    now = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            is_blocked INTEGER DEFAULT 0,
+            daily_limit INTEGER DEFAULT -1,
+            created_at TEXT DEFAULT {now}
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id TEXT PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            chat_name TEXT,
+            created_at TEXT DEFAULT {now},
+            is_active INTEGER DEFAULT 1,
+            model TEXT
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            chat_id TEXT REFERENCES chats(chat_id),
+            role TEXT,
+            content TEXT,
+            created_at TEXT DEFAULT {now},
+            tokens INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_usage (
+            user_id BIGINT REFERENCES users(user_id),
+            usage_date TEXT,
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, usage_date)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id BIGINT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_active ON chats(user_id, is_active)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_created ON chats(user_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id, message_id)')
+
+
+def _pg_migration_chat_summaries(cursor):
+    """معادل _migration_chat_summaries روی PostgreSQL"""
+    cursor.execute('ALTER TABLE chats ADD COLUMN IF NOT EXISTS summary TEXT')
+    cursor.execute('ALTER TABLE messages ADD COLUMN IF NOT EXISTS archived INTEGER DEFAULT 0')
+
+
+def _pg_migration_archived_index(cursor):
+    """معادل _migration_archived_index روی PostgreSQL"""
+    _migration_archived_index(cursor)
+
+
+def _pg_migration_pagination_indexes(cursor):
+    """معادل _migration_pagination_indexes روی PostgreSQL (به همراه ایندکس صفحه‌بندی کاربران)"""
+    _migration_pagination_indexes(cursor)
+    # در SQLite ایندکس created_at به صورت ضمنی شامل user_id (همان rowid) است
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_page ON users(created_at, user_id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_users_created')
+
+
+def _pg_migration_broadcasts(cursor):
+    """معادل _migration_broadcasts روی PostgreSQL"""
+    now = "to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id TEXT PRIMARY KEY,
+            admin_id BIGINT,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            cursor_user_id BIGINT DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            report_chat_id BIGINT,
+            report_message_id BIGINT,
+            owner TEXT,
+            heartbeat TEXT,
+            created_at TEXT DEFAULT {now},
+            finished_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status, created_at)')
+
+
+def _pg_migration_user_state_version(cursor):
+    """معادل _migration_user_state_version روی PostgreSQL"""
+    _migration_user_state_version(cursor)
+
+
+def _pg_migration_inactive_chats_index(cursor):
+    """معادل _migration_inactive_chats_index روی PostgreSQL"""
+    _migration_inactive_chats_index(cursor)
+
+
+def _pg_migration_single_running_broadcast(cursor):
+    """معادل _migration_single_running_broadcast روی PostgreSQL"""
+    _migration_single_running_broadcast(cursor)
+
+
+def _pg_migration_bot_blocked(cursor):
+    """معادل _migration_bot_blocked روی PostgreSQL"""
+    cursor.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS bot_blocked INTEGER DEFAULT 0')
+
+
+# مهاجرت‌ها به ترتیب اجرا؛ شماره‌ی نسخه‌ی هر کدام برابر جایگاه آن در لیست است.
+# فقط به انتهای لیست اضافه کنید و مهاجرت‌های قبلی را تغییر ندهید.
+MIGRATIONS = [
+    _migration_create_tables,
+    _migration_message_tokens,
+    _migration_indexes,
+    _migration_integer_message_ids,
+    _migration_chat_model,
+    _migration_user_data,
+    _migration_chat_summaries,
+    _migration_archived_index,
+    _migration_pagination_indexes,
+    _migration_broadcasts,
+    _migration_user_state_version,
+    _migration_inactive_chats_index,
+    _migration_single_running_broadcast,
+    _migration_bot_blocked,
+]
+
+# مهاجرت‌های PostgreSQL؛ تغییرات ساختار بعدی به هر دو لیست اضافه می‌شوند
+POSTGRES_MIGRATIONS = [
+    _pg_migration_create_tables,
+    _pg_migration_chat_summaries,
+    _pg_migration_archived_index,
+    _pg_migration_pagination_indexes,
+    _pg_migration_broadcasts,
+    _pg_migration_user_state_version,
+    _pg_migration_inactive_chats_index,
+    _pg_migration_single_running_broadcast,
+    _pg_migration_bot_blocked,
+]
+
+MIGRATIONS_BY_BACKEND = {
+    'sqlite': MIGRATIONS,
+    'postgres': POSTGRES_MIGRATIONS,
+}
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn, backend: Optional[StorageBackend] = None) -> int:
+    """نسخه‌ی فعلی ساختار دیتابیس (در SQLite: PRAGMA user_version)"""
+    return (backend or SQLiteBackend()).get_schema_version(conn)
+
+
+def migrate(conn, backend: Optional[StorageBackend] = None) -> int:
+    """
+    اجرای مهاجرت‌های باقی‌مانده، هر کدام در یک تراکنش جداگانه
+    تراکنش انحصاری backend مانع اجرای همزمان مهاجرت توسط چند پروسه می‌شود.
+    """
+    backend = backend or SQLiteBackend()
+    migrations = MIGRATIONS_BY_BACKEND[backend.name]
+    if conn.in_transaction:
+        conn.commit()
+    
+    while True:
+        backend.begin_migration(conn)
+        try:
+            version = backend.get_schema_version(conn)
+            if version >= len(migrations):
+                conn.rollback()
+                return version
+            
+            cursor = conn.cursor()
+            migrations[version](cursor)
+            backend.set_schema_version(conn, version + 1)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+class ConnectionPool:
+    """استخر اتصال‌های پایدار (اتصال‌ها توسط backend ساخته و پیکربندی می‌شوند)"""
+    
+    def __init__(self, connect: Callable, size: int = DB_POOL_SIZE):
+        self._connect = connect
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
         
-        # جدول گفتگوها
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chats (
-                chat_id TEXT PRIMARY KEY,
-                user_id INTEGER,
-                chat_name TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                is_active INTEGER DEFAULT 1,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
         
-        # جدول پیام‌ها
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                message_id TEXT PRIMARY KEY,
-                chat_id TEXT,
-                role TEXT,
-                content TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
-            )
-        ''')
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
         
-        # جدول آمار روزانه
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS daily_usage (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                usage_date TEXT,
-                message_count INTEGER DEFAULT 0,
-                UNIQUE(user_id, usage_date),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
+        # استخر پر است؛ منتظر آزاد شدن یک اتصال می‌مانیم
+        return self._idle.get()
+    
+    def _release(self, conn):
+        self._idle.put(conn)
+    
+    @contextmanager
+    def connection(self):
+        """قرض گرفتن یک اتصال؛ commit در پایان و rollback در صورت خطا"""
+        conn = self._acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+    
+    def close(self):
+        """بستن همه اتصال‌های آزاد"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+class UserStateCache:
+    """
+    کش LRU/TTL وضعیت کاربران (بلاک، محدودیت، گفتگوی فعال، استفاده‌ی امروز)
+    متدهای نوشتن Database رکوردها را به‌روزرسانی یا باطل می‌کنند.
+    """
+    
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # با هر تغییر افزایش می‌یابد تا خواندن‌های قدیمی جای نوشتن‌های جدید ننشینند
+        self.generation = 0
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return item[1]
+    
+    def peek(self, user_id: int) -> Optional[Dict]:
+        """
+        رکورد معتبر یا None، در یک قدم زیر قفل (فقط hit شمرده می‌شود)
+        پاسخ از همین رکورد داده می‌شود تا انقضا یا باطل شدن همزمان رکورد به کوئری روی حلقه‌ی رویداد نرسد؛
+        miss در خواندن بعدی از دیتابیس شمرده می‌شود.
+        """
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None or item[0] < time.monotonic():
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return item[1]
+    
+    def set(self, user_id: int, state: Dict, generation: int):
+        """ذخیره‌ی رکورد خوانده‌شده، اگر از زمان خواندن تغییری رخ نداده باشد"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[user_id] = (time.monotonic() + self.ttl, state)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    
+    def update(self, user_id: int, **fields):
+        """به‌روزرسانی فیلدهای رکورد موجود (write-through)"""
+        with self._lock:
+            self.generation += 1
+            item = self._data.get(user_id)
+            if item is not None:
+                self._data[user_id] = (item[0], {**item[1], **fields})
+    
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(user_id, None)
+    
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+    
+    def stats(self) -> Dict:
+        """آمار کش: تعداد رکوردها، hit و miss"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class KnownUsers:
+    """
+    کاربرانی که در دیتابیس ثبت شده‌اند، همراه با آخرین نام کاربری و نام آن‌ها (LRU محدود)
+    تغییرات پروفایل با بافر نوشتن فعال جمع‌آوری و در flush بعدی یک‌جا نوشته می‌شوند.
+    """
+    
+    def __init__(self, max_size: int = KNOWN_USERS_SIZE):
+        self.max_size = max_size
+        self._profiles = OrderedDict()  # user_id -> (username, first_name)
+        self._pending: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        self._lock = threading.Lock()
+        # با بافر نوشتن فعال، تغییرات پروفایل دسته‌ای نوشته می‌شوند
+        self.batching = False
         
-        conn.commit()
-        conn.close()
+        # آمار
+        self.hits = 0
+        self.misses = 0
+        self.flushed_profiles = 0
     
-    # ==================== مدیریت کاربران ====================
+    def __len__(self) -> int:
+        return len(self._profiles)
+    
+    def check(self, user_id: int, profile: tuple) -> Optional[bool]:
+        """
+        None: کاربر ناشناخته؛ False: پروفایل بدون تغییر؛ True: پروفایل تغییر کرده
+        در حالت دسته‌ای تغییر برای flush بعدی ثبت می‌شود؛ وگرنه پروفایل جدید فقط پس از نوشتن
+        موفق (با add) ثبت می‌شود تا نوشتن ناموفق، تغییر را «بدون تغییر» جا نزند.
+        """
+        with self._lock:
+            known = self._profiles.get(user_id)
+            if known is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._profiles.move_to_end(user_id)
+            if known == profile:
+                return False
+            if self.batching:
+                self._profiles[user_id] = profile
+                self._pending[user_id] = profile
+            return True
+    
+    def add(self, user_id: int, profile: tuple):
+        """ثبت کاربری که در دیتابیس با همین پروفایل وجود دارد"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._profiles[user_id] = profile
+            self._profiles.move_to_end(user_id)
+            self._pending.pop(user_id, None)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+    
+    def take_pending(self) -> Dict[int, tuple]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            return pending
+    
+    def restore_pending(self, pending: Dict[int, tuple]):
+        """بازگرداندن تغییرات flush ناموفق (تغییرات جدیدتر حفظ می‌شوند)"""
+        with self._lock:
+            self._pending = {**pending, **self._pending}
+    
+    def stats(self) -> Dict:
+        """آمار: تعداد کاربران ثبت‌شده، hit و miss و تغییرات پروفایل در انتظار"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._profiles),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'pending_profiles': len(self._pending),
+            'flushed_profiles': self.flushed_profiles,
+        }
+
+
+class WriteBehindBuffer:
+    """
+    بافر درج پیام‌ها برای نوشتن دسته‌ای در یک تراکنش
+    پیام‌های بافر شده در خواندن‌های تاریخچه دیده می‌شوند (read-your-writes). تأیید تراکنش
+    flush و حذف پیام‌ها از بافر در یک قدم انجام می‌شود تا خواننده‌ها هیچ پیامی را
+    دو بار یا هیچ بار نبینند.
+    """
     
-    def get_or_create_user(self, user_id: int, username: str = None, first_name: str = None) -> Dict:
-        """دریافت یا ایجاد کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def __init__(self, max_size: int = WRITE_BEHIND_BATCH):
+        self.max_size = max(1, max_size)
+        self._cond = threading.Condition()
+        self._pending = []   # (chat_id, role, content, tokens)
+        self._inflight = []  # ردیف‌های در حال flush
+        self._readers = 0
+        self._committing = False
         
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
+        # آمار
+        self.flushes = 0
+        self.flushed_rows = 0
+    
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._pending)
+    
+    def is_full(self) -> bool:
+        return len(self) >= self.max_size
+    
+    def add(self, rows: List[tuple]):
+        with self._cond:
+            self._pending.extend(rows)
+    
+    def pending_for(self, chat_id: str) -> List[Dict]:
+        """پیام‌های ذخیره‌نشده‌ی یک گفتگو به ترتیب زمانی"""
+        with self._cond:
+            return [
+                {'role': row[1], 'content': row[2], 'tokens': row[3]}
+                for row in self._inflight + self._pending if row[0] == chat_id
+            ]
+    
+    def discard_chat(self, chat_id: str):
+        """حذف پیام‌های بافر شده‌ی یک گفتگو (هنگام پاک شدن تاریخچه)"""
+        with self._cond:
+            self._pending = [row for row in self._pending if row[0] != chat_id]
+    
+    def begin_flush(self) -> List[tuple]:
+        with self._cond:
+            self._inflight, self._pending = self._pending, []
+            return list(self._inflight)
+    
+    def end_flush(self):
+        with self._cond:
+            self.flushes += 1
+            self.flushed_rows += len(self._inflight)
+            self._inflight = []
+    
+    def abort_flush(self):
+        """بازگرداندن ردیف‌های flush ناموفق به ابتدای بافر"""
+        with self._cond:
+            self._pending = self._inflight + self._pending
+            self._inflight = []
+    
+    @contextmanager
+    def reading(self):
+        """بلوک خواندن دیتابیس به همراه بافر؛ در طول آن تأیید flush انجام نمی‌شود"""
+        with self._cond:
+            while self._committing:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def committing(self):
+        """انتظار برای تمام شدن خواندن‌های جاری و جلوگیری از خواندن‌های جدید"""
+        with self._cond:
+            self._committing = True
+            while self._readers:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._committing = False
+                self._cond.notify_all()
+
+
+class Database:
+    def __init__(self, db_path: str = DATABASE_PATH, pool_size: int = DB_POOL_SIZE,
+                 backend: Optional[StorageBackend] = None):
+        if backend is None:
+            backend = SQLiteBackend(db_path) if STORAGE_BACKEND == 'sqlite' else create_backend()
+        self.db_path = db_path
+        self.backend = backend
+        self.pool = ConnectionPool(backend.connect, pool_size)
+        self.user_cache = UserStateCache()
+        # آخرین نسخه‌ی وضعیت کاربران که کش این پروسه با آن همگام است
+        self.state_version = 0
+        self.known_users = KnownUsers()
+        # بافر نوشتن با تأخیر پیام‌ها (با AsyncDatabase.start_write_behind فعال می‌شود)
+        self.write_buffer: Optional[WriteBehindBuffer] = None
+        self.init_db()
+    
+    def connection(self):
+        """قرض گرفتن یک اتصال از استخر"""
+        return self.pool.connection()
+    
+    def close(self):
+        """بستن اتصال‌های دیتابیس"""
+        self.pool.close()
+    
+    def _execute_returning(self, conn, sql: str, params: tuple,
+                           column: str, select_sql: str, select_params: tuple) -> Optional[Any]:
+        """
+        اجرای یک دستور نوشتن و برگرداندن مقدار یک ستون از ردیف تغییر یافته
+        روی SQLite قدیمی به جای RETURNING یک SELECT در همان تراکنش اجرا می‌شود.
+        """
+        if self.backend.has_returning:
+            rows = conn.execute(f'{sql} RETURNING {column}', params).fetchall()
+            return rows[0][0] if rows else None
         
-        if not user:
-            cursor.execute(
-                'INSERT INTO users (user_id, username, first_name, daily_limit) VALUES (?, ?, ?, ?)',
+        cursor = conn.execute(sql, params)
+        if cursor.rowcount <= 0:
+            return None
+        row = conn.execute(select_sql, select_params).fetchone()
+        return row[0] if row else None
+    
+    @contextmanager
+    def _pending_messages(self, chat_id: str):
+        """پیام‌های هنوز ذخیره‌نشده‌ی گفتگو برای ترکیب با نتیجه‌ی کوئری"""
+        if self.write_buffer is None:
+            yield []
+            return
+        with self.write_buffer.reading():
+            yield self.write_buffer.pending_for(chat_id)
+    
+    def init_db(self):
+        """ایجاد جداول و اجرای مهاجرت‌های دیتابیس"""
+        with self.connection() as conn:
+            migrate(conn, self.backend)
+            self.state_version = self._read_state_version(conn)
+    
+    @staticmethod
+    def _read_state_version(conn) -> int:
+        return conn.execute('SELECT version FROM user_state_version WHERE id = 1').fetchone()[0]
+    
+    def _bump_state_version(self, conn):
+        """اعلام تغییر وضعیت کاربر به پروسه‌های دیگر (در همان تراکنش تغییر)"""
+        version = self._execute_returning(
+            conn,
+            'UPDATE user_state_version SET version = version + 1 WHERE id = 1',
+            (),
+            'version',
+            'SELECT version FROM user_state_version WHERE id = 1',
+            ()
+        )
+        # تغییر خود این پروسه در کش اعمال شده؛ اگر پروسه‌ی دیگری هم تغییری داده، همگام‌سازی بعدی کش را پاک می‌کند
+        if version == self.state_version + 1:
+            self.state_version = version
+    
+    def sync_user_cache(self) -> bool:
+        """پاک کردن کش وضعیت کاربران اگر پروسه‌ی دیگری از آخرین همگام‌سازی وضعیت کاربری را تغییر داده باشد"""
+        with self.connection() as conn:
+            version = self._read_state_version(conn)
+        if version == self.state_version:
+            return False
+        self.user_cache.clear()
+        self.state_version = version
+        return True
+    
+    # ==================== مدیریت کاربران ====================
+    
+    def ensure_user(self, user_id: int, username: str = None, first_name: str = None):
+        """
+        ثبت کاربر یا به‌روزرسانی نام کاربری و نام او
+        کاربران شناخته‌شده بدون دسترسی به دیتابیس رد می‌شوند؛ برای بقیه یک upsert اجرا می‌شود.
+        """
+        if not self.ensure_known_user(user_id, username, first_name):
+            self.write_user(user_id, username, first_name)
+    
+    def ensure_known_user(self, user_id: int, username: str = None, first_name: str = None) -> bool:
+        """
+        بخش بدون دیتابیس ensure_user: True اگر کاربر شناخته‌شده است و کاری برای دیتابیس
+        نمانده (پروفایل بدون تغییر، یا تغییر آن برای flush دسته‌ای ثبت شد)
+        """
+        changed = self.known_users.check(user_id, (username, first_name))
+        return changed is False or (changed is True and self.known_users.batching)
+    
+    def write_user(self, user_id: int, username: str = None, first_name: str = None):
+        """upsert کاربر؛ پروفایل فقط پس از نوشتن موفق در known_users ثبت می‌شود"""
+        with self.connection() as conn:
+            conn.execute(
+                'INSERT INTO users (user_id, username, first_name, daily_limit) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET '
+                'username = excluded.username, first_name = excluded.first_name, bot_blocked = 0',
                 (user_id, username, first_name, DEFAULT_DAILY_LIMIT)
             )
-            conn.commit()
-            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            user = cursor.fetchone()
+        # وضعیت «کاربر وجود ندارد» در کش دیگر معتبر نیست
+        self.user_cache.invalidate(user_id)
+        self.known_users.add(user_id, (username, first_name))
+    
+    def get_user_state(self, user_id: int) -> Dict:
+        """
+        وضعیت فشرده‌ی کاربر (از کش یا با یک کوئری)
+        شامل: exists, is_blocked, daily_limit, active_chat_id, active_chat_model, usage, usage_date
+        """
+        today = date.today().isoformat()
+        state = self.user_cache.get(user_id)
         
-        conn.close()
-        return dict(user)
+        if state is None:
+            generation = self.user_cache.generation
+            with self.connection() as conn:
+                row = conn.execute('''
+                    SELECT
+                        u.is_blocked,
+                        u.daily_limit,
+                        c.chat_id AS active_chat_id,
+                        c.model AS active_chat_model,
+                        (SELECT message_count FROM daily_usage
+                         WHERE user_id = u.user_id AND usage_date = ?) AS usage
+                    FROM users u
+                    LEFT JOIN chats c ON c.user_id = u.user_id AND c.is_active = 1
+                    WHERE u.user_id = ?
+                    LIMIT 1
+                ''', (today, user_id)).fetchone()
+            
+            if row:
+                state = {
+                    'exists': True,
+                    'is_blocked': row['is_blocked'] == 1,
+                    'daily_limit': row['daily_limit'],
+                    'active_chat_id': row['active_chat_id'],
+                    'active_chat_model': row['active_chat_model'],
+                    'usage': row['usage'] or 0,
+                    'usage_date': today,
+                }
+            else:
+                state = {
+                    'exists': False,
+                    'is_blocked': False,
+                    'daily_limit': DEFAULT_DAILY_LIMIT,
+                    'active_chat_id': None,
+                    'active_chat_model': None,
+                    'usage': 0,
+                    'usage_date': today,
+                }
+            self.user_cache.set(user_id, state, generation)
+        
+        return self._current_day(user_id, state, today)
+    
+    def _current_day(self, user_id: int, state: Dict, today: str) -> Dict:
+        """کپی وضعیت با استفاده‌ی صفر در شروع روز جدید"""
+        if state['usage_date'] != today:
+            state = {**state, 'usage': 0, 'usage_date': today}
+            self.user_cache.update(user_id, usage=0, usage_date=today)
+        return dict(state)
+    
+    def cached_user_state(self, user_id: int) -> Optional[Dict]:
+        """وضعیت کاربر فقط از کش، بدون دسترسی به دیتابیس؛ None اگر رکورد معتبری نباشد"""
+        state = self.user_cache.peek(user_id)
+        if state is None:
+            return None
+        return self._current_day(user_id, state, date.today().isoformat())
     
     def is_user_blocked(self, user_id: int) -> bool:
         """بررسی بلاک بودن کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT is_blocked FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result and result['is_blocked'] == 1
+        return self.get_user_state(user_id)['is_blocked']
     
     def block_user(self, user_id: int) -> bool:
         """بلاک کردن کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_blocked = 1 WHERE user_id = ?', (user_id,))
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.execute('UPDATE users SET is_blocked = 1 WHERE user_id = ?', (user_id,))
+            affected = cursor.rowcount
+            self._bump_state_version(conn)
+        self.user_cache.update(user_id, is_blocked=True)
         return affected > 0
     
     def unblock_user(self, user_id: int) -> bool:
         """آن‌بلاک کردن کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_blocked = 0 WHERE user_id = ?', (user_id,))
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.execute('UPDATE users SET is_blocked = 0 WHERE user_id = ?', (user_id,))
+            affected = cursor.rowcount
+            self._bump_state_version(conn)
+        self.user_cache.update(user_id, is_blocked=False)
         return affected > 0
     
     def set_user_limit(self, user_id: int, limit: int) -> bool:
         """تنظیم محدودیت کاربر (-1 = نامحدود)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET daily_limit = ? WHERE user_id = ?', (limit, user_id))
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.execute('UPDATE users SET daily_limit = ? WHERE user_id = ?', (limit, user_id))
+            affected = cursor.rowcount
+            self._bump_state_version(conn)
+        self.user_cache.update(user_id, daily_limit=limit)
         return affected > 0
     
     def get_user_limit(self, user_id: int) -> int:
         """دریافت محدودیت کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT daily_limit FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            return result['daily_limit']
-        return DEFAULT_DAILY_LIMIT
+        return self.get_user_state(user_id)['daily_limit']
     
     def get_all_users(self) -> List[Dict]:
         """دریافت لیست همه کاربران"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users ORDER BY created_at DESC')
-        users = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return users
+        with self.connection() as conn:
+            rows = conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
+        return [dict(row) for row in rows]
+    
+    @staticmethod
+    def _keyset_page(conn, sql: str, params: tuple, columns: Tuple[str, ...], anchor_sql: str,
+                     limit: int, after: Any, before: Any) -> Tuple[List[Dict], bool, bool]:
+        """
+        یک صفحه با صفحه‌بندی keyset روی ستون‌های columns (جدیدترین اول)
+        after: صفحه‌ی بعد از ردیف با این شناسه (قدیمی‌ترها)، before: صفحه‌ی قبل از آن (جدیدترها)
+        ردیف مرجع با کلید اصلی پیدا می‌شود، پس هزینه‌ی هر صفحه مستقل از شماره‌ی آن است.
+        خروجی: (ردیف‌ها، صفحه‌ی قبلی دارد، صفحه‌ی بعدی دارد)
+        """
+        key = ', '.join(columns)
+        if before is not None:
+            ascending = ', '.join(f'{c} ASC' for c in columns)
+            rows = conn.execute(
+                f'{sql} AND ({key}) > ({anchor_sql}) ORDER BY {ascending} LIMIT ?',
+                params + (before, limit + 1)
+            ).fetchall()
+            rows = [dict(row) for row in rows]
+            return rows[:limit][::-1], len(rows) > limit, True
+        
+        if after is not None:
+            sql += f' AND ({key}) < ({anchor_sql})'
+            params += (after,)
+        descending = ', '.join(f'{c} DESC' for c in columns)
+        rows = conn.execute(f'{sql} ORDER BY {descending} LIMIT ?', params + (limit + 1,)).fetchall()
+        rows = [dict(row) for row in rows]
+        return rows[:limit], after is not None, len(rows) > limit
+    
+    def get_users_page(self, limit: int = USERS_PAGE_SIZE, after: Optional[int] = None,
+                       before: Optional[int] = None) -> Tuple[List[Dict], bool, bool]:
+        """صفحه‌ای از کاربران به ترتیب عضویت (جدیدترین اول)؛ (کاربران، قبلی دارد، بعدی دارد)"""
+        with self.connection() as conn:
+            page = self._keyset_page(
+                conn,
+                'SELECT * FROM users WHERE 1 = 1', (),
+                ('created_at', 'user_id'),
+                'SELECT created_at, user_id FROM users WHERE user_id = ?',
+                limit, after, before
+            )
+        if not page[0] and (after is not None or before is not None):
+            # کاربر مرجع حذف شده است؛ بازگشت به صفحه‌ی اول
+            return self.get_users_page(limit)
+        return page
+    
+    def search_users(self, query: str, limit: int = USERS_PAGE_SIZE) -> List[Dict]:
+        """جستجوی کاربر با شناسه‌ی عددی یا ابتدای نام کاربری (با یا بدون @)"""
+        query = query.strip()
+        with self.connection() as conn:
+            if query.lstrip('-').isdigit():
+                rows = conn.execute('SELECT * FROM users WHERE user_id = ?', (int(query),)).fetchall()
+            else:
+                prefix = query.lstrip('@').lower()
+                if not prefix:
+                    return []
+                # جستجوی بازه‌ای روی ایندکس LOWER(username) به جای LIKE
+                rows = conn.execute(
+                    'SELECT * FROM users WHERE LOWER(username) >= ? AND LOWER(username) < ? '
+                    'ORDER BY LOWER(username) LIMIT ?',
+                    (prefix, prefix + '\uffff', limit)
+                ).fetchall()
+        return [dict(row) for row in rows]
     
     # ==================== مدیریت گفتگوها ====================
     
@@ -168,158 +1061,424 @@ class Database:
         if not chat_name:
             chat_name = f"گفتگو {datetime.now().strftime('%Y/%m/%d %H:%M')}"
         
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # غیرفعال کردن گفتگوهای قبلی
-        cursor.execute('UPDATE chats SET is_active = 0 WHERE user_id = ?', (user_id,))
-        
-        # ایجاد گفتگوی جدید
-        cursor.execute(
-            'INSERT INTO chats (chat_id, user_id, chat_name, is_active) VALUES (?, ?, ?, 1)',
-            (chat_id, user_id, chat_name)
-        )
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # غیرفعال کردن گفتگوهای قبلی
+            cursor.execute('UPDATE chats SET is_active = 0 WHERE user_id = ?', (user_id,))
+            
+            # ایجاد گفتگوی جدید
+            cursor.execute(
+                'INSERT INTO chats (chat_id, user_id, chat_name, is_active) VALUES (?, ?, ?, 1)',
+                (chat_id, user_id, chat_name)
+            )
         
-        conn.commit()
-        conn.close()
+        self.user_cache.update(user_id, active_chat_id=chat_id, active_chat_model=None)
         return chat_id
     
     def get_active_chat(self, user_id: int) -> Optional[Dict]:
         """دریافت گفتگوی فعال کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT * FROM chats WHERE user_id = ? AND is_active = 1',
-            (user_id,)
-        )
-        chat = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            chat = conn.execute(
+                'SELECT * FROM chats WHERE user_id = ? AND is_active = 1',
+                (user_id,)
+            ).fetchone()
         return dict(chat) if chat else None
     
+    def get_active_chat_id(self, user_id: int) -> Optional[str]:
+        """دریافت شناسه‌ی گفتگوی فعال کاربر (از کش)"""
+        return self.get_user_state(user_id)['active_chat_id']
+    
     def get_user_chats(self, user_id: int) -> List[Dict]:
         """دریافت همه گفتگوهای کاربر"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT * FROM chats WHERE user_id = ? ORDER BY created_at DESC',
-            (user_id,)
-        )
-        chats = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return chats
+        with self.connection() as conn:
+            rows = conn.execute(
+                'SELECT * FROM chats WHERE user_id = ? ORDER BY created_at DESC',
+                (user_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+    
+    def get_user_chats_page(self, user_id: int, limit: int = CHATS_PAGE_SIZE,
+                            after: Optional[str] = None,
+                            before: Optional[str] = None) -> Tuple[List[Dict], bool, bool]:
+        """صفحه‌ای از گفتگوهای کاربر (جدیدترین اول)؛ (گفتگوها، قبلی دارد، بعدی دارد)"""
+        with self.connection() as conn:
+            page = self._keyset_page(
+                conn,
+                'SELECT * FROM chats WHERE user_id = ?', (user_id,),
+                ('created_at', 'chat_id'),
+                'SELECT created_at, chat_id FROM chats WHERE chat_id = ?',
+                limit, after, before
+            )
+        if not page[0] and (after is not None or before is not None):
+            return self.get_user_chats_page(user_id, limit)
+        return page
+    
+    def get_user_chat(self, user_id: int, chat_id: str) -> Optional[Dict]:
+        """دریافت یک گفتگوی کاربر"""
+        with self.connection() as conn:
+            chat = conn.execute(
+                'SELECT * FROM chats WHERE chat_id = ? AND user_id = ?',
+                (chat_id, user_id)
+            ).fetchone()
+        return dict(chat) if chat else None
+    
+    def count_user_chats(self, user_id: int) -> int:
+        """تعداد گفتگوهای کاربر"""
+        with self.connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM chats WHERE user_id = ?', (user_id,)).fetchone()[0]
     
     def switch_chat(self, user_id: int, chat_id: str) -> bool:
         """تغییر گفتگوی فعال"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # غیرفعال کردن همه گفتگوها
-        cursor.execute('UPDATE chats SET is_active = 0 WHERE user_id = ?', (user_id,))
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # غیرفعال کردن همه گفتگوها
+            cursor.execute('UPDATE chats SET is_active = 0 WHERE user_id = ?', (user_id,))
+            
+            # فعال کردن گفتگوی انتخاب شده
+            cursor.execute(
+                'UPDATE chats SET is_active = 1 WHERE chat_id = ? AND user_id = ?',
+                (chat_id, user_id)
+            )
+            
+            affected = cursor.rowcount
         
-        # فعال کردن گفتگوی انتخاب شده
-        cursor.execute(
-            'UPDATE chats SET is_active = 1 WHERE chat_id = ? AND user_id = ?',
-            (chat_id, user_id)
-        )
+        # مدل گفتگوی جدید در کش نیست؛ در خواندن بعدی بارگذاری می‌شود
+        self.user_cache.invalidate(user_id)
+        return affected > 0
+    
+    def get_active_chat_model(self, user_id: int) -> Optional[str]:
+        """دریافت مدل انتخابی گفتگوی فعال (None = مدل پیش‌فرض)"""
+        return self.get_user_state(user_id)['active_chat_model']
+    
+    def set_chat_model(self, user_id: int, chat_id: str, model: Optional[str]) -> bool:
+        """تنظیم مدل یک گفتگو"""
+        with self.connection() as conn:
+            cursor = conn.execute(
+                'UPDATE chats SET model = ? WHERE chat_id = ? AND user_id = ?',
+                (model, chat_id, user_id)
+            )
+            affected = cursor.rowcount
         
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        if affected > 0 and self.get_active_chat_id(user_id) == chat_id:
+            self.user_cache.update(user_id, active_chat_model=model)
         return affected > 0
     
     def delete_chat(self, chat_id: str) -> bool:
         """حذف گفتگو و پیام‌های آن"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            owner = cursor.execute('SELECT user_id FROM chats WHERE chat_id = ?', (chat_id,)).fetchone()
+            if self.write_buffer is not None:
+                self.write_buffer.discard_chat(chat_id)
+            cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+            
+            affected = cursor.rowcount
         
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        if owner:
+            self.user_cache.invalidate(owner['user_id'])
         return affected > 0
     
     def clear_chat_history(self, chat_id: str) -> bool:
         """پاک کردن تاریخچه گفتگو"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            if self.write_buffer is not None:
+                self.write_buffer.discard_chat(chat_id)
+            conn.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            conn.execute('UPDATE chats SET summary = NULL WHERE chat_id = ?', (chat_id,))
         return True
     
     # ==================== مدیریت پیام‌ها ====================
     
-    def add_message(self, chat_id: str, role: str, content: str) -> str:
-        """افزودن پیام به گفتگو"""
-        message_id = str(uuid.uuid4())
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO messages (message_id, chat_id, role, content) VALUES (?, ?, ?, ?)',
-            (message_id, chat_id, role, content)
+    def _insert_message(self, conn, chat_id: str, role: str, content: str) -> int:
+        """درج یک پیام و برگرداندن شناسه‌ی آن"""
+        return self._execute_returning(
+            conn,
+            'INSERT INTO messages (chat_id, role, content, tokens) VALUES (?, ?, ?, ?)',
+            (chat_id, role, content, estimate_tokens(content)),
+            'message_id',
+            'SELECT last_insert_rowid()',
+            ()
         )
-        conn.commit()
-        conn.close()
+    
+    def add_message(self, chat_id: str, role: str, content: str) -> Optional[int]:
+        """افزودن پیام به گفتگو (با بافر نوشتن فعال، شناسه None است)"""
+        if self.write_buffer is not None:
+            self.write_buffer.add([(chat_id, role, content, estimate_tokens(content))])
+            return None
+        with self.connection() as conn:
+            message_id = self._insert_message(conn, chat_id, role, content)
         return message_id
     
-    def get_chat_messages(self, chat_id: str) -> List[Dict]:
-        """دریافت پیام‌های یک گفتگو"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT role, content FROM messages WHERE chat_id = ? ORDER BY created_at ASC',
-            (chat_id,)
+    def record_turn(self, chat_id: str, user_content: str, assistant_content: str) -> tuple:
+        """ذخیره‌ی پیام کاربر و پاسخ مدل در یک تراکنش (یا در بافر نوشتن)"""
+        if self.write_buffer is not None:
+            self.write_buffer.add([
+                (chat_id, 'user', user_content, estimate_tokens(user_content)),
+                (chat_id, 'assistant', assistant_content, estimate_tokens(assistant_content)),
+            ])
+            return None, None
+        with self.connection() as conn:
+            user_message_id = self._insert_message(conn, chat_id, 'user', user_content)
+            assistant_message_id = self._insert_message(conn, chat_id, 'assistant', assistant_content)
+        return user_message_id, assistant_message_id
+    
+    def flush_profiles(self) -> int:
+        """نوشتن دسته‌ای تغییرات نام کاربری و نام کاربران؛ تعداد کاربران به‌روزشده"""
+        pending = self.known_users.take_pending()
+        if not pending:
+            return 0
+        try:
+            with self.connection() as conn:
+                conn.executemany(
+                    'UPDATE users SET username = ?, first_name = ? WHERE user_id = ?',
+                    [(username, first_name, user_id) for user_id, (username, first_name) in pending.items()]
+                )
+        except BaseException:
+            self.known_users.restore_pending(pending)
+            raise
+        self.known_users.flushed_profiles += len(pending)
+        return len(pending)
+    
+    def flush_writes(self) -> int:
+        """نوشتن پیام‌های بافر شده و تغییرات پروفایل کاربران؛ تعداد پیام‌های نوشته‌شده"""
+        self.flush_profiles()
+        buffer = self.write_buffer
+        if buffer is None:
+            return 0
+        rows = buffer.begin_flush()
+        if not rows:
+            return 0
+        
+        try:
+            with self.connection() as conn:
+                conn.executemany(
+                    'INSERT INTO messages (chat_id, role, content, tokens) VALUES (?, ?, ?, ?)',
+                    rows
+                )
+                with buffer.committing():
+                    conn.commit()
+                    buffer.end_flush()
+        except BaseException:
+            buffer.abort_flush()
+            raise
+        return len(rows)
+    
+    def get_chat_messages(self, chat_id: str, after_id: int = 0, limit: int = -1) -> List[Dict]:
+        """دریافت پیام‌های یک گفتگو (صفحه‌بندی با after_id و limit؛ -1 = بدون محدودیت)"""
+        sql = 'SELECT role, content FROM messages WHERE chat_id = ? AND message_id > ? ORDER BY message_id ASC'
+        params = (chat_id, after_id)
+        if limit >= 0:
+            sql += ' LIMIT ?'
+            params += (limit,)
+        with self.connection() as conn, self._pending_messages(chat_id) as pending:
+            rows = conn.execute(sql, params).fetchall()
+        
+        messages = [dict(row) for row in rows]
+        # پیام‌های بافر شده همیشه جدیدتر از پیام‌های ذخیره‌شده‌اند
+        messages += [{'role': m['role'], 'content': m['content']} for m in pending]
+        return messages if limit < 0 else messages[:limit]
+    
+    def _read_recent(self, conn, pending: List[Dict], chat_id: str, token_budget: int,
+                     max_messages: int, include_newest: bool) -> List[Dict]:
+        """پیمایش پیام‌های بایگانی‌نشده از جدیدترین تا پر شدن بودجه"""
+        messages = []
+        used = 0
+        cursor = conn.execute(
+            'SELECT role, content, tokens FROM messages WHERE chat_id = ? AND archived = 0 '
+            'ORDER BY message_id DESC LIMIT ?',
+            (chat_id, max_messages)
         )
-        messages = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        # ابتدا پیام‌های بافر شده (جدیدترین‌ها) و سپس پیام‌های ذخیره‌شده
+        for row in itertools.chain(reversed(pending), cursor):
+            if len(messages) >= max_messages:
+                break
+            tokens = row['tokens'] or estimate_tokens(row['content'])
+            if used + tokens > token_budget and (messages or not include_newest):
+                break
+            used += tokens
+            messages.append({'role': row['role'], 'content': row['content']})
+        cursor.close()
+        
+        messages.reverse()
         return messages
     
+    def get_recent_messages(self, chat_id: str, token_budget: int,
+                            max_messages: int = CONTEXT_MAX_MESSAGES,
+                            include_newest: bool = True) -> List[Dict]:
+        """
+        دریافت جدیدترین پیام‌هایی که در بودجه‌ی توکن جا می‌شوند (به ترتیب زمانی)
+        include_newest: جدیدترین پیام حتی اگر از بودجه بیشتر باشد برگردانده شود
+        """
+        with self.connection() as conn, self._pending_messages(chat_id) as pending:
+            return self._read_recent(conn, pending, chat_id, token_budget, max_messages, include_newest)
+    
+    def get_context_window(self, chat_id: str, token_budget: int,
+                           max_messages: int = CONTEXT_MAX_MESSAGES,
+                           include_newest: bool = True) -> Tuple[Optional[str], List[Dict]]:
+        """خلاصه‌ی گفتگو به همراه جدیدترین پیام‌هایی که در باقی‌مانده‌ی بودجه جا می‌شوند"""
+        with self.connection() as conn, self._pending_messages(chat_id) as pending:
+            row = conn.execute('SELECT summary FROM chats WHERE chat_id = ?', (chat_id,)).fetchone()
+            summary = row['summary'] if row else None
+            if summary:
+                token_budget -= estimate_tokens(summary)
+            messages = self._read_recent(
+                conn, pending, chat_id, max(token_budget, 0), max_messages, include_newest
+            )
+        return summary, messages
+    
+    # ==================== فشرده‌سازی تاریخچه ====================
+    
+    def get_history_tokens(self, chat_id: str) -> int:
+        """مجموع توکن پیام‌های بایگانی‌نشده‌ی گفتگو (شامل پیام‌های بافر شده)"""
+        with self.connection() as conn, self._pending_messages(chat_id) as pending:
+            row = conn.execute(
+                'SELECT COALESCE(SUM(tokens), 0) FROM messages WHERE chat_id = ? AND archived = 0',
+                (chat_id,)
+            ).fetchone()
+        return row[0] + sum(m['tokens'] for m in pending)
+    
+    def get_compaction_batch(self, chat_id: str, keep_tokens: int,
+                             max_tokens: int) -> Tuple[Optional[str], List[Dict]]:
+        """
+        خلاصه‌ی فعلی و قدیمی‌ترین پیام‌های قابل خلاصه‌سازی
+        جدیدترین پیام‌ها تا keep_tokens دست‌نخورده می‌مانند و دسته حداکثر max_tokens است؛
+        دسته همیشه با پاسخ مدل تمام می‌شود تا پرسش و پاسخ از هم جدا نشوند.
+        """
+        with self.connection() as conn:
+            row = conn.execute('SELECT summary FROM chats WHERE chat_id = ?', (chat_id,)).fetchone()
+            rows = conn.execute(
+                'SELECT message_id, role, content, tokens FROM messages '
+                'WHERE chat_id = ? AND archived = 0 ORDER BY message_id ASC',
+                (chat_id,)
+            ).fetchall()
+        summary = row['summary'] if row else None
+        
+        # کنار گذاشتن جدیدترین پیام‌ها
+        kept = 0
+        cutoff = len(rows)
+        while cutoff > 0 and kept + rows[cutoff - 1]['tokens'] <= keep_tokens:
+            cutoff -= 1
+            kept += rows[cutoff]['tokens']
+        
+        batch = []
+        used = 0
+        for r in rows[:cutoff]:
+            if batch and used + r['tokens'] > max_tokens:
+                break
+            used += r['tokens']
+            batch.append(dict(r))
+        while batch and batch[-1]['role'] != 'assistant':
+            batch.pop()
+        return summary, batch
+    
+    def set_chat_summary(self, chat_id: str, summary: str, through_message_id: int, count: int) -> bool:
+        """
+        ذخیره‌ی خلاصه‌ی جدید و بایگانی پیام‌های خلاصه‌شده در یک تراکنش
+        اگر در این فاصله تاریخچه پاک یا تغییر کرده باشد، چیزی ذخیره نمی‌شود.
+        """
+        with self.connection() as conn:
+            cursor = conn.execute(
+                'UPDATE messages SET archived = 1 WHERE chat_id = ? AND message_id <= ? AND archived = 0',
+                (chat_id, through_message_id)
+            )
+            if cursor.rowcount != count:
+                conn.rollback()
+                return False
+            conn.execute('UPDATE chats SET summary = ? WHERE chat_id = ?', (summary, chat_id))
+        return True
+    
     # ==================== مدیریت آمار ====================
     
     def increment_daily_usage(self, user_id: int) -> int:
         """افزایش شمارنده استفاده روزانه"""
         today = date.today().isoformat()
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            usage = self._execute_returning(
+                conn,
+                'INSERT INTO daily_usage (user_id, usage_date, message_count) VALUES (?, ?, 1) '
+                'ON CONFLICT(user_id, usage_date) DO UPDATE SET message_count = daily_usage.message_count + 1',
+                (user_id, today),
+                'message_count',
+                'SELECT message_count FROM daily_usage WHERE user_id = ? AND usage_date = ?',
+                (user_id, today)
+            ) or 0
         
-        cursor.execute(
-            'INSERT OR IGNORE INTO daily_usage (user_id, usage_date, message_count) VALUES (?, ?, 0)',
-            (user_id, today)
-        )
-        cursor.execute(
-            'UPDATE daily_usage SET message_count = message_count + 1 WHERE user_id = ? AND usage_date = ?',
-            (user_id, today)
-        )
+        self.user_cache.update(user_id, usage=usage, usage_date=today)
+        return usage
+    
+    def admit_message(self, user_id: int) -> tuple:
+        """
+        پذیرش پیام: بررسی بلاک و محدودیت و رزرو یک واحد از سهمیه‌ی امروز در یک دستور اتمی
+        دو پیام همزمان از یک کاربر نمی‌توانند هر دو از آخرین واحد سهمیه عبور کنند.
+        خروجی مشابه can_send_message: (allowed, limit, usage)
+        """
+        today = date.today().isoformat()
+        with self.connection() as conn:
+            # کاربری که پیام می‌دهد دوباره در دسترس است (ارسال‌های همگانی بعدی را می‌گیرد)
+            conn.execute('UPDATE users SET bot_blocked = 0 WHERE user_id = ? AND bot_blocked = 1', (user_id,))
+            usage = self._execute_returning(
+                conn,
+                '''
+                INSERT INTO daily_usage (user_id, usage_date, message_count)
+                SELECT user_id, ?, 1 FROM users
+                WHERE user_id = ? AND is_blocked = 0 AND daily_limit != 0
+                ON CONFLICT(user_id, usage_date) DO UPDATE SET message_count = daily_usage.message_count + 1
+                WHERE (SELECT daily_limit FROM users WHERE users.user_id = daily_usage.user_id) = -1
+                   OR daily_usage.message_count < (SELECT daily_limit FROM users WHERE users.user_id = daily_usage.user_id)
+                ''',
+                (today, user_id),
+                'message_count',
+                'SELECT message_count FROM daily_usage WHERE user_id = ? AND usage_date = ?',
+                (user_id, today)
+            )
         
-        cursor.execute(
-            'SELECT message_count FROM daily_usage WHERE user_id = ? AND usage_date = ?',
-            (user_id, today)
-        )
-        result = cursor.fetchone()
+        if usage is None:
+            # رد شده؛ وضعیت تازه برای نمایش پیام مناسب خوانده می‌شود
+            self.user_cache.invalidate(user_id)
+            state = self.get_user_state(user_id)
+            return False, state['daily_limit'], state['usage']
         
-        conn.commit()
-        conn.close()
-        return result['message_count'] if result else 0
+        self.user_cache.update(user_id, usage=usage, usage_date=today)
+        return True, self.get_user_state(user_id)['daily_limit'], usage
+    
+    def refund_message(self, user_id: int, count: int = 1) -> int:
+        """بازگرداندن count واحد رزرو شده در admit_message (مثلاً در صورت خطای API یا ادغام پیام‌ها)"""
+        today = date.today().isoformat()
+        with self.connection() as conn:
+            usage = self._execute_returning(
+                conn,
+                'UPDATE daily_usage SET message_count = '
+                'CASE WHEN message_count > ? THEN message_count - ? ELSE 0 END '
+                'WHERE user_id = ? AND usage_date = ? AND message_count > 0',
+                (count, count, user_id, today),
+                'message_count',
+                'SELECT message_count FROM daily_usage WHERE user_id = ? AND usage_date = ?',
+                (user_id, today)
+            )
+        
+        if usage is None:
+            self.user_cache.invalidate(user_id)
+            return 0
+        self.user_cache.update(user_id, usage=usage, usage_date=today)
+        return usage
     
     def get_daily_usage(self, user_id: int) -> int:
         """دریافت استفاده روزانه کاربر"""
-        today = date.today().isoformat()
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT message_count FROM daily_usage WHERE user_id = ? AND usage_date = ?',
-            (user_id, today)
-        )
-        result = cursor.fetchone()
-        conn.close()
-        return result['message_count'] if result else 0
+        return self.get_user_state(user_id)['usage']
     
     def can_send_message(self, user_id: int) -> tuple:
         """بررسی امکان ارسال پیام"""
-        limit = self.get_user_limit(user_id)
-        usage = self.get_daily_usage(user_id)
+        return self.quota_status(self.get_user_state(user_id))
+    
+    @staticmethod
+    def quota_status(state: Dict) -> tuple:
+        """(allowed, limit, usage) از روی وضعیت کاربر"""
+        limit = state['daily_limit']
+        usage = state['usage']
         
         # -1 = نامحدود
         if limit == -1:
@@ -331,14 +1490,448 @@ class Database:
         """دریافت آمار کاربر"""
         usage = self.get_daily_usage(user_id)
         limit = self.get_user_limit(user_id)
-        chats = len(self.get_user_chats(user_id))
+        chats = self.count_user_chats(user_id)
         
         return {
             'today': usage,
             'limit': 'نامحدود' if limit == -1 else limit,
             'chats': chats
         }
+    
+    # ==================== داده‌های موقت کاربران (persistence) ====================
+    
+    def get_all_user_data(self) -> Dict[int, Dict]:
+        """دریافت user_data همه کاربران"""
+        with self.connection() as conn:
+            rows = conn.execute('SELECT user_id, data FROM user_data').fetchall()
+        return {row['user_id']: json.loads(row['data']) for row in rows}
+    
+    def get_user_data(self, user_id: int) -> Dict:
+        """دریافت user_data یک کاربر"""
+        with self.connection() as conn:
+            row = conn.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row['data']) if row else {}
+    
+    def save_user_data(self, user_id: int, data: Dict):
+        """ذخیره‌ی user_data یک کاربر (داده‌ی خالی حذف می‌شود)"""
+        with self.connection() as conn:
+            if not data:
+                conn.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+                return
+            conn.execute(
+                'INSERT INTO user_data (user_id, data) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data',
+                (user_id, json.dumps(data, ensure_ascii=False))
+            )
+    
+    def delete_user_data(self, user_id: int):
+        """حذف user_data یک کاربر"""
+        with self.connection() as conn:
+            conn.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+    
+    # ==================== ارسال همگانی ====================
+    
+    def create_broadcast(self, admin_id: int, text: str, report_chat_id: int,
+                         report_message_id: int, owner: str, now: str) -> Optional[Dict]:
+        """
+        ثبت ارسال همگانی جدید (در اختیار پروسه‌ی owner) با تعداد گیرندگان فعلی
+        None اگر ارسال دیگری در حال انجام باشد؛ ایندکس یکتای idx_broadcasts_running شروع همزمان را هم رد می‌کند.
+        کاربران بلاک‌شده و کاربرانی که ربات را بلاک کرده‌اند شمرده نمی‌شوند.
+        """
+        broadcast_id = uuid.uuid4().hex
+        with self.connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO broadcasts (broadcast_id, admin_id, text, total, report_chat_id,
+                                        report_message_id, owner, heartbeat)
+                SELECT ?, ?, ?, (SELECT COUNT(*) FROM users WHERE is_blocked = 0 AND bot_blocked = 0), ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM broadcasts WHERE status = 'running')
+                ON CONFLICT DO NOTHING
+            ''', (broadcast_id, admin_id, text, report_chat_id, report_message_id, owner, now))
+            if cursor.rowcount <= 0:
+                return None
+            row = conn.execute('SELECT * FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,)).fetchone()
+        return dict(row)
+    
+    def get_broadcast(self, broadcast_id: str) -> Optional[Dict]:
+        """دریافت یک ارسال همگانی"""
+        with self.connection() as conn:
+            row = conn.execute('SELECT * FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def get_running_broadcast(self) -> Optional[Dict]:
+        """قدیمی‌ترین ارسال همگانی ناتمام"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM broadcasts WHERE status = 'running' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+        return dict(row) if row else None
+    
+    def get_broadcast_recipients(self, after_user_id: int, limit: int) -> List[int]:
+        """
+        دسته‌ی بعدی گیرندگان پس از after_user_id (کاربران بلاک‌شده و کاربرانی که ربات را بلاک کرده‌اند حذف می‌شوند)
+        پیمایش keyset روی کلید اصلی هزینه‌ی هر دسته را مستقل از جایگاه آن نگه می‌دارد.
+        """
+        with self.connection() as conn:
+            rows = conn.execute(
+                'SELECT user_id FROM users WHERE user_id > ? AND is_blocked = 0 AND bot_blocked = 0 '
+                'ORDER BY user_id LIMIT ?',
+                (after_user_id, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def claim_broadcast(self, broadcast_id: str, owner: str, now: str, stale_before: str) -> bool:
+        """در اختیار گرفتن ارسال ناتمامی که صاحبی ندارد یا صاحب آن از stale_before خبری نداده است"""
+        with self.connection() as conn:
+            cursor = conn.execute('''
+                UPDATE broadcasts SET owner = ?, heartbeat = ?
+                WHERE broadcast_id = ? AND status = 'running'
+                  AND (owner IS NULL OR owner = ? OR heartbeat < ?)
+            ''', (owner, now, broadcast_id, owner, stale_before))
+            affected = cursor.rowcount
+        return affected > 0
+    
+    def renew_broadcast(self, broadcast_id: str, owner: str, now: str) -> bool:
+        """تمدید lease ارسال همگانی؛ False یعنی ارسال لغو شده یا در اختیار پروسه‌ی دیگری است"""
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE broadcasts SET heartbeat = ? WHERE broadcast_id = ? AND status = 'running' AND owner = ?",
+                (now, broadcast_id, owner)
+            )
+            affected = cursor.rowcount
+        return affected > 0
+    
+    def save_broadcast_progress(self, broadcast_id: str, owner: str, cursor_user_id: int,
+                                delivered: int, failed: int, now: str,
+                                unreachable: Sequence[int] = ()) -> bool:
+        """
+        ثبت یک دسته‌ی ارسال‌شده؛ False یعنی ارسال لغو شده یا در اختیار پروسه‌ی دیگری است
+        unreachable: کاربرانی که ربات را بلاک کرده‌اند و از ارسال‌های بعدی حذف می‌شوند
+        """
+        with self.connection() as conn:
+            if unreachable:
+                placeholders = ','.join('?' * len(unreachable))
+                conn.execute(
+                    f'UPDATE users SET bot_blocked = 1 WHERE user_id IN ({placeholders})',
+                    tuple(unreachable)
+                )
+            cursor = conn.execute('''
+                UPDATE broadcasts
+                SET cursor_user_id = ?, delivered = delivered + ?, failed = failed + ?, heartbeat = ?
+                WHERE broadcast_id = ? AND status = 'running' AND owner = ?
+            ''', (cursor_user_id, delivered, failed, now, broadcast_id, owner))
+            affected = cursor.rowcount
+        return affected > 0
+    
+    def finish_broadcast(self, broadcast_id: str, status: str, now: str) -> bool:
+        """پایان ارسال همگانی با وضعیت done یا cancelled"""
+        with self.connection() as conn:
+            cursor = conn.execute('''
+                UPDATE broadcasts SET status = ?, finished_at = ?, owner = NULL
+                WHERE broadcast_id = ? AND status = 'running'
+            ''', (status, now, broadcast_id))
+            affected = cursor.rowcount
+        return affected > 0
+    
+    def release_broadcast(self, broadcast_id: str, owner: str) -> bool:
+        """رها کردن ارسال ناتمام هنگام خاموش شدن تا پروسه‌ی بعدی بلافاصله آن را ادامه دهد"""
+        with self.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE broadcasts SET owner = NULL WHERE broadcast_id = ? AND owner = ? AND status = 'running'",
+                (broadcast_id, owner)
+            )
+            affected = cursor.rowcount
+        return affected > 0
+    
+    # ==================== نگهداری و بایگانی ====================
+    
+    def get_expired_chats(self, before: str, limit: int) -> List[Dict]:
+        """
+        گفتگوهای غیرفعالی که از زمان before به بعد پیامی نداشته‌اند، همراه با همه‌ی پیام‌هایشان
+        (برای نوشتن در بایگانی پیش از حذف)
+        """
+        with self.connection() as conn:
+            chats = conn.execute('''
+                SELECT c.chat_id, c.user_id, c.chat_name, c.created_at, c.model, c.summary
+                FROM chats c
+                WHERE c.is_active = 0 AND c.created_at < ?
+                  AND COALESCE(
+                      (SELECT m.created_at FROM messages m WHERE m.chat_id = c.chat_id
+                       ORDER BY m.message_id DESC LIMIT 1),
+                      c.created_at
+                  ) < ?
+                LIMIT ?
+            ''', (before, before, limit)).fetchall()
+            
+            records = []
+            for chat in chats:
+                record = dict(chat)
+                record['messages'] = [dict(row) for row in conn.execute(
+                    'SELECT role, content, created_at, archived FROM messages '
+                    'WHERE chat_id = ? ORDER BY message_id',
+                    (chat['chat_id'],)
+                ).fetchall()]
+                records.append(record)
+        return records
+    
+    def purge_chats(self, chat_ids: List[str]) -> int:
+        """حذف گفتگوهای بایگانی‌شده و پیام‌هایشان (گفتگویی که دوباره فعال شده حذف نمی‌شود)"""
+        if not chat_ids:
+            return 0
+        placeholders = ','.join('?' * len(chat_ids))
+        params = tuple(chat_ids)
+        with self.connection() as conn:
+            conn.execute(
+                f'DELETE FROM messages WHERE chat_id IN ('
+                f'SELECT chat_id FROM chats WHERE chat_id IN ({placeholders}) AND is_active = 0)',
+                params
+            )
+            cursor = conn.execute(
+                f'DELETE FROM chats WHERE chat_id IN ({placeholders}) AND is_active = 0',
+                params
+            )
+            affected = cursor.rowcount
+        return affected
+    
+    def get_expired_summarized_messages(self, before: str, limit: int) -> List[Dict]:
+        """پیام‌های خلاصه‌شده (archived = 1) قدیمی‌تر از before"""
+        with self.connection() as conn:
+            rows = conn.execute('''
+                SELECT m.message_id, m.chat_id, c.user_id, m.role, m.content, m.created_at
+                FROM messages m LEFT JOIN chats c ON c.chat_id = m.chat_id
+                WHERE m.archived = 1 AND m.created_at < ?
+                ORDER BY m.created_at
+                LIMIT ?
+            ''', (before, limit)).fetchall()
+        return [dict(row) for row in rows]
+    
+    def purge_summarized_messages(self, message_ids: List[int]) -> int:
+        """حذف پیام‌های خلاصه‌شده‌ی بایگانی‌شده"""
+        if not message_ids:
+            return 0
+        placeholders = ','.join('?' * len(message_ids))
+        with self.connection() as conn:
+            cursor = conn.execute(
+                f'DELETE FROM messages WHERE message_id IN ({placeholders}) AND archived = 1',
+                tuple(message_ids)
+            )
+            affected = cursor.rowcount
+        return affected
+    
+    def prune_daily_usage(self, before: str) -> int:
+        """حذف آمار روزهای پیش از before (YYYY-MM-DD)"""
+        with self.connection() as conn:
+            cursor = conn.execute('DELETE FROM daily_usage WHERE usage_date < ?', (before,))
+            affected = cursor.rowcount
+        return affected
+    
+    def get_storage_size(self) -> Tuple[int, int]:
+        """حجم دیتابیس و فضای آزاد داخل آن (بایت)"""
+        with self.connection() as conn:
+            return self.backend.database_size(conn)
+    
+    def optimize_storage(self, full: bool = False):
+        """به‌روزرسانی آمار برنامه‌ریز کوئری (ANALYZE / PRAGMA optimize)"""
+        with self.connection() as conn:
+            self.backend.optimize(conn, full)
+    
+    def reclaim_storage(self, full: bool = False, max_pages: int = 0):
+        """آزادسازی فضای ردیف‌های حذف‌شده (incremental vacuum یا VACUUM کامل)"""
+        with self.connection() as conn:
+            self.backend.reclaim_space(conn, full, max_pages)
+
+
+class AsyncDatabase:
+    """
+    نسخه‌ی غیرهمزمان Database برای هندلرهای async
+    کوئری‌های خواندنی در چند ترد و همه‌ی نوشتن‌ها در یک ترد نویسنده‌ی واحد اجرا می‌شوند
+    تا حلقه‌ی رویداد هیچ‌وقت پشت I/O دیسک متوقف نشود.
+    """
+    
+    # متدهایی که فقط می‌خوانند؛ بقیه در ترد نویسنده اجرا می‌شوند
+    READ_METHODS = frozenset({
+        'get_user_state',
+        'is_user_blocked',
+        'get_user_limit',
+        'get_all_users',
+        'get_active_chat',
+        'get_active_chat_id',
+        'get_active_chat_model',
+        'get_user_chats',
+        'get_user_chats_page',
+        'get_user_chat',
+        'count_user_chats',
+        'get_users_page',
+        'search_users',
+        'get_chat_messages',
+        'get_recent_messages',
+        'get_context_window',
+        'get_history_tokens',
+        'get_compaction_batch',
+        'get_daily_usage',
+        'can_send_message',
+        'get_user_stats',
+        'get_all_user_data',
+        'get_user_data',
+        'get_expired_chats',
+        'get_expired_summarized_messages',
+        'get_broadcast',
+        'get_running_broadcast',
+        'get_broadcast_recipients',
+        'get_storage_size',
+        'sync_user_cache',
+    })
+    
+    # متدهایی که با کش گرم وضعیت کاربر بدون دسترسی به دیسک پاسخ می‌دهند (پاسخ از روی رکورد کش)
+    USER_STATE_METHODS = {
+        'get_user_state': lambda state: state,
+        'is_user_blocked': lambda state: state['is_blocked'],
+        'get_user_limit': lambda state: state['daily_limit'],
+        'get_active_chat_id': lambda state: state['active_chat_id'],
+        'get_active_chat_model': lambda state: state['active_chat_model'],
+        'get_daily_usage': lambda state: state['usage'],
+        'can_send_message': Database.quota_status,
+    }
+    
+    # متدهایی که با بافر نوشتن فعال فقط در حافظه اجرا می‌شوند
+    BUFFERED_METHODS = frozenset({
+        'add_message',
+        'record_turn',
+    })
+    
+    def __init__(self, database: Database, read_workers: int = DB_READ_WORKERS):
+        self.db = database
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(
+            max_workers=max(1, read_workers),
+            thread_name_prefix='db-reader'
+        )
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_now: Optional[asyncio.Event] = None
+        self._sync_task: Optional[asyncio.Task] = None
+        # کارهای در صف یا در حال اجرای تردهای دیتابیس
+        self.pending_reads = 0
+        self.pending_writes = 0
+    
+    def start_write_behind(self, interval: float = WRITE_BEHIND_INTERVAL,
+                           batch: int = WRITE_BEHIND_BATCH):
+        """فعال کردن بافر نوشتن پیام‌ها و flush دوره‌ای آن (در post_init اپلیکیشن)"""
+        if not WRITE_BEHIND or self._flush_task is not None:
+            return
+        self.db.write_buffer = WriteBehindBuffer(batch)
+        self.db.known_users.batching = True
+        self._flush_now = asyncio.Event()
+        self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop(interval))
+    
+    async def _flush_loop(self, interval: float):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                # flush در ترد نویسنده، به ترتیب با بقیه‌ی نوشتن‌ها
+                await self.flush_writes()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}")
+    
+    async def ensure_user(self, user_id: int, username: str = None, first_name: str = None):
+        """ثبت کاربر؛ کاربران شناخته‌شده بدون دسترسی به دیتابیس و بقیه با upsert در ترد نویسنده"""
+        if self.db.ensure_known_user(user_id, username, first_name):
+            return
+        await self.write_user(user_id, username, first_name)
+    
+    def start_cache_sync(self, interval: float = USER_CACHE_SYNC_INTERVAL):
+        """همگام‌سازی دوره‌ای کش وضعیت کاربران با تغییرات پروسه‌های دیگر (فقط با backend مشترک)"""
+        if not self.db.backend.shared or interval <= 0 or USER_CACHE_SIZE <= 0 or self._sync_task is not None:
+            return
+        self._sync_task = asyncio.get_running_loop().create_task(self._sync_loop(interval))
+    
+    async def _sync_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await self.sync_user_cache():
+                    logger.info("User state cache cleared after a change in another process")
+            except Exception as e:
+                logger.error(f"User cache sync failed: {e}")
+    
+    async def run(self, func, *args, write: bool = True, **kwargs):
+        """اجرای یک تابع دلخواه روی دیتابیس در ترد مناسب"""
+        executor = self._writer if write else self._readers
+        loop = asyncio.get_running_loop()
+        if write:
+            self.pending_writes += 1
+        else:
+            self.pending_reads += 1
+        try:
+            return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+        finally:
+            if write:
+                self.pending_writes -= 1
+            else:
+                self.pending_reads -= 1
+    
+    def stats(self) -> Dict:
+        """عمق صف تردهای دیتابیس و وضعیت بافر نوشتن"""
+        buffer = self.db.write_buffer
+        return {
+            'pending_reads': self.pending_reads,
+            'pending_writes': self.pending_writes,
+            'buffered_messages': len(buffer) if buffer is not None else 0,
+            'flushes': buffer.flushes if buffer is not None else 0,
+            'flushed_rows': buffer.flushed_rows if buffer is not None else 0,
+        }
+    
+    def __getattr__(self, name: str):
+        func = getattr(self.db, name)
+        if not callable(func) or name.startswith('_'):
+            return func
+        # زمان اجرای هر متد (بدون زمان انتظار در صف ترد)
+        func = timed(func, DB_SECONDS, method=name)
+        write = name not in self.READ_METHODS
+        from_state = self.USER_STATE_METHODS.get(name)
+        buffered = name in self.BUFFERED_METHODS
+        
+        async def method(*args, **kwargs):
+            # پاسخ مستقیم از رکورد کش، بدون رفت‌وبرگشت به ترد دیتابیس؛ miss همیشه به استخر خواندن می‌رود
+            if from_state is not None and args:
+                state = self.db.cached_user_state(args[0])
+                if state is not None:
+                    return from_state(state)
+            buffer = self.db.write_buffer
+            if buffered and buffer is not None:
+                result = func(*args, **kwargs)
+                if buffer.is_full():
+                    self._flush_now.set()
+                return result
+            return await self.run(func, *args, write=write, **kwargs)
+        
+        method.__name__ = name
+        method.__doc__ = func.__doc__
+        # کش کردن wrapper برای فراخوانی‌های بعدی
+        setattr(self, name, method)
+        return method
+    
+    def close(self):
+        """منتظر ماندن برای کارهای در صف، نوشتن بافر و بستن تردها و اتصال‌ها"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.db.flush_writes()
+        self.db.write_buffer = None
+        self.db.known_users.batching = False
+        self.db.close()
 
 
 # نمونه singleton
 db = Database()
+async_db = AsyncDatabase(db)
+registry.register_stats('user_cache', db.user_cache.stats)
+registry.register_stats('known_users', db.known_users.stats)
+registry.register_stats('db', async_db.stats)
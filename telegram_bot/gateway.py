@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+درگاه webhook برای اجرای چند پروسه‌ی ربات
+Webhook gateway that routes each user's updates to a fixed worker process
+"""
+
+import hashlib
+import json
+import logging
+from typing import List, Optional
+
+import httpx
+import tornado.ioloop
+import tornado.web
+
+from config import (
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WORKER_URLS,
+)
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_user_id(update: dict) -> Optional[int]:
+    """شناسه‌ی کاربر فرستنده‌ی آپدیت (message، callback_query و ...)"""
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user') or value.get('chat') or {}
+        if 'id' in sender:
+            return sender['id']
+    return None
+
+
+def workers_for(key: int, workers: List[str]) -> List[str]:
+    """
+    ترتیب workerها برای یک کاربر با rendezvous hashing
+    هر کاربر همیشه به یک worker می‌رود و با اضافه یا حذف شدن یک worker
+    فقط کاربران همان worker جابجا می‌شوند.
+    """
+    def score(worker: str) -> int:
+        return int.from_bytes(hashlib.sha1(f'{worker}:{key}'.encode()).digest()[:8], 'big')
+    return sorted(workers, key=score, reverse=True)
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """دریافت آپدیت از تلگرام و ارسال آن به worker کاربر"""
+    
+    def initialize(self, client: httpx.AsyncClient, workers: List[str]):
+        self.client = client
+        self.workers = workers
+    
+    async def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            raise tornado.web.HTTPError(403)
+        
+        try:
+            update = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        
+        key = update_user_id(update)
+        if key is None:
+            key = update.get('update_id', 0)
+        
+        headers = {'Content-Type': 'application/json'}
+        if WEBHOOK_SECRET:
+            headers[SECRET_HEADER] = WEBHOOK_SECRET
+        
+        # در صورت در دسترس نبودن worker اصلی، worker بعدی در همان ترتیب امتحان می‌شود
+        for worker in workers_for(key, self.workers):
+            try:
+                response = await self.client.post(worker, content=self.request.body, headers=headers)
+            except httpx.TransportError as e:
+                logger.warning(f"Worker {worker} unavailable ({e!r}), trying next")
+                continue
+            self.set_status(response.status_code)
+            return
+        
+        # تلگرام آپدیت را بعداً دوباره ارسال می‌کند
+        raise tornado.web.HTTPError(502)
+
+
+def main():
+    """اجرای درگاه"""
+    if not WORKER_URLS:
+        raise SystemExit("WORKER_URLS is not set")
+    
+    client = httpx.AsyncClient(timeout=30)
+    url_path = '/' + WEBHOOK_PATH.strip('/')
+    app = tornado.web.Application([
+        (url_path, WebhookHandler, {'client': client, 'workers': WORKER_URLS}),
+    ])
+    app.listen(WEBHOOK_PORT, address=WEBHOOK_LISTEN)
+    logger.info(f"Gateway listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{url_path} -> {len(WORKER_URLS)} workers")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+نگهداری دیتابیس: بایگانی و حذف داده‌های قدیمی، به‌روزرسانی آمار و آزادسازی فضا
+Retention, archival and vacuum maintenance for the bot database
+"""
+
+import asyncio
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Optional, List, Dict, Tuple
+
+from config import (
+    MAINTENANCE_INTERVAL,
+    RETENTION_CHAT_DAYS,
+    RETENTION_SUMMARIZED_DAYS,
+    RETENTION_USAGE_DAYS,
+    ARCHIVE_DIR,
+    ARCHIVE_COMPRESSION,
+    ARCHIVE_BATCH,
+    VACUUM_PAGES,
+)
+from database import async_db
+from metrics import registry
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = {
+    'zstd': 'zst',
+    'gzip': 'gz',
+}
+
+
+def cutoff(days: int, date_only: bool = False) -> str:
+    """زمان days روز پیش (UTC) در همان قالب ستون‌های created_at و usage_date"""
+    moment = time.gmtime(time.time() - days * 86400)
+    return time.strftime('%Y-%m-%d' if date_only else '%Y-%m-%d %H:%M:%S', moment)
+
+
+def format_size(num_bytes: int) -> str:
+    """نمایش خوانای حجم"""
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+class ChatArchive:
+    """
+    نوشتن رکوردهای بایگانی به صورت JSONL فشرده، هر دسته در یک فایل جداگانه
+    فایل پیش از حذف ردیف‌ها از دیتابیس کامل روی دیسک نوشته (fsync) و سپس هم‌نام نهایی می‌شود،
+    پس قطع برنامه در میانه‌ی کار داده‌ای را از بین نمی‌برد.
+    """
+    
+    def __init__(self, directory: str = ARCHIVE_DIR, compression: str = ARCHIVE_COMPRESSION):
+        if compression == 'zstd' and zstandard is None:
+            logger.warning("zstandard is not installed; archiving with gzip")
+            compression = 'gzip'
+        if compression not in ARCHIVE_EXTENSIONS:
+            raise ValueError(f"Unknown archive compression: {compression}")
+        self.directory = directory
+        self.compression = compression
+        self._sequence = itertools.count(1)
+    
+    def _compressed(self, raw) -> io.TextIOWrapper:
+        if self.compression == 'zstd':
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        else:
+            stream = gzip.GzipFile(fileobj=raw, mode='wb')
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    
+    def write(self, kind: str, records: List[Dict]) -> str:
+        """نوشتن یک دسته رکورد؛ مسیر فایل ساخته‌شده"""
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        name = f'{kind}-{stamp}-{os.getpid()}-{next(self._sequence)}.jsonl.{ARCHIVE_EXTENSIONS[self.compression]}'
+        path = os.path.join(self.directory, name)
+        partial = path + '.part'
+        
+        with open(partial, 'wb') as raw:
+            with self._compressed(raw) as stream:
+                for record in records:
+                    stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(partial, path)
+        return path
+
+
+class DatabaseMaintenance:
+    """
+    اجرای دوره‌ای (و دستی با /maintenance) نگهداری دیتابیس:
+    بایگانی و حذف گفتگوهای غیرفعال قدیمی و پیام‌های خلاصه‌شده، حذف آمار روزانه‌ی قدیمی،
+    آزادسازی فضا (incremental vacuum) و به‌روزرسانی آمار برنامه‌ریز کوئری.
+    بایگانی در ترد نویسنده‌ی دیتابیس و در دسته‌های کوچک انجام می‌شود تا نوشتن‌های ربات
+    بین دسته‌ها ادامه یابند.
+    """
+    
+    def __init__(self, interval_hours: float = MAINTENANCE_INTERVAL,
+                 chat_days: int = RETENTION_CHAT_DAYS,
+                 summarized_days: int = RETENTION_SUMMARIZED_DAYS,
+                 usage_days: int = RETENTION_USAGE_DAYS,
+                 batch: int = ARCHIVE_BATCH, vacuum_pages: int = VACUUM_PAGES):
+        self.interval = interval_hours * 3600
+        self.chat_days = chat_days
+        self.summarized_days = summarized_days
+        self.usage_days = usage_days
+        self.batch = max(1, batch)
+        self.vacuum_pages = vacuum_pages
+        self._archive: Optional[ChatArchive] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        
+        # آمار
+        self.runs = 0
+        self.last_report: Optional[Dict] = None
+    
+    @property
+    def archive(self) -> ChatArchive:
+        if self._archive is None:
+            self._archive = ChatArchive()
+        return self._archive
+    
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+    
+    def start(self):
+        """شروع اجرای دوره‌ای (در post_init اپلیکیشن)"""
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except Exception as e:
+                logger.error(f"Database maintenance failed: {e}")
+    
+    # ==================== دسته‌ها (در ترد نویسنده) ====================
+    
+    def _archive_chats(self, before: str) -> Tuple[int, int]:
+        """بایگانی و حذف یک دسته گفتگو؛ (تعداد حذف‌شده، تعداد انتخاب‌شده)"""
+        db = async_db.db
+        records = db.get_expired_chats(before, self.batch)
+        if not records:
+            return 0, 0
+        self.archive.write('chats', records)
+        return db.purge_chats([record['chat_id'] for record in records]), len(records)
+    
+    def _archive_summarized(self, before: str) -> Tuple[int, int]:
+        """بایگانی و حذف یک دسته پیام خلاصه‌شده؛ (تعداد حذف‌شده، تعداد انتخاب‌شده)"""
+        db = async_db.db
+        records = db.get_expired_summarized_messages(before, self.batch)
+        if not records:
+            return 0, 0
+        self.archive.write('messages', records)
+        return db.purge_summarized_messages([record['message_id'] for record in records]), len(records)
+    
+    async def _drain(self, step, before: str) -> int:
+        total = 0
+        while True:
+            purged, selected = await async_db.run(step, before)
+            total += purged
+            if selected < self.batch or purged == 0:
+                return total
+    
+    # ==================== اجرا ====================
+    
+    async def run(self, full: bool = False) -> Dict:
+        """
+        یک دور کامل نگهداری و گزارش آن
+        full: اجرای VACUUM و ANALYZE کامل (کند؛ دیتابیس قدیمی را به auto_vacuum افزایشی تبدیل می‌کند)
+        """
+        async with self._lock:
+            started = time.monotonic()
+            size_before, _ = await async_db.get_storage_size()
+            # پیام‌های بافر شده باید پیش از انتخاب گفتگوهای منقضی در دیتابیس باشند
+            await async_db.flush_writes()
+            
+            report = {'chats': 0, 'messages': 0, 'usage': 0}
+            if self.chat_days > 0:
+                report['chats'] = await self._drain(self._archive_chats, cutoff(self.chat_days))
+            if self.summarized_days > 0:
+                report['messages'] = await self._drain(
+                    self._archive_summarized, cutoff(self.summarized_days)
+                )
+            if self.usage_days > 0:
+                report['usage'] = await async_db.prune_daily_usage(cutoff(self.usage_days, date_only=True))
+            
+            await async_db.reclaim_storage(full, self.vacuum_pages)
+            await async_db.optimize_storage(full)
+            size_after, free_after = await async_db.get_storage_size()
+            
+            report.update({
+                'size_before': size_before,
+                'size_after': size_after,
+                'free_after': free_after,
+                'reclaimed': max(0, size_before - size_after),
+                'seconds': time.monotonic() - started,
+            })
+            self.runs += 1
+            self.last_report = report
+            logger.info(
+                f"Database maintenance: archived {report['chats']} chats and {report['messages']} "
+                f"summarized messages, pruned {report['usage']} usage rows, "
+                f"reclaimed {format_size(report['reclaimed'])}"
+            )
+            return report
+    
+    def stats(self) -> Dict:
+        """آمار نگهداری: تعداد اجراها و نتیجه‌ی آخرین اجرا"""
+        report = self.last_report or {}
+        return {
+            'running': self.running,
+            'runs': self.runs,
+            'last_reclaimed_bytes': report.get('reclaimed', 0),
+            'last_seconds': report.get('seconds', 0.0),
+        }
+    
+    async def close(self):
+        """توقف اجرای دوره‌ای (هنگام خاموش شدن)"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+# نمونه singleton
+db_maintenance = DatabaseMaintenance()
+registry.register_stats('maintenance', db_maintenance.stats)
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+شمارنده‌ها و هیستوگرام‌های کارایی، endpoint ‏/metrics و خلاصه‌ی /perf
+Prometheus-style metrics, a local /metrics endpoint and the /perf summary
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from config import (
+    METRICS_LISTEN,
+    METRICS_PORT,
+)
+
+logger = logging.getLogger(__name__)
+
+# مرزهای پیش‌فرض هیستوگرام‌های زمان (ثانیه)
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+# حداکثر ترکیب برچسب‌ها در هر متریک؛ ترکیب‌های بیشتر در برچسب «other» جمع می‌شوند
+MAX_SERIES = 500
+
+STARTED_AT = time.monotonic()
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """برچسب‌ها در قالب متنی Prometheus"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + '}'
+
+
+def format_seconds(seconds: float) -> str:
+    """نمایش خوانای مدت زمان"""
+    if seconds < 0.001:
+        return f'{seconds * 1e6:.0f}µs'
+    if seconds < 0.01:
+        return f'{seconds * 1000:.1f}ms'
+    if seconds < 1:
+        return f'{seconds * 1000:.0f}ms'
+    return f'{seconds:.2f}s'
+
+
+class Metric:
+    """پایه‌ی متریک‌های برچسب‌دار (امن برای استفاده از چند ترد)"""
+    
+    type = 'untyped'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: Dict) -> tuple:
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        if key not in self._values and len(self._values) >= MAX_SERIES:
+            return ('other',) * len(self.labelnames)
+        return key
+    
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+    
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """شمارنده‌ی افزایشی"""
+    
+    type = 'counter'
+    
+    def inc(self, amount: float = 1.0, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0.0) + amount
+    
+    def samples(self) -> Dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+    
+    def render(self) -> List[str]:
+        return [
+            f'{self.name}{format_labels(self._labels(key))} {value:g}'
+            for key, value in sorted(self.samples().items())
+        ]
+
+
+class Histogram(Metric):
+    """هیستوگرام با مرزهای ثابت؛ صدک‌ها از روی مرزها تخمین زده می‌شوند"""
+    
+    type = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            data = self._values.get(key)
+            if data is None:
+                # [تعداد هر بازه (آخری: بیشتر از بزرگ‌ترین مرز), مجموع, تعداد]
+                data = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+    
+    def time(self, **labels):
+        """context manager برای اندازه‌گیری زمان یک بلوک"""
+        return _Timer(self, labels)
+    
+    def samples(self) -> Dict[tuple, Tuple[List[int], float, int]]:
+        with self._lock:
+            return {key: (list(data[0]), data[1], data[2]) for key, data in self._values.items()}
+    
+    def quantile(self, counts: List[int], q: float) -> float:
+        """تخمین صدک q با درون‌یابی خطی داخل بازه"""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        target = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= target and count:
+                if index >= len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (target - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+    
+    def summary(self) -> List[Dict]:
+        """خلاصه‌ی هر ترکیب برچسب: تعداد، مجموع، میانگین، p50 و p95"""
+        result = []
+        for key, (counts, total, count) in self.samples().items():
+            result.append({
+                **self._labels(key),
+                'count': count,
+                'sum': total,
+                'avg': total / count if count else 0.0,
+                'p50': self.quantile(counts, 0.5),
+                'p95': self.quantile(counts, 0.95),
+            })
+        return result
+    
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self.samples().items()):
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels({**labels, "le": f"{bound:g}"})} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_labels({**labels, "le": "+Inf"})} {count}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total:.6f}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Registry:
+    """
+    مجموعه‌ی متریک‌ها و منابع آمار
+    منابع آمار توابعی مانند upstream_scheduler.stats هستند که هنگام خواندن /metrics
+    فراخوانی می‌شوند و مقادیر عددی آن‌ها به صورت gauge نمایش داده می‌شود.
+    """
+    
+    def __init__(self, prefix: str = 'bot'):
+        self.prefix = prefix
+        self._metrics: List[Metric] = []
+        self._stats: List[Tuple[str, Callable, Tuple[str, ...]]] = []
+    
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(f'{self.prefix}_{name}', documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(f'{self.prefix}_{name}', documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def register_stats(self, name: str, source: Callable, label_keys: Sequence[str] = ()):
+        """
+        ثبت تابع آمار (خروجی dict یا لیستی از dict)
+        label_keys: کلیدهایی که به جای مقدار، برچسب هر ردیف هستند (مثلاً نام backend)
+        """
+        self._stats.append((name, source, tuple(label_keys)))
+    
+    def collect_stats(self) -> List[Tuple[str, List[Tuple[Dict[str, str], Dict[str, float]]]]]:
+        """خواندن همه‌ی منابع آمار: [(نام، [(برچسب‌ها، مقادیر عددی)])]"""
+        collected = []
+        for name, source, label_keys in self._stats:
+            try:
+                result = source()
+            except Exception as e:
+                logger.warning(f"Stats source {name} failed: {e}")
+                continue
+            rows = []
+            for item in (result if isinstance(result, list) else [result]):
+                labels = {k: str(item.get(k)) for k in label_keys}
+                values = {
+                    k: float(v) for k, v in item.items()
+                    if k not in label_keys and isinstance(v, (int, float))
+                }
+                rows.append((labels, values))
+            collected.append((name, rows))
+        return collected
+    
+    def render(self) -> str:
+        """همه‌ی متریک‌ها در قالب متنی Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        
+        gauges: Dict[str, List[str]] = {}
+        for name, rows in self.collect_stats():
+            for labels, values in rows:
+                for key, value in values.items():
+                    gauges.setdefault(f'{self.prefix}_{name}_{key}', []).append(
+                        f'{format_labels(labels)} {value:g}'
+                    )
+        for gauge, samples in gauges.items():
+            lines.append(f'# TYPE {gauge} gauge')
+            lines.extend(f'{gauge}{sample}' for sample in samples)
+        
+        lines.append(f'# TYPE {self.prefix}_uptime_seconds gauge')
+        lines.append(f'{self.prefix}_uptime_seconds {time.monotonic() - STARTED_AT:.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+# نمونه singleton
+registry = Registry()
+
+# ==================== متریک‌های مسیرهای پرتکرار ====================
+
+UPDATE_SECONDS = registry.histogram(
+    'update_seconds', 'Update handling time by handler and callback type', ('handler', 'kind')
+)
+UPDATE_ERRORS = registry.counter(
+    'update_errors_total', 'Updates whose handler raised an exception', ('handler',)
+)
+DB_SECONDS = registry.histogram(
+    'db_query_seconds', 'Database method execution time', ('method',)
+)
+UPSTREAM_SECONDS = registry.histogram(
+    'upstream_request_seconds', 'Upstream API request time (stream: until the last chunk)', ('model', 'mode')
+)
+UPSTREAM_TTFT = registry.histogram(
+    'upstream_ttft_seconds', 'Time to the first streamed chunk', ('model',)
+)
+UPSTREAM_RESPONSES = registry.counter(
+    'upstream_responses_total', 'Upstream API responses by HTTP status or error type', ('model', 'status')
+)
+
+
+def timed(func: Callable, histogram: Histogram, **labels) -> Callable:
+    """نسخه‌ی زمان‌دار یک تابع همزمان (برای اجرا در تردهای دیتابیس)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started, **labels)
+    return wrapper
+
+
+def timed_handler(func: Callable) -> Callable:
+    """اندازه‌گیری زمان هندلر آپدیت؛ برای callbackها پیشوند data به عنوان نوع ثبت می‌شود"""
+    name = func.__name__
+    for suffix in ('_handler', '_command'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        kind = ''
+        query = getattr(update, 'callback_query', None)
+        if query is not None and isinstance(query.data, str):
+            kind = query.data.split(':', 1)[0][:32]
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception:
+            UPDATE_ERRORS.inc(handler=name)
+            raise
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started, handler=name, kind=kind)
+    return wrapper
+
+
+# ==================== خلاصه‌ی /perf ====================
+
+def _format_value(value: float) -> str:
+    if value == int(value) and abs(value) < 1e12:
+        return str(int(value))
+    return f'{value:.3g}'
+
+
+def _timing_lines(rows: List[Dict], label: Callable[[Dict], str], key: str, limit: int) -> List[str]:
+    rows = sorted(rows, key=lambda r: r[key], reverse=True)[:limit]
+    return [
+        f"• {label(r)}: {r['count']}× میانگین {format_seconds(r['avg'])} · p95 {format_seconds(r['p95'])}"
+        for r in rows
+    ]
+
+
+def perf_summary(limit: int = 8) -> str:
+    """خلاصه‌ی متنی متریک‌ها برای دستور /perf ادمین"""
+    uptime = int(time.monotonic() - STARTED_AT)
+    lines = [f'📈 کارایی ربات (مدت اجرا: {uptime // 3600}h {uptime % 3600 // 60}m)']
+    
+    handlers = UPDATE_SECONDS.summary()
+    if handlers:
+        lines.append('\n⏱ هندلرها:')
+        lines += _timing_lines(
+            handlers, lambda r: r['handler'] + (f"/{r['kind']}" if r['kind'] else ''), 'count', limit
+        )
+    
+    queries = DB_SECONDS.summary()
+    if queries:
+        lines.append('\n🗄 دیتابیس (بیشترین زمان کل):')
+        lines += _timing_lines(queries, lambda r: r['method'], 'sum', limit)
+    
+    upstream = UPSTREAM_SECONDS.summary()
+    if upstream:
+        lines.append('\n🌐 API:')
+        lines += _timing_lines(upstream, lambda r: f"{r['model']} ({r['mode']})", 'count', limit)
+        for r in sorted(UPSTREAM_TTFT.summary(), key=lambda r: r['count'], reverse=True)[:limit]:
+            lines.append(f"• TTFT {r['model']}: p50 {format_seconds(r['p50'])} · p95 {format_seconds(r['p95'])}")
+        statuses: Dict[str, float] = {}
+        for (model, status), count in UPSTREAM_RESPONSES.samples().items():
+            statuses[status] = statuses.get(status, 0) + count
+        if statuses:
+            lines.append('• وضعیت‌ها: ' + ', '.join(
+                f'{status}={_format_value(count)}' for status, count in sorted(statuses.items())
+            ))
+    
+    stats = registry.collect_stats()
+    if stats:
+        lines.append('\n📦 صف‌ها و کش‌ها:')
+        for name, rows in stats:
+            for labels, values in rows:
+                title = name + (f" [{', '.join(labels.values())}]" if labels else '')
+                text = ', '.join(f'{k}={_format_value(v)}' for k, v in values.items())
+                lines.append(f'• {title}: {text}')
+    
+    text = '\n'.join(lines)
+    return text if len(text) <= 4000 else text[:3990] + '\n…'
+
+
+# ==================== endpoint ‏/metrics ====================
+
+_server: Optional[asyncio.AbstractServer] = None
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """پاسخ به GET /metrics (HTTP/1.1 ساده، یک درخواست در هر اتصال)"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # نادیده گرفتن هدرها
+        while True:
+            header = await asyncio.wait_for(reader.readline(), 5)
+            if header in (b'\r\n', b'\n', b''):
+                break
+        
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', registry.render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = METRICS_LISTEN, port: int = METRICS_PORT):
+    """راه‌اندازی endpoint ‏/metrics (METRICS_PORT = 0 یعنی غیرفعال)"""
+    global _server
+    if port <= 0 or _server is not None:
+        return
+    _server = await asyncio.start_server(_handle_request, host, port)
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    """بستن endpoint ‏/metrics"""
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
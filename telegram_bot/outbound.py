@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+صف ارسال پیام به تلگرام: محدودیت نرخ کل ربات و هر گفتگو، RetryAfter و اولویت پاسخ‌های نهایی
+Outbound Telegram send queue honoring global and per-chat flood limits
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE,
+    TELEGRAM_MAX_RETRIES,
+    BROADCAST_RATE,
+)
+from metrics import registry
+from scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# نشانگر انتهای متن در ویرایش‌های میانی پاسخ‌های stream
+PROGRESS_SUFFIX = ' ▌'
+
+# متدهایی که پیام در یک گفتگو می‌فرستند یا ویرایش می‌کنند و مشمول محدودیت نرخ‌اند
+MESSAGE_ENDPOINTS = frozenset({
+    'sendMessage',
+    'editMessageText',
+    'editMessageReplyMarkup',
+    'sendPhoto',
+    'sendDocument',
+    'sendChatAction',
+    'copyMessage',
+    'forwardMessage',
+})
+
+# اولویت‌ها: پیام‌ها و پاسخ‌های نهایی پیش از ویرایش‌های میانی و هر دو پیش از ارسال همگانی
+URGENT = 0
+PROGRESS = 1
+BULK = 2
+PRIORITIES = (URGENT, PROGRESS, BULK)
+
+# تعداد گفتگوهایی که سطل نرخشان در حافظه می‌ماند
+MAX_TRACKED_CHATS = 10000
+
+
+class _Waiter:
+    __slots__ = ('future', 'key', 'priority')
+    
+    def __init__(self, future: asyncio.Future, key: Optional[tuple], priority: int):
+        self.future = future
+        self.key = key
+        self.priority = priority
+
+
+def classify(endpoint: str, data: Dict[str, Any]) -> Tuple[int, Optional[tuple]]:
+    """اولویت درخواست و کلید پیام ویرایش‌شده (chat_id, message_id)"""
+    key = None
+    if endpoint == 'editMessageText' and data.get('message_id') is not None:
+        key = (data.get('chat_id'), data.get('message_id'))
+        text = data.get('text') or ''
+        if text.endswith(PROGRESS_SUFFIX):
+            return PROGRESS, key
+    return URGENT, key
+
+
+class OutboundLimiter(BaseRateLimiter[Dict[str, Any]]):
+    """
+    صف ارسال به تلگرام (rate limiter اپلیکیشن)
+    هر گفتگو صف و سطل نرخ خودش را دارد و یک سطل مشترک سقف کل ربات را نگه می‌دارد.
+    گفتگوها به نوبت سرویس می‌گیرند؛ در هر گفتگو و در سطل مشترک، پیام‌ها و پاسخ‌های نهایی
+    پیش از ویرایش‌های میانی stream ارسال می‌شوند. ویرایش میانی که پیش از ارسال با ویرایش
+    جدیدتری از همان پیام جایگزین شود اصلاً ارسال نمی‌شود. پس از RetryAfter فقط همان گفتگو
+    متوقف می‌شود و درخواست‌های فوری دوباره ارسال می‌شوند.
+    پیام‌های ارسال همگانی (BULK) آخر از همه نوبت می‌گیرند و سطل جداگانه‌ی خودشان را دارند
+    تا بخشی از سقف کل ربات همیشه برای گفتگوهای عادی آزاد بماند.
+    """
+    
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, chat_burst: float = TELEGRAM_CHAT_BURST,
+                 group_rate: float = TELEGRAM_GROUP_RATE, max_retries: int = TELEGRAM_MAX_RETRIES,
+                 bulk_rate: float = BROADCAST_RATE):
+        self.global_bucket = TokenBucket(global_rate * 60, max(1.0, global_rate))
+        self.bulk_bucket = TokenBucket(bulk_rate * 60, 1.0)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max(0, max_retries)
+        self._buckets: 'OrderedDict[Any, TokenBucket]' = OrderedDict()
+        self._queues: 'OrderedDict[Any, List[deque]]' = OrderedDict()
+        self._paused: Dict[Any, float] = {}
+        self._latest: Dict[tuple, _Waiter] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        
+        # آمار
+        self.sent = 0
+        self.superseded = 0
+        self.retry_after = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for queues in self._queues.values():
+            for queue in queues:
+                for waiter in queue:
+                    if not waiter.future.done():
+                        waiter.future.cancel()
+        self._queues.clear()
+    
+    # ==================== سطل‌ها ====================
+    
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # شناسه‌ی منفی = گروه یا کانال
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1.0)
+            else:
+                bucket = TokenBucket(self.chat_rate * 60, self.chat_burst)
+            self._buckets[chat_id] = bucket
+            while len(self._buckets) > MAX_TRACKED_CHATS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+    
+    @property
+    def queued(self) -> int:
+        return sum(
+            1 for queues in self._queues.values() for queue in queues
+            for waiter in queue if not waiter.future.done()
+        )
+    
+    # ==================== نوبت‌دهی ====================
+    
+    @staticmethod
+    def _head(queue: deque) -> Optional[_Waiter]:
+        while queue and queue[0].future.done():
+            queue.popleft()
+        return queue[0] if queue else None
+    
+    def _dispatch(self):
+        self._timer = None
+        now = time.monotonic()
+        wait = None
+        
+        def later(delay: float):
+            nonlocal wait
+            wait = delay if wait is None else min(wait, delay)
+        
+        # دورها تا وقتی ادامه می‌یابند که نوبتی داده شود؛ هر دور به هر گفتگو حداکثر یک نوبت می‌دهد
+        granted = True
+        while granted:
+            granted = False
+            for priority in PRIORITIES:
+                for chat_id in list(self._queues):
+                    queues = self._queues[chat_id]
+                    # پیام فوری همان گفتگو جلوتر از ویرایش میانی و پیام همگانی آن است
+                    if any(self._head(queues[higher]) is not None for higher in PRIORITIES[:priority]):
+                        continue
+                    waiter = self._head(queues[priority])
+                    if waiter is None:
+                        if not any(queues):
+                            del self._queues[chat_id]
+                        continue
+                    
+                    paused = self._paused.get(chat_id, 0.0) - now
+                    if paused > 0:
+                        later(paused)
+                        continue
+                    self._paused.pop(chat_id, None)
+                    
+                    bucket = self._bucket(chat_id)
+                    delay = bucket.try_take()
+                    if delay > 0:
+                        later(delay)
+                        continue
+                    if priority == BULK:
+                        delay = self.bulk_bucket.try_take()
+                        if delay > 0:
+                            bucket.tokens += 1
+                            later(delay)
+                            break
+                    delay = self.global_bucket.try_take()
+                    if delay > 0:
+                        # سقف کل پر است؛ توکن گفتگو برگردانده می‌شود و تا آزاد شدن سقف صبر می‌کنیم
+                        bucket.tokens += 1
+                        if priority == BULK:
+                            self.bulk_bucket.tokens += 1
+                        later(delay)
+                        granted = False
+                        break
+                    
+                    queues[priority].popleft()
+                    waiter.future.set_result(True)
+                    granted = True
+                    # گفتگو به انتهای نوبت می‌رود
+                    self._queues.move_to_end(chat_id)
+                else:
+                    continue
+                break
+        
+        if wait is not None and self.queued:
+            self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+    
+    def _supersede(self, key: tuple):
+        """کنار گذاشتن ویرایش میانی در صف که ویرایش جدیدتری از همان پیام دارد"""
+        previous = self._latest.pop(key, None)
+        if previous is not None and previous.priority == PROGRESS and not previous.future.done():
+            previous.future.set_result(False)
+            self.superseded += 1
+    
+    async def _acquire(self, chat_id, priority: int, key: Optional[tuple]) -> bool:
+        """انتظار تا رسیدن نوبت؛ False یعنی درخواست با درخواست جدیدتری جایگزین شد"""
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(future, key, priority)
+        if key is not None:
+            self._supersede(key)
+            self._latest[key] = waiter
+        queues = self._queues.get(chat_id)
+        if queues is None:
+            queues = self._queues[chat_id] = [deque() for _ in PRIORITIES]
+        queues[priority].append(waiter)
+        
+        started = time.monotonic()
+        self._reschedule()
+        try:
+            granted = await future
+        finally:
+            if key is not None and self._latest.get(key) is waiter:
+                del self._latest[key]
+        
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return granted
+    
+    def _reschedule(self):
+        """محاسبه‌ی دوباره‌ی نوبت‌ها (زمان انتظار تایمر قبلی ممکن است دیگر درست نباشد)"""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+    
+    def _pause(self, chat_id, seconds: float):
+        now = time.monotonic()
+        self._paused = {chat: until for chat, until in self._paused.items() if until > now}
+        self._paused[chat_id] = max(self._paused.get(chat_id, 0.0), now + seconds)
+        self._reschedule()
+    
+    # ==================== BaseRateLimiter ====================
+    
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get('chat_id')
+        if endpoint not in MESSAGE_ENDPOINTS or chat_id is None:
+            # پاسخ callbackها و متدهای مدیریتی مشمول محدودیت پیام نیستند
+            return await callback(*args, **kwargs)
+        
+        priority, key = classify(endpoint, data)
+        if rate_limit_args and 'priority' in rate_limit_args:
+            priority = rate_limit_args['priority']
+        
+        attempt = 0
+        while True:
+            if not await self._acquire(chat_id, priority, key):
+                # نتیجه‌ی True همان پاسخ تلگرام به ویرایش بدون بازگرداندن پیام است
+                return True
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                delay = float(e.retry_after)
+                logger.warning(f"Telegram flood limit for chat {chat_id}, pausing {delay}s")
+                self._pause(chat_id, delay)
+                # ویرایش‌های میانی تکرار نمی‌شوند؛ ویرایش بعدی جای آن‌ها را می‌گیرد
+                if priority == PROGRESS or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                continue
+            self.sent += 1
+            return result
+    
+    def stats(self) -> Dict:
+        """آمار صف ارسال: عمق صف، ارسال‌ها، ویرایش‌های جایگزین‌شده و RetryAfter"""
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'superseded': self.superseded,
+            'retry_after': self.retry_after,
+            'paused_chats': sum(1 for until in self._paused.values() if until > time.monotonic()),
+            'avg_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+# نمونه singleton
+outbound_limiter = OutboundLimiter()
+registry.register_stats('outbound', outbound_limiter.stats)
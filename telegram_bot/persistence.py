@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+ذخیره‌ی user_data ربات در دیتابیس مشترک
+Database-backed persistence for python-telegram-bot user_data
+"""
+
+import json
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import PERSISTENCE_INTERVAL, PERSISTENCE_CACHE_SIZE
+from database import async_db
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    persistence برای user_data (مثلاً وضعیت «در حال تنظیم محدودیت» ادمین)
+    داده‌ی هر کاربر اولین بار که آپدیتی از او به این پروسه می‌رسد از دیتابیس خوانده می‌شود،
+    پس اگر کاربر به پروسه‌ی دیگری منتقل شود وضعیتش را از دست نمی‌دهد.
+    آخرین داده‌ی ذخیره‌شده‌ی هر کاربر (LRU محدود) نگه داشته می‌شود تا داده‌ی بدون تغییر دوباره نوشته نشود.
+    """
+    
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL, max_size: int = PERSISTENCE_CACHE_SIZE):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.max_size = max(max_size, 1)
+        # user_id -> JSON آخرین داده‌ی ذخیره‌شده (None یعنی رکوردی در دیتابیس نیست)
+        self._saved = OrderedDict()
+    
+    def _remember(self, user_id: int, payload: Optional[str]):
+        self._saved[user_id] = payload
+        self._saved.move_to_end(user_id)
+        while len(self._saved) > self.max_size:
+            self._saved.popitem(last=False)
+    
+    async def get_user_data(self) -> Dict[int, Dict]:
+        # داده‌ها به صورت تنبل در refresh_user_data بارگذاری می‌شوند
+        return {}
+    
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        if user_id in self._saved:
+            self._saved.move_to_end(user_id)
+            return
+        stored = await async_db.get_user_data(user_id)
+        self._remember(user_id, json.dumps(stored, ensure_ascii=False, sort_keys=True) if stored else None)
+        for key, value in stored.items():
+            user_data.setdefault(key, value)
+    
+    async def update_user_data(self, user_id: int, data: Dict):
+        payload = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        # داده‌ی بدون تغییر (یا خالی برای کاربری که رکوردی ندارد) نوشته نمی‌شود
+        if user_id in self._saved and self._saved[user_id] == payload:
+            self._saved.move_to_end(user_id)
+            return
+        await async_db.save_user_data(user_id, dict(data))
+        self._remember(user_id, payload)
+    
+    async def drop_user_data(self, user_id: int):
+        await async_db.delete_user_data(user_id)
+        self._remember(user_id, None)
+    
+    # ==================== داده‌هایی که ذخیره نمی‌شوند ====================
+    
+    async def get_chat_data(self) -> Dict:
+        return {}
+    
+    async def get_bot_data(self) -> Dict:
+        return {}
+    
+    async def get_callback_data(self) -> Optional[tuple]:
+        return None
+    
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+    
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        pass
+    
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        pass
+    
+    async def update_bot_data(self, data: Dict):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id: int):
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+    
+    async def refresh_bot_data(self, bot_data: Dict):
+        pass
+    
+    async def flush(self):
+        pass
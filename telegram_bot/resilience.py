@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+تلاش مجدد و قطع‌کننده‌ی مدار برای درخواست‌های API
+Retry with backoff and circuit breaker for upstream calls
+"""
+
+import asyncio
+import itertools
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple
+
+import httpx
+
+from config import (
+    API_MAX_RETRIES,
+    API_RETRY_BASE_DELAY,
+    API_RETRY_MAX_DELAY,
+    API_REQUEST_DEADLINE,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RECOVERY_TIME,
+)
+
+# کدهای وضعیتی که ارزش تلاش مجدد دارند (500 ممکن است پس از تولید پاسخ رخ داده باشد)
+RETRYABLE_STATUS_CODES = frozenset({429, 502, 503, 504})
+
+# خطاهایی که درخواست هرگز به API نرسیده است؛ تکرار POST فقط در این حالت هزینه‌ی دوباره ندارد
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+# نوبت ارسالی که allow می‌دهد: (نسل مدار، شماره‌ی درخواست آزمایشی یا 0)
+Ticket = Tuple[int, int]
+
+
+class CircuitOpenError(Exception):
+    """مدار باز است؛ درخواست بدون ارسال رد می‌شود"""
+
+
+class CircuitBreaker:
+    """
+    قطع‌کننده‌ی مدار سه‌حالته (closed / open / half_open)
+    پس از چند خطای پیاپی مدار باز می‌شود و تا پایان زمان بازیابی درخواست‌ها فوراً رد می‌شوند؛
+    سپس یک درخواست آزمایشی اجازه می‌یابد و نتیجه‌ی آن وضعیت مدار را تعیین می‌کند.
+    هر درخواست با نوبتی که allow داده نتیجه‌اش را ثبت می‌کند: فقط صاحب نوبت آزمایشی مدار نیمه‌باز را
+    می‌بندد یا آزاد می‌کند و نتیجه‌ی درخواست‌هایی که پیش از آخرین باز شدن مدار ارسال شده‌اند نادیده گرفته می‌شود.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 recovery_time: float = CIRCUIT_RECOVERY_TIME):
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        # با هر باز شدن مدار افزایش می‌یابد
+        self._generation = 0
+        self._probe_ids = itertools.count(1)
+        # شماره‌ی درخواست آزمایشی در جریان (0 = هیچ)
+        self._probe = 0
+    
+    def available(self) -> bool:
+        """بررسی امکان ارسال درخواست بدون مصرف نوبت آزمایشی"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at >= self.recovery_time
+        return not self._probe
+    
+    def allow(self) -> Optional[Ticket]:
+        """نوبت ارسال درخواست جدید؛ None یعنی درخواست مجاز نیست"""
+        if self.state == self.CLOSED:
+            return (self._generation, 0)
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.recovery_time:
+                return None
+            self.state = self.HALF_OPEN
+            self._probe = 0
+        # half_open: فقط یک درخواست آزمایشی
+        if self._probe:
+            return None
+        self._probe = next(self._probe_ids)
+        return (self._generation, self._probe)
+    
+    def _is_probe(self, ticket: Ticket) -> bool:
+        return ticket[1] != 0 and ticket[1] == self._probe
+    
+    def _is_current(self, ticket: Ticket) -> bool:
+        """درخواست عادی که در همین دوره‌ی بسته بودن مدار ارسال شده است"""
+        return self.state == self.CLOSED and ticket == (self._generation, 0)
+    
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._generation += 1
+        self._probe = 0
+    
+    def record_success(self, ticket: Ticket):
+        if self._is_probe(ticket):
+            self.state = self.CLOSED
+            self._probe = 0
+            self.failures = 0
+        elif self._is_current(ticket):
+            self.failures = 0
+    
+    def release(self, ticket: Ticket):
+        """آزاد کردن نوبت آزمایشی بدون تغییر وضعیت (درخواست لغو شد یا نتیجه‌اش نشانه‌ی سلامت API نیست)"""
+        if self._is_probe(ticket):
+            self._probe = 0
+    
+    def record_failure(self, ticket: Ticket):
+        if self._is_probe(ticket):
+            self.failures += 1
+            self._open()
+        elif self._is_current(ticket):
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self._open()
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    خطاهای قابل تکرار: درخواستی که به API نرسیده و کدهای 429/502/503/504
+    timeout خواندن یا قطع اتصال پس از ارسال تکرار نمی‌شود؛ ممکن است پاسخ تولید و محاسبه شده باشد.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, UNSENT_ERRORS)
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    """خطاهایی که نشانه‌ی ناسالم بودن API هستند (429 به حساب نمی‌آید)"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def request_deadline() -> float:
+    """زمان پایان مهلت یک درخواست (بر حسب time.monotonic)"""
+    return time.monotonic() + API_REQUEST_DEADLINE
+
+
+def remaining(deadline: float) -> float:
+    """زمان باقی‌مانده تا پایان مهلت (ثانیه)"""
+    return max(0.0, deadline - time.monotonic())
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """خواندن هدر Retry-After (ثانیه یا تاریخ HTTP)"""
+    if not isinstance(error, httpx.HTTPStatusError):
+        return None
+    value = error.response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """
+    زمان انتظار پیش از تلاش بعدی: Retry-After کامل در صورت وجود، وگرنه
+    backoff نمایی با jitter کامل (محدود به API_RETRY_MAX_DELAY)
+    """
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def should_retry(attempt: int, error: Exception) -> bool:
+    return attempt < API_MAX_RETRIES and is_retryable(error)
+
+
+def plan_retry(attempt: int, error: Exception, deadline: float) -> Optional[float]:
+    """
+    زمان انتظار پیش از تلاش بعدی؛ None یعنی خطا به فراخواننده برگردد
+    Retry-After سرور کوتاه نمی‌شود: اگر تا پایان مهلت درخواست جایی برای آن نباشد تلاش مجددی انجام نمی‌شود.
+    """
+    if not should_retry(attempt, error):
+        return None
+    delay = retry_delay(attempt, error)
+    if delay >= remaining(deadline):
+        return None
+    return delay
+
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+کش پاسخ برای پرسش‌های تکراری
+Exact-match response cache for single-turn prompts
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Optional, List, Dict
+
+from config import (
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+)
+from metrics import registry
+
+
+def normalize_content(text: str) -> str:
+    """یکسان‌سازی فاصله‌ها برای مقایسه‌ی دقیق پیام‌ها"""
+    return ' '.join(text.split())
+
+
+class ResponseCache:
+    """
+    کش LRU/TTL پاسخ‌های مدل با کلید هش (مدل + پیام‌های یکسان‌سازی‌شده)
+    فقط درخواست‌های تک‌نوبتی (گفتگوی تازه، بدون پاسخ قبلی مدل) کش می‌شوند
+    چون پاسخ آن‌ها به تاریخچه‌ی هیچ کاربری وابسته نیست.
+    """
+    
+    def __init__(self, enabled: bool = RESPONSE_CACHE, max_size: int = RESPONSE_CACHE_SIZE,
+                 ttl: float = RESPONSE_CACHE_TTL):
+        self.enabled = enabled and max_size > 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+    
+    @staticmethod
+    def is_cacheable(messages: List[Dict]) -> bool:
+        """فقط پیام سیستمی و یک پیام کاربر"""
+        roles = [m['role'] for m in messages]
+        return roles.count('user') == 1 and all(r in ('system', 'user') for r in roles)
+    
+    @staticmethod
+    def make_key(model: str, messages: List[Dict]) -> str:
+        normalized = [[m['role'], normalize_content(m['content'])] for m in messages]
+        raw = json.dumps([model, normalized], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def key_for(self, model: str, messages: List[Dict]) -> Optional[str]:
+        """کلید کش درخواست؛ None اگر کش غیرفعال یا درخواست قابل کش نباشد"""
+        if not self.enabled or not self.is_cacheable(messages):
+            return None
+        return self.make_key(model, messages)
+    
+    def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+    
+    def set(self, key: str, response: str):
+        self._data[key] = (time.monotonic() + self.ttl, response)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def stats(self) -> Dict:
+        """آمار کش: تعداد رکوردها، hit و miss"""
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+# نمونه singleton
+response_cache = ResponseCache()
+registry.register_stats('response_cache', response_cache.stats)
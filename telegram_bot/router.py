@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+مسیریابی درخواست‌ها بین مدل‌ها و endpointهای مختلف
+Multi-model routing with latency-aware backend selection
+"""
+
+import math
+import time
+from typing import Optional, List, Dict, Tuple
+
+from config import (
+    API_ENDPOINT,
+    API_BACKENDS,
+    DEFAULT_MODEL,
+    FALLBACK_MODELS,
+    ROUTER_SLOW_THRESHOLD,
+    ROUTER_SLOW_TTFT,
+    ROUTER_PROBE_INTERVAL,
+    ROUTER_DECAY_TIME,
+    ROUTER_EWMA_ALPHA,
+)
+from resilience import CircuitBreaker, Ticket
+from metrics import registry
+
+
+class LatencyAverage:
+    """
+    میانگین نمایی تأخیر با آستانه‌ی کندی خودش
+    نمونه‌ی جدید پس از مدتی بی‌خبری وزن بیشتری می‌گیرد، پس یک اندازه‌گیری تازه
+    جای میانگین کهنه را می‌گیرد و یک دوره‌ی کندی قدیمی backend را برای همیشه کند نگه نمی‌دارد.
+    """
+    
+    def __init__(self, threshold: float, decay_time: float = ROUTER_DECAY_TIME):
+        self.threshold = threshold
+        self.decay_time = decay_time
+        self.value: Optional[float] = None
+        self._updated = 0.0
+    
+    def record(self, sample: float, alpha: float = ROUTER_EWMA_ALPHA):
+        now = time.monotonic()
+        if self.value is None:
+            self.value = sample
+        else:
+            weight = alpha
+            if self.decay_time > 0:
+                weight = max(alpha, 1 - math.exp(-(now - self._updated) / self.decay_time))
+            self.value = weight * sample + (1 - weight) * self.value
+        self._updated = now
+    
+    def is_slow(self) -> bool:
+        return self.value is not None and self.value > self.threshold
+
+
+class Backend:
+    """یک مقصد درخواست (endpoint + مدل) به همراه آمار لحظه‌ای آن"""
+    
+    def __init__(self, endpoint: str, model: str, weight: float = 1.0,
+                 api_key: Optional[str] = None, max_concurrency: int = 0):
+        self.endpoint = endpoint
+        self.model = model
+        self.weight = max(weight, 0.01)
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency  # 0 = بدون سقف
+        self.breaker = CircuitBreaker()
+        
+        # آمار: میانگین نمایی تأخیر پاسخ کامل، زمان رسیدن اولین تکه‌ی stream و نرخ خطا
+        # دو تأخیر جدا نگه داشته می‌شوند چون با هم قابل مقایسه نیستند
+        self.latency = LatencyAverage(ROUTER_SLOW_THRESHOLD)
+        self.ttft = LatencyAverage(ROUTER_SLOW_TTFT)
+        self.error_rate = 0.0
+        self.last_used = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+    
+    @property
+    def name(self) -> str:
+        return f"{self.model}@{self.endpoint}"
+    
+    def available(self) -> bool:
+        return self.breaker.available()
+    
+    def _average(self, stream: bool) -> LatencyAverage:
+        return self.ttft if stream else self.latency
+    
+    def is_slow(self, stream: bool = False) -> bool:
+        return self._average(stream).is_slow()
+    
+    def probe_due(self, now: float) -> bool:
+        """backend کند پس از ROUTER_PROBE_INTERVAL بی‌استفاده ماندن یک درخواست می‌گیرد تا دوباره اندازه‌گیری شود"""
+        return ROUTER_PROBE_INTERVAL > 0 and now - self.last_used >= ROUTER_PROBE_INTERVAL
+    
+    def is_saturated(self) -> bool:
+        return self.max_concurrency > 0 and self.in_flight >= self.max_concurrency
+    
+    def score(self, stream: bool = False) -> float:
+        """امتیاز انتخاب (کمتر بهتر)؛ backend بدون آمار ابتدا امتحان می‌شود"""
+        latency = self._average(stream).value
+        if latency is None:
+            return 0.0
+        return latency * (1 + 4 * self.error_rate) / self.weight
+    
+    def record(self, ticket: Ticket, latency: Optional[float], failed: bool,
+               upstream_failure: bool = False, stream: bool = False):
+        """
+        ثبت نتیجه‌ی درخواستی که با نوبت ticket ارسال شد (stream: تأخیر، زمان رسیدن اولین تکه است)
+        فقط پاسخ موفق مدار را می‌بندد؛ 429 و دیگر خطاهای 4xx وضعیت مدار را تغییر نمی‌دهند.
+        """
+        alpha = ROUTER_EWMA_ALPHA
+        self.requests += 1
+        if latency is not None:
+            self._average(stream).record(latency, alpha)
+        self.error_rate = alpha * (1.0 if failed else 0.0) + (1 - alpha) * self.error_rate
+        if failed:
+            self.failures += 1
+        if upstream_failure:
+            self.breaker.record_failure(ticket)
+        elif failed:
+            self.breaker.release(ticket)
+        else:
+            self.breaker.record_success(ticket)
+    
+    def stats(self) -> Dict:
+        return {
+            'name': self.name,
+            'state': self.breaker.state,
+            'latency': self.latency.value,
+            'ttft': self.ttft.value,
+            'error_rate': self.error_rate,
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+
+
+class ModelRouter:
+    """
+    انتخاب سریع‌ترین backend سالم برای مدل درخواستی
+    اگر backendهای مدل اصلی کند، اشباع یا از دسترس خارج باشند، مدل‌های جایگزین
+    (FALLBACK_MODELS) استفاده می‌شوند.
+    """
+    
+    def __init__(self, backends: Optional[List[Backend]] = None,
+                 fallback_models: Optional[List[str]] = None):
+        self.backends: List[Backend] = list(backends or [])
+        self.fallback_models = list(fallback_models or [])
+    
+    def backends_for(self, model: str) -> List[Backend]:
+        """backendهای یک مدل؛ برای مدل تعریف‌نشده یک backend روی API_ENDPOINT ساخته می‌شود"""
+        found = [b for b in self.backends if b.model == model]
+        if not found:
+            backend = Backend(API_ENDPOINT, model)
+            self.backends.append(backend)
+            found = [backend]
+        return found
+    
+    @staticmethod
+    def _best(backends: List[Backend], stream: bool) -> Optional[Backend]:
+        return min(backends, key=lambda b: b.score(stream)) if backends else None
+    
+    def select(self, model: str = DEFAULT_MODEL, exclude: tuple = (),
+               stream: bool = False) -> Optional[Tuple[Backend, Ticket]]:
+        """
+        انتخاب backend برای یک درخواست همراه با نوبت مدار آن؛ None یعنی هیچ backend در دسترس نیست
+        کندی با تأخیر همان نوع درخواست (stream یا پاسخ کامل) سنجیده می‌شود.
+        """
+        now = time.monotonic()
+        primary = [b for b in self.backends_for(model) if b.available() and b not in exclude]
+        fallback = [
+            b for m in self.fallback_models if m != model
+            for b in self.backends_for(m) if b.available() and b not in exclude
+        ]
+        
+        # backend کند اصلی گاهی یک درخواست می‌گیرد، وگرنه تأخیرش هیچ‌وقت به‌روز نمی‌شود
+        for backend in primary:
+            if backend.is_slow(stream) and backend.probe_due(now):
+                ticket = backend.breaker.allow()
+                if ticket is not None:
+                    backend.last_used = now
+                    return backend, ticket
+        
+        fast_primary = [b for b in primary if not b.is_slow(stream) and not b.is_saturated()]
+        fast_fallback = [b for b in fallback if not b.is_slow(stream) and not b.is_saturated()]
+        
+        for group in (fast_primary, fast_fallback, primary, fallback):
+            backend = self._best(group, stream)
+            if backend is None:
+                continue
+            ticket = backend.breaker.allow()
+            if ticket is not None:
+                backend.last_used = now
+                return backend, ticket
+        return None
+    
+    def stats(self) -> List[Dict]:
+        return [b.stats() for b in self.backends]
+
+
+def _load_backends() -> List[Backend]:
+    backends = [
+        Backend(
+            item.get('endpoint', API_ENDPOINT),
+            item['model'],
+            float(item.get('weight', 1.0)),
+            item.get('api_key'),
+            int(item.get('max_concurrency', 0)),
+        )
+        for item in API_BACKENDS
+    ]
+    if not backends:
+        backends = [Backend(API_ENDPOINT, DEFAULT_MODEL)]
+    return backends
+
+
+# نمونه singleton
+model_router = ModelRouter(_load_backends(), FALLBACK_MODELS)
+registry.register_stats('router_backend', model_router.stats, ('name', 'state'))
+
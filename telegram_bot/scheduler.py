@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+زمان‌بندی درخواست‌های API: محدودیت نرخ، همزمانی و صف عادلانه
+Upstream rate limiter and fair bounded-concurrency scheduler
+"""
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Optional, Dict
+
+from config import (
+    ADMIN_ID,
+    API_MAX_CONCURRENCY,
+    API_RATE_LIMIT_RPM,
+    API_RATE_BURST,
+)
+from metrics import registry
+
+
+class TokenBucket:
+    """سطل توکن برای محدود کردن تعداد درخواست در دقیقه (rpm <= 0 یعنی نامحدود)"""
+    
+    def __init__(self, rpm: float, burst: Optional[float] = None):
+        self.rate = rpm / 60.0
+        self.capacity = max(1.0, burst if burst else max(1.0, rpm / 6.0))
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def try_take(self) -> float:
+        """برداشتن یک توکن؛ در صورت نبود، زمان انتظار لازم (ثانیه) برگردانده می‌شود"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class UpstreamScheduler:
+    """
+    صف درخواست‌ها به API با سقف همزمانی و نرخ
+    درخواست‌های ادمین اولویت دارند و بقیه به صورت نوبتی (round-robin) بین کاربران
+    پخش می‌شوند تا یک کاربر پرمصرف بقیه را پشت صف نگه ندارد.
+    """
+    
+    def __init__(self, max_concurrency: int = API_MAX_CONCURRENCY,
+                 rpm: float = API_RATE_LIMIT_RPM, burst: Optional[float] = API_RATE_BURST):
+        self.max_concurrency = max(1, max_concurrency)
+        self.bucket = TokenBucket(rpm, burst)
+        self.in_flight = 0
+        self._priority = deque()
+        self._queues: 'OrderedDict[Optional[int], deque]' = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # تعداد منتظران (future لغوشده همان لحظه کم می‌شود و بعداً از صف برداشته می‌شود)
+        self._waiting = 0
+        
+        # آمار
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    @property
+    def queued(self) -> int:
+        return self._waiting
+    
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        while self._priority:
+            future = self._priority.popleft()
+            if not future.done():
+                return future
+        
+        while self._queues:
+            user_id, queue = self._queues.popitem(last=False)
+            future = None
+            while queue and future is None:
+                candidate = queue.popleft()
+                if not candidate.done():
+                    future = candidate
+            if queue:
+                # کاربر به انتهای نوبت می‌رود
+                self._queues[user_id] = queue
+            if future is not None:
+                return future
+        return None
+    
+    def _dispatch(self):
+        self._timer = None
+        while self.in_flight < self.max_concurrency and self._waiting > 0:
+            delay = self.bucket.try_take()
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            future = self._next_waiter()
+            if future is None:
+                return
+            self._waiting -= 1
+            self.in_flight += 1
+            future.set_result(None)
+    
+    def release(self):
+        """آزاد کردن نوبت گرفته‌شده با acquire"""
+        self.in_flight -= 1
+        if self._timer is None:
+            self._dispatch()
+    
+    async def acquire(self, user_id: Optional[int] = None, priority: bool = False):
+        """انتظار تا رسیدن نوبت؛ پس از پایان کار باید release فراخوانی شود"""
+        future = asyncio.get_running_loop().create_future()
+        if priority:
+            self._priority.append(future)
+        else:
+            self._queues.setdefault(user_id, deque()).append(future)
+        self._waiting += 1
+        
+        started = time.monotonic()
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._waiting -= 1
+            else:
+                # نوبت داده شده بود اما استفاده نشد
+                self.release()
+            raise
+        
+        waited = time.monotonic() - started
+        self.dispatched += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+    
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[int] = None):
+        """گرفتن نوبت ارسال درخواست برای کاربر (ادمین با اولویت)"""
+        await self.acquire(user_id, priority=user_id is not None and user_id == ADMIN_ID)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    def stats(self) -> Dict:
+        """آمار صف: عمق صف، درخواست‌های در جریان و زمان انتظار"""
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'dispatched': self.dispatched,
+            'avg_wait': self.total_wait / self.dispatched if self.dispatched else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+# نمونه singleton
+upstream_scheduler = UpstreamScheduler()
+registry.register_stats('upstream_scheduler', upstream_scheduler.stats)